@@ -3,121 +3,36 @@ import streamlit as st
 import pandas as pd
 import datetime
 import os
-import io
-import uuid
-
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey, Text
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
-from contextlib import contextmanager
-
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
-import plotly.express as px
-import streamlit_javascript as st_js
-
-# --- Database Setup ---
-DB_PATH = "sqlite:///dental_clinic.db"
-engine = create_engine(DB_PATH, echo=False, connect_args={"check_same_thread": False})
-Session = sessionmaker(bind=engine)
-Base = declarative_base()
-
-# --- Models ---
-class Patient(Base):
-    __tablename__ = 'patients'
-    id = Column(Integer, primary_key=True)
-    name = Column(String, nullable=False)
-    age = Column(Integer)
-    gender = Column(String)
-    phone = Column(String)
-    address = Column(String)
-    medical_history = Column(Text)
-    image_path = Column(String)
-
-class Doctor(Base):
-    __tablename__ = 'doctors'
-    id = Column(Integer, primary_key=True)
-    name = Column(String, nullable=False)
-    specialty = Column(String)
-    phone = Column(String)
-    email = Column(String)
-
-class Treatment(Base):
-    __tablename__ = 'treatments'
-    id = Column(Integer, primary_key=True)
-    name = Column(String, nullable=False)
-    base_cost = Column(Float)
-
-class TreatmentPercentage(Base):
-    __tablename__ = 'treatment_percentages'
-    id = Column(Integer, primary_key=True)
-    treatment_id = Column(Integer, ForeignKey('treatments.id'))
-    doctor_id = Column(Integer, ForeignKey('doctors.id'))
-    clinic_percentage = Column(Float)
-    doctor_percentage = Column(Float)
-    treatment = relationship("Treatment")
-    doctor = relationship("Doctor")
-
-class Appointment(Base):
-    __tablename__ = 'appointments'
-    id = Column(Integer, primary_key=True)
-    patient_id = Column(Integer, ForeignKey('patients.id'))
-    doctor_id = Column(Integer, ForeignKey('doctors.id'))
-    treatment_id = Column(Integer, ForeignKey('treatments.id'))
-    date = Column(DateTime)
-    status = Column(String)
-    notes = Column(Text)
-    patient = relationship("Patient")
-    doctor = relationship("Doctor")
-    treatment = relationship("Treatment")
-
-class Payment(Base):
-    __tablename__ = 'payments'
-    id = Column(Integer, primary_key=True)
-    appointment_id = Column(Integer, ForeignKey('appointments.id'), nullable=True)
-    total_amount = Column(Float)
-    paid_amount = Column(Float)
-    clinic_share = Column(Float)
-    doctor_share = Column(Float)
-    payment_method = Column(String)
-    discounts = Column(Float)
-    taxes = Column(Float)
-    date_paid = Column(DateTime)
-    appointment = relationship("Appointment")
-
-class Expense(Base):
-    __tablename__ = 'expenses'
-    id = Column(Integer, primary_key=True)
-    description = Column(String)
-    amount = Column(Float)
-    date = Column(DateTime)
-
-class InventoryItem(Base):
-    __tablename__ = 'inventory_items'
-    id = Column(Integer, primary_key=True)
-    name = Column(String, nullable=False)
-    quantity = Column(Float)
-    unit = Column(String)
-    cost_per_unit = Column(Float)
-
-Base.metadata.create_all(engine)
-
-# --- DB session context manager ---
-@contextmanager
-def get_session():
-    session = Session()
-    try:
-        yield session
-        session.commit()
-    except Exception:
-        session.rollback()
-        raise
-    finally:
-        session.close()
+
+from models import init_db
+from database import (
+    PAGE_SIZE, REPORT_PERIODS, IMPORT_KINDS, IMPORT_COLUMNS,
+    add_patient, get_patients, get_patients_page, search_patients, get_patient, edit_patient, delete_patient,
+    add_doctor, get_doctors, search_doctors, get_doctor, edit_doctor, delete_doctor,
+    add_treatment, get_treatments, edit_treatment, set_treatment_percentage, get_treatment_percentage_rows, recalculate_shares,
+    MAX_DURATION_MINUTES, AppointmentConflict, find_free_slots,
+    add_appointment, search_appointments, get_appointments_page, get_appointment,
+    edit_appointment, delete_appointment,
+    add_payment, get_payments_page,
+    add_expense, get_expenses, delete_expense,
+    add_inventory_item, get_inventory_items, edit_inventory_item, delete_inventory_item,
+    get_low_stock_items, count_low_stock, get_stock_movements, get_treatment_materials, set_treatment_material,
+    get_financial_totals, get_financial_series, import_records,
+)
+from images import make_thumbnail
+from invoices import generate_invoice_pdf
+import branches
+import jobs
+from settlements import SettlementError, close_period, get_settlements, settlement_for, settlement_frame
+import sql_profile
+
+init_db()
+sql_profile.install()
 
 # --- Utility Functions ---
 def get_screen_width():
     try:
+        import streamlit_javascript as st_js
         width = st_js.st_javascript("window.innerWidth")
         return int(width) if width else 1000
     except Exception:
@@ -131,361 +46,84 @@ def determine_num_columns(width):
     else:
         return 3
 
-def secure_filename():
-    return uuid.uuid4().hex
-
-def save_uploaded_image(image_file, prefix="img"):
-    """Save uploaded streamlit file to images/ and return path"""
-    if image_file is None:
-        return None
-    os.makedirs("images", exist_ok=True)
-    ext = os.path.splitext(image_file.name)[1] if hasattr(image_file, "name") else ".png"
-    filename = f"{prefix}_{secure_filename()}{ext}"
-    path = os.path.join("images", filename)
-    with open(path, "wb") as f:
-        f.write(image_file.getvalue())
-    return path
-
-# --- CRUD Functions ---
-# Patients
-def add_patient(name, age=None, gender=None, phone=None, address=None, medical_history=None, image=None):
-    with get_session() as session:
-        patient = Patient(
-            name=name,
-            age=age,
-            gender=gender,
-            phone=phone,
-            address=address,
-            medical_history=medical_history
-        )
-        if image:
-            patient.image_path = save_uploaded_image(image, prefix="patient")
-        session.add(patient)
-        session.flush()  # to get id
-        return patient.id
-
-def get_patients():
-    with get_session() as session:
-        return session.query(Patient).order_by(Patient.id).all()
-
-def get_patient(patient_id):
-    with get_session() as session:
-        return session.get(Patient, patient_id)
-
-def edit_patient(patient_id, name, age, gender, phone, address, medical_history, image=None):
-    with get_session() as session:
-        patient = session.get(Patient, patient_id)
-        if not patient:
-            return False
-        patient.name = name
-        patient.age = age
-        patient.gender = gender
-        patient.phone = phone
-        patient.address = address
-        patient.medical_history = medical_history
-        if image:
-            patient.image_path = save_uploaded_image(image, prefix="patient")
-        return True
-
-def delete_patient(patient_id):
-    with get_session() as session:
-        patient = session.get(Patient, patient_id)
-        if patient:
-            session.delete(patient)
-            return True
-    return False
-
-# Doctors
-def add_doctor(name, specialty=None, phone=None, email=None):
-    with get_session() as session:
-        doc = Doctor(name=name, specialty=specialty, phone=phone, email=email)
-        session.add(doc)
-        session.flush()
-        return doc.id
-
-def get_doctors():
-    with get_session() as session:
-        return session.query(Doctor).order_by(Doctor.id).all()
-
-def get_doctor(doctor_id):
-    with get_session() as session:
-        return session.get(Doctor, doctor_id)
-
-def edit_doctor(doctor_id, name, specialty, phone, email):
-    with get_session() as session:
-        doc = session.get(Doctor, doctor_id)
-        if not doc:
-            return False
-        doc.name = name
-        doc.specialty = specialty
-        doc.phone = phone
-        doc.email = email
-        return True
-
-def delete_doctor(doctor_id):
-    with get_session() as session:
-        doc = session.get(Doctor, doctor_id)
-        if doc:
-            session.delete(doc)
-            return True
-    return False
-
-# Treatments
-def add_treatment(name, base_cost):
-    with get_session() as session:
-        t = Treatment(name=name, base_cost=base_cost)
-        session.add(t)
-        session.flush()
-        return t.id
-
-def get_treatments():
-    with get_session() as session:
-        return session.query(Treatment).order_by(Treatment.id).all()
-
-def get_treatment(treatment_id):
-    with get_session() as session:
-        return session.get(Treatment, treatment_id)
-
-def edit_treatment(treatment_id, name, base_cost):
-    with get_session() as session:
-        t = session.get(Treatment, treatment_id)
-        if not t:
-            return False
-        t.name = name
-        t.base_cost = base_cost
-        return True
-
-def delete_treatment(treatment_id):
-    with get_session() as session:
-        t = session.get(Treatment, treatment_id)
-        if t:
-            session.delete(t)
-            return True
-    return False
-
-# Treatment Percentage
-def set_treatment_percentage(treatment_id, doctor_id, clinic_percentage, doctor_percentage):
-    with get_session() as session:
-        tp = session.query(TreatmentPercentage).filter_by(treatment_id=treatment_id, doctor_id=doctor_id).first()
-        if not tp:
-            tp = TreatmentPercentage(treatment_id=treatment_id, doctor_id=doctor_id,
-                                     clinic_percentage=clinic_percentage, doctor_percentage=doctor_percentage)
-            session.add(tp)
-        else:
-            tp.clinic_percentage = clinic_percentage
-            tp.doctor_percentage = doctor_percentage
-        return True
-
-def get_treatment_percentages():
-    with get_session() as session:
-        return session.query(TreatmentPercentage).order_by(TreatmentPercentage.id).all()
-
-# Appointments
-def add_appointment(patient_id, doctor_id, treatment_id, date, status="مجدول", notes=None):
-    with get_session() as session:
-        appt = Appointment(patient_id=patient_id, doctor_id=doctor_id, treatment_id=treatment_id,
-                           date=date, status=status, notes=notes)
-        session.add(appt)
-        session.flush()
-        return appt.id
-
-def get_appointments():
-    with get_session() as session:
-        return session.query(Appointment).order_by(Appointment.date.desc()).all()
-
-def get_appointment(appointment_id):
-    with get_session() as session:
-        return session.get(Appointment, appointment_id)
-
-def edit_appointment(appointment_id, patient_id, doctor_id, treatment_id, date, status, notes):
-    with get_session() as session:
-        appt = session.get(Appointment, appointment_id)
-        if not appt:
-            return False
-        appt.patient_id = patient_id
-        appt.doctor_id = doctor_id
-        appt.treatment_id = treatment_id
-        appt.date = date
-        appt.status = status
-        appt.notes = notes
-        return True
-
-def delete_appointment(appointment_id):
-    with get_session() as session:
-        appt = session.get(Appointment, appointment_id)
-        if appt:
-            session.delete(appt)
-            return True
-    return False
-
-# Payment calculation and CRUD
-def calculate_shares(appointment_id, total_amount, discounts=0.0, taxes=0.0):
-    with get_session() as session:
-        appointment = session.get(Appointment, appointment_id)
-        if not appointment:
-            # default split if appointment missing
-            clinic_perc = 50.0
-            doctor_perc = 50.0
+# --- Streamlit Pages ---
+def page_cursor(key):
+    """Cursor of the page currently shown for the list identified by key"""
+    stack = st.session_state.setdefault(f"{key}_cursors", [None])
+    return stack[-1]
+
+def reset_pages(key):
+    st.session_state[f"{key}_cursors"] = [None]
+
+def _next_page(key, cursor):
+    st.session_state[f"{key}_cursors"].append(cursor)
+
+def _prev_page(key):
+    stack = st.session_state[f"{key}_cursors"]
+    if len(stack) > 1:
+        stack.pop()
+
+def page_controls(key, next_cursor):
+    stack = st.session_state.setdefault(f"{key}_cursors", [None])
+    c1, c2, c3 = st.columns([1, 1, 4])
+    with c1:
+        st.button("السابق", key=f"{key}_prev", disabled=len(stack) <= 1, on_click=_prev_page, args=(key,))
+    with c2:
+        st.button("التالي", key=f"{key}_next", disabled=next_cursor is None, on_click=_next_page, args=(key, next_cursor))
+    with c3:
+        st.caption(f"صفحة {len(stack)}")
+
+# kind -> (label, download file name, mime type)
+EXPORT_FILES = {
+    "payments_csv": ("ملخص الدفعات (CSV)", "payments_summary.csv", "text/csv"),
+    "report_pdf": ("تقرير المحاسبة (PDF)", "report.pdf", "application/pdf"),
+    "report_excel": ("تقرير المحاسبة (Excel)", "report.xlsx",
+                     "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    "invoices_zip": ("الفواتير (ZIP)", "invoices.zip", "application/zip"),
+    "doctor_statement": ("كشف حساب الطبيب (PDF)", "doctor_statement.pdf", "application/pdf"),
+}
+JOB_STATUS = {"queued": "في الانتظار", "running": "قيد التنفيذ", "done": "جاهز", "failed": "فشل", "expired": "قديم"}
+JOB_POLL_SECONDS = 2
+
+def submit_export(kind, **params):
+    """Start a background export; the session remembers the job so the page can show it"""
+    job_id = jobs.submit(kind, **params)
+    ids = st.session_state.setdefault("jobs", [])
+    if job_id not in ids:
+        ids.append(job_id)
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def job_progress(job_ids):
+    """Reruns on its own while exports run; reruns the page once one of them finishes"""
+    rows = jobs.get_jobs(job_ids)
+    if any(j.status not in jobs.ACTIVE for j in rows):
+        st.rerun()
+    for j in rows:
+        label = EXPORT_FILES[j.kind][0]
+        if j.total:
+            st.progress(min(j.done / j.total, 1.0), text=f"{label}: {j.done}/{j.total}")
         else:
-            perc = session.query(TreatmentPercentage).filter_by(
-                treatment_id=appointment.treatment_id,
-                doctor_id=appointment.doctor_id).first()
-            if perc:
-                clinic_perc = perc.clinic_percentage or 50.0
-                doctor_perc = perc.doctor_percentage or 50.0
-            else:
-                clinic_perc = 50.0
-                doctor_perc = 50.0
-    # compute net amounts
-    net_amount = float(total_amount) - float(discounts or 0.0) + float(taxes or 0.0)
-    clinic_share = round(net_amount * (clinic_perc / 100.0), 2)
-    doctor_share = round(net_amount * (doctor_perc / 100.0), 2)
-    return clinic_share, doctor_share
-
-def add_payment(appointment_id, total_amount, paid_amount, payment_method, discounts=0.0, taxes=0.0):
-    with get_session() as session:
-        clinic_share, doctor_share = calculate_shares(appointment_id, total_amount, discounts, taxes)
-        p = Payment(
-            appointment_id=appointment_id,
-            total_amount=total_amount,
-            paid_amount=paid_amount,
-            clinic_share=clinic_share,
-            doctor_share=doctor_share,
-            payment_method=payment_method,
-            discounts=discounts,
-            taxes=taxes,
-            date_paid=datetime.datetime.now()
-        )
-        session.add(p)
-        session.flush()
-        return p.id
-
-def get_payments():
-    with get_session() as session:
-        return session.query(Payment).order_by(Payment.date_paid.desc()).all()
-
-# Expenses
-def add_expense(description, amount, date=None):
-    with get_session() as session:
-        if date is None:
-            date = datetime.datetime.now()
-        e = Expense(description=description, amount=amount, date=date)
-        session.add(e)
-        session.flush()
-        return e.id
-
-def get_expenses():
-    with get_session() as session:
-        return session.query(Expense).order_by(Expense.date.desc()).all()
-
-def delete_expense(expense_id):
-    with get_session() as session:
-        e = session.get(Expense, expense_id)
-        if e:
-            session.delete(e)
-            return True
-    return False
-
-# Inventory
-def add_inventory_item(name, quantity, unit, cost_per_unit):
-    with get_session() as session:
-        it = InventoryItem(name=name, quantity=quantity, unit=unit, cost_per_unit=cost_per_unit)
-        session.add(it)
-        session.flush()
-        return it.id
-
-def get_inventory_items():
-    with get_session() as session:
-        return session.query(InventoryItem).order_by(InventoryItem.id).all()
-
-def edit_inventory_item(item_id, name, quantity, unit, cost_per_unit):
-    with get_session() as session:
-        it = session.get(InventoryItem, item_id)
-        if not it:
-            return False
-        it.name = name
-        it.quantity = quantity
-        it.unit = unit
-        it.cost_per_unit = cost_per_unit
-        return True
-
-def delete_inventory_item(item_id):
-    with get_session() as session:
-        it = session.get(InventoryItem, item_id)
-        if it:
-            session.delete(it)
-            return True
-    return False
-
-# --- PDF generation ---
-def generate_invoice_pdf(payment_id=None, appointment_id=None):
-    buffer = io.BytesIO()
-    c = canvas.Canvas(buffer, pagesize=letter)
-    width, height = letter
-    y = height - 50
-
-    # Header
-    c.setFont("Helvetica-Bold", 14)
-    c.drawString(50, y, "فاتورة عيادة الأسنان")
-    y -= 30
-
-    if payment_id:
-        with get_session() as session:
-            payment = session.get(Payment, payment_id)
-            if payment:
-                appt = payment.appointment
-                c.setFont("Helvetica", 11)
-                c.drawString(50, y, f"تاريخ الدفع: {payment.date_paid.strftime('%Y-%m-%d %H:%M') if payment.date_paid else ''}")
-                y -= 20
-                if appt:
-                    patient = appt.patient
-                    doctor = appt.doctor
-                    treatment = appt.treatment
-                    c.drawString(50, y, f"المريض: {patient.name if patient else ''}")
-                    y -= 15
-                    c.drawString(50, y, f"الطبيب: {doctor.name if doctor else ''}")
-                    y -= 15
-                    c.drawString(50, y, f"العلاج: {treatment.name if treatment else ''}")
-                    y -= 20
-
-                c.drawString(50, y, f"المبلغ الإجمالي: {payment.total_amount}")
-                y -= 15
-                c.drawString(50, y, f"الخصم: {payment.discounts or 0.0}")
-                y -= 15
-                c.drawString(50, y, f"الضريبة: {payment.taxes or 0.0}")
-                y -= 15
-                c.drawString(50, y, f"حصة العيادة: {payment.clinic_share}")
-                y -= 15
-                c.drawString(50, y, f"حصة الطبيب: {payment.doctor_share}")
-                y -= 15
-                c.drawString(50, y, f"المدفوع: {payment.paid_amount}")
-                y -= 30
-
-    elif appointment_id:
-        with get_session() as session:
-            appt = session.get(Appointment, appointment_id)
-            if appt:
-                patient = appt.patient
-                doctor = appt.doctor
-                treatment = appt.treatment
-                c.setFont("Helvetica", 11)
-                c.drawString(50, y, f"تاريخ الموعد: {appt.date.strftime('%Y-%m-%d %H:%M') if appt.date else ''}")
-                y -= 20
-                c.drawString(50, y, f"المريض: {patient.name if patient else ''}")
-                y -= 15
-                c.drawString(50, y, f"الطبيب: {doctor.name if doctor else ''}")
-                y -= 15
-                c.drawString(50, y, f"العلاج: {treatment.name if treatment else ''}")
-                y -= 25
-                c.drawString(50, y, f"ملاحظات: {appt.notes or ''}")
-                y -= 25
-
-    c.showPage()
-    c.save()
-    buffer.seek(0)
-    return buffer
+            st.caption(f"{label}: {JOB_STATUS[j.status]} ({j.done or 0})")
+
+def export_jobs(kinds):
+    """This session's exports of the given kinds: downloads, errors and live progress"""
+    rows = [j for j in jobs.get_jobs(st.session_state.get("jobs")) if j.kind in kinds]
+    files = st.session_state.setdefault("job_files", {})  # job id -> bytes, read once per job
+    for j in rows:
+        label, file_name, mime = EXPORT_FILES[j.kind]
+        if j.status == "done" and j.result_path and (j.id in files or os.path.exists(j.result_path)):
+            if j.id not in files:
+                with open(j.result_path, "rb") as f:
+                    files[j.id] = f.read()
+            seconds = (j.finished_at - j.started_at).total_seconds() if j.started_at else 0
+            st.download_button(f"تحميل {label} — {j.done} صف، {seconds:.1f} ثانية", data=files[j.id],
+                               file_name=file_name, mime=mime, key=f"job-{j.id}")
+        elif j.status == "failed":
+            st.error(f"{label}: {JOB_STATUS[j.status]} ({j.error})")
+    active = [j.id for j in rows if j.status in jobs.ACTIVE]
+    if active:
+        job_progress(active)
 
-# --- Streamlit Pages ---
 def patients_page(num_cols):
     st.title("إدارة المرضى")
     with st.expander("إضافة مريض جديد", expanded=False):
@@ -512,18 +150,18 @@ def patients_page(num_cols):
                     st.success(f"تم إضافة المريض (ID: {pid})")
 
     st.markdown("---")
-    patients = get_patients()
+    search = st.text_input("بحث (اسم، هاتف، عنوان)", key="patients_search", on_change=reset_pages, args=("patients",))
+    if search.strip():
+        patients, next_cursor = search_patients(search, limit=PAGE_SIZE), None
+    else:
+        patients, next_cursor = get_patients_page(page_cursor("patients"))
     df = pd.DataFrame([{
         "ID": p.id, "الاسم": p.name, "العمر": p.age, "الجنس": p.gender or "",
         "الهاتف": p.phone or "", "العنوان": p.address or ""
     } for p in patients])
 
-    search = st.text_input("بحث (اسم، هاتف، عنوان)")
-    if search:
-        mask = df.astype(str).apply(lambda col: col.str.contains(search, case=False, na=False)).any(axis=1)
-        df = df[mask]
-
     st.dataframe(df, use_container_width=True)
+    page_controls("patients", next_cursor)
 
     st.markdown("### تحرير / حذف مريض")
     ids = [p.id for p in patients]
@@ -532,6 +170,9 @@ def patients_page(num_cols):
         pid = int(selected)
         p = get_patient(pid)
         if p:
+            thumb = make_thumbnail(p.image_path) if p.image_path else None
+            if thumb:
+                st.image(thumb, width=160)
             with st.form("edit-patient"):
                 name = st.text_input("الاسم", value=p.name)
                 age = st.number_input("العمر", min_value=0, step=1, value=p.age or 0)
@@ -577,12 +218,9 @@ def doctors_page(num_cols):
                     st.success(f"تم إضافة الطبيب (ID: {did})")
 
     st.markdown("---")
-    doctors = get_doctors()
-    df = pd.DataFrame([{"ID": d.id, "الاسم": d.name, "التخصص": d.specialty or "", "الهاتف": d.phone or "", "البريد": d.email or ""} for d in doctors])
     search = st.text_input("بحث في الأطباء")
-    if search:
-        mask = df.astype(str).apply(lambda col: col.str.contains(search, case=False, na=False)).any(axis=1)
-        df = df[mask]
+    doctors = search_doctors(search) if search.strip() else get_doctors()
+    df = pd.DataFrame([{"ID": d.id, "الاسم": d.name, "التخصص": d.specialty or "", "الهاتف": d.phone or "", "البريد": d.email or ""} for d in doctors])
     st.dataframe(df, use_container_width=True)
 
     st.markdown("### تحرير / حذف طبيب")
@@ -619,21 +257,39 @@ def treatments_page(num_cols):
         with st.form("add-treatment"):
             name = st.text_input("اسم العلاج")
             base_cost = st.number_input("السعر الأساسي", min_value=0.0, value=0.0, step=1.0)
+            duration = st.number_input("مدة العلاج (دقيقة)", min_value=5, max_value=MAX_DURATION_MINUTES, value=30, step=5)
             if st.form_submit_button("إضافة"):
                 if not name.strip():
                     st.error("يرجى إدخال اسم العلاج")
                 else:
-                    tid = add_treatment(name=name.strip(), base_cost=float(base_cost))
+                    tid = add_treatment(name=name.strip(), base_cost=float(base_cost), duration_minutes=int(duration))
                     st.success(f"تم إضافة العلاج (ID: {tid})")
 
     st.markdown("---")
     treatments = get_treatments()
-    df = pd.DataFrame([{"ID": t.id, "العلاج": t.name, "السعر": t.base_cost} for t in treatments])
+    df = pd.DataFrame([{"ID": t.id, "العلاج": t.name, "السعر": t.base_cost, "المدة (دقيقة)": t.duration_minutes} for t in treatments])
     st.dataframe(df, use_container_width=True)
 
+    st.markdown("### تحرير علاج")
+    by_id = {t.id: t for t in treatments}
+    selected = st.selectbox("اختر ID للعلاج", options=[""] + list(by_id))
+    if selected:
+        t = by_id[int(selected)]
+        with st.form("edit-treatment"):
+            name = st.text_input("اسم العلاج", value=t.name)
+            base_cost = st.number_input("السعر الأساسي", min_value=0.0, value=float(t.base_cost or 0.0), step=1.0)
+            duration = st.number_input("مدة العلاج (دقيقة)", min_value=5, max_value=MAX_DURATION_MINUTES,
+                                       value=int(t.duration_minutes or 30), step=5)
+            if st.form_submit_button("حفظ التعديلات"):
+                if not name.strip():
+                    st.error("يرجى إدخال اسم العلاج")
+                elif edit_treatment(t.id, name=name.strip(), base_cost=float(base_cost), duration_minutes=int(duration)):
+                    st.success("تم حفظ التعديلات")
+                else:
+                    st.error("حدث خطأ")
+
     st.markdown("### نسب التوزيع بين العيادة والطبيب")
     doctors = get_doctors()
-    treatments = get_treatments()
     if doctors and treatments:
         with st.form("set-percentage"):
             t_choice = st.selectbox("اختر علاج", options=[("", None)] + [(f"{t.id} - {t.name}", t.id) for t in treatments], format_func=lambda x: x[0] if x else "")
@@ -645,16 +301,62 @@ def treatments_page(num_cols):
                     st.error("اختر علاجًا وطبيبًا")
                 else:
                     set_treatment_percentage(t_choice[1], d_choice[1], float(clinic_perc), float(doctor_perc))
-                    st.success("تم حفظ نسب التوزيع")
+                    st.success("تم حفظ نسب التوزيع — استخدم إعادة الحساب أدناه لتحديث الدفعات السابقة")
     else:
         st.info("أضف على الأقل طبيبًا وعلاجًا لإعداد النسب")
 
+    with st.expander("إعادة حساب حصص الدفعات السابقة", expanded=False):
+        c1, c2 = st.columns(2)
+        with c1:
+            rt = st.selectbox("العلاج", options=[("كل العلاجات", None)] + [(f"{t.id} - {t.name}", t.id) for t in treatments],
+                              format_func=lambda x: x[0], key="recalc-treatment")
+            since = st.date_input("من تاريخ (اختياري)", value=None, key="recalc-start")
+        with c2:
+            rd = st.selectbox("الطبيب", options=[("كل الأطباء", None)] + [(f"{d.id} - {d.name}", d.id) for d in doctors],
+                              format_func=lambda x: x[0], key="recalc-doctor")
+            until = st.date_input("إلى تاريخ (اختياري)", value=None, key="recalc-end")
+        b1, b2 = st.columns(2)
+        preview = b1.button("معاينة التغييرات")
+        apply = b2.button("تطبيق إعادة الحساب")
+        if preview or apply:
+            changes = recalculate_shares(rt[1], rd[1], since, until, dry_run=preview)
+            if not changes:
+                st.info("كل الحصص المخزنة مطابقة للنسب الحالية")
+            else:
+                df3 = pd.DataFrame(changes).rename(columns={
+                    "treatment_id": "علاج/ID", "doctor_id": "طبيب/ID", "payments": "عدد الدفعات",
+                    "clinic_delta": "فرق حصة العيادة", "doctor_delta": "فرق حصة الطبيب"})
+                st.dataframe(df3, use_container_width=True)
+                total = sum(c["payments"] for c in changes)
+                if preview:
+                    st.warning(f"سيتم تعديل {total} دفعة (لم يُحفظ شيء بعد)")
+                else:
+                    st.success(f"تم تحديث {total} دفعة")
+
+    st.markdown("### المواد المستهلكة لكل علاج")
+    items = get_inventory_items()
+    if items and treatments:
+        with st.form("set-material"):
+            t_choice = st.selectbox("اختر علاج", options=[(f"{t.id} - {t.name}", t.id) for t in treatments], format_func=lambda x: x[0],
+                                    key="material-treatment")
+            i_choice = st.selectbox("اختر صنف", options=[(f"{it.id} - {it.name}", it.id) for it in items], format_func=lambda x: x[0],
+                                    key="material-item")
+            qty = st.number_input("الكمية لكل علاج (0 للإزالة)", min_value=0.0, value=1.0)
+            if st.form_submit_button("حفظ المادة"):
+                set_treatment_material(t_choice[1], i_choice[1], float(qty))
+                st.success("تم الحفظ — تُخصم المواد من المخزون عند تحويل الموعد إلى \"تم\"")
+        names = {t.id: t.name for t in treatments}
+        st.dataframe(pd.DataFrame([{"علاج": names.get(m.treatment_id, ""), "الصنف": m.name, "الكمية": m.quantity,
+                                    "الوحدة": m.unit} for m in get_treatment_materials()]), use_container_width=True)
+    else:
+        st.info("أضف أصنافًا في المخزون لربطها بالعلاجات")
+
     st.markdown("### قائمة نسب التوزيع")
-    tps = get_treatment_percentages()
+    tps = get_treatment_percentage_rows()
     df2 = pd.DataFrame([{
         "ID": tp.id,
-        "علاج": tp.treatment.name if tp.treatment else "",
-        "طبيب": tp.doctor.name if tp.doctor else "",
+        "علاج": tp.treatment_name or "",
+        "طبيب": tp.doctor_name or "",
         "نسبة العيادة": tp.clinic_percentage,
         "نسبة الطبيب": tp.doctor_percentage
     } for tp in tps])
@@ -672,30 +374,49 @@ def appointments_page(num_cols):
             d_choice = st.selectbox("اختر طبيب", options=[("", None)] + [(f"{d.id} - {d.name}", d.id) for d in doctors], format_func=lambda x: x[0] if x else "")
             t_choice = st.selectbox("اختر علاج", options=[("", None)] + [(f"{t.id} - {t.name}", t.id) for t in treatments], format_func=lambda x: x[0] if x else "")
             date = st.datetime_input("تاريخ ووقت الموعد", value=datetime.datetime.now() + datetime.timedelta(days=1))
+            duration = st.number_input("المدة بالدقائق (0 = مدة العلاج)", min_value=0, max_value=MAX_DURATION_MINUTES, value=0, step=5)
             notes = st.text_area("ملاحظات")
             if st.form_submit_button("حجز"):
                 if not (p_choice[1] and d_choice[1] and t_choice[1]):
                     st.error("يرجى اختيار مريض وطبيب وعلاج")
                 else:
-                    appt_id = add_appointment(patient_id=p_choice[1], doctor_id=d_choice[1],
-                                              treatment_id=t_choice[1], date=date, status="مجدول", notes=notes)
-                    st.success(f"تم حجز الموعد (ID: {appt_id})")
+                    try:
+                        appt_id = add_appointment(patient_id=p_choice[1], doctor_id=d_choice[1],
+                                                  treatment_id=t_choice[1], date=date, status="مجدول", notes=notes,
+                                                  duration_minutes=int(duration) or None)
+                        st.success(f"تم حجز الموعد (ID: {appt_id})")
+                    except AppointmentConflict as e:
+                        st.error(str(e))
+
+    with st.expander("البحث عن موعد متاح", expanded=False):
+        c1, c2, c3 = st.columns(3)
+        with c1:
+            d_free = st.selectbox("الطبيب", options=[("", None)] + [(f"{d.id} - {d.name}", d.id) for d in doctors], format_func=lambda x: x[0] if x else "", key="free-doctor")
+        with c2:
+            free_duration = st.number_input("المدة (دقيقة)", min_value=5, max_value=MAX_DURATION_MINUTES, value=30, step=5, key="free-duration")
+        with c3:
+            free_days = st.number_input("خلال (أيام)", min_value=1, max_value=90, value=7, key="free-days")
+        if d_free[1]:
+            slots = find_free_slots(d_free[1], int(free_duration), datetime.timedelta(days=int(free_days)))
+            st.dataframe(pd.DataFrame([{"من": s, "إلى": e} for s, e in slots[:50]]), use_container_width=True)
 
     st.markdown("---")
-    appts = get_appointments()
+    search = st.text_input("بحث في المواعيد", key="appointments_search", on_change=reset_pages, args=("appointments",))
+    if search.strip():
+        appts, next_cursor = search_appointments(search, limit=PAGE_SIZE), None
+    else:
+        appts, next_cursor = get_appointments_page(page_cursor("appointments"))
     df = pd.DataFrame([{
         "ID": a.id,
-        "المريض": a.patient.name if a.patient else "",
-        "الطبيب": a.doctor.name if a.doctor else "",
-        "العلاج": a.treatment.name if a.treatment else "",
+        "المريض": a.patient_name or "",
+        "الطبيب": a.doctor_name or "",
+        "العلاج": a.treatment_name or "",
         "تاريخ": a.date,
+        "المدة": a.duration_minutes,
         "الحالة": a.status
     } for a in appts])
-    search = st.text_input("بحث في المواعيد")
-    if search:
-        mask = df.astype(str).apply(lambda col: col.str.contains(search, case=False, na=False)).any(axis=1)
-        df = df[mask]
     st.dataframe(df, use_container_width=True)
+    page_controls("appointments", next_cursor)
 
     st.markdown("### تحرير / حذف موعد")
     ids = [a.id for a in appts]
@@ -709,17 +430,22 @@ def appointments_page(num_cols):
                 d_choice = st.selectbox("الطبيب", options=[(f"{d.id} - {d.name}", d.id) for d in doctors], index=[i for i,d in enumerate(doctors) if d.id==a.doctor_id][0] if doctors else 0)
                 t_choice = st.selectbox("العلاج", options=[(f"{t.id} - {t.name}", t.id) for t in treatments], index=[i for i,t in enumerate(treatments) if t.id==a.treatment_id][0] if treatments else 0)
                 date = st.datetime_input("تاريخ ووقت الموعد", value=a.date or datetime.datetime.now())
+                duration = st.number_input("المدة بالدقائق", min_value=1, max_value=MAX_DURATION_MINUTES, value=a.duration_minutes or 30, step=5)
                 status = st.selectbox("الحالة", ["مجدول", "تم", "ملغي", "مؤجل"], index=0 if a.status is None else ["مجدول", "تم", "ملغي", "مؤجل"].index(a.status) if a.status in ["مجدول","تم","ملغي","مؤجل"] else 0)
                 notes = st.text_area("ملاحظات", value=a.notes or "")
                 c1, c2 = st.columns(2)
                 with c1:
                     if st.form_submit_button("حفظ التعديلات"):
-                        ok = edit_appointment(aid, patient_id=p_choice[1], doctor_id=d_choice[1],
-                                              treatment_id=t_choice[1], date=date, status=status, notes=notes)
-                        if ok:
-                            st.success("تم حفظ التعديلات")
-                        else:
-                            st.error("فشل الحفظ")
+                        try:
+                            ok = edit_appointment(aid, patient_id=p_choice[1], doctor_id=d_choice[1],
+                                                  treatment_id=t_choice[1], date=date, status=status, notes=notes,
+                                                  duration_minutes=int(duration))
+                            if ok:
+                                st.success("تم حفظ التعديلات")
+                            else:
+                                st.error("فشل الحفظ")
+                        except AppointmentConflict as e:
+                            st.error(str(e))
                 with c2:
                     if st.button("حذف الموعد"):
                         ok = delete_appointment(aid)
@@ -730,12 +456,17 @@ def appointments_page(num_cols):
 
 def payments_page(num_cols):
     st.title("الدفعات والفواتير")
-    appts = get_appointments()
-    payments = get_payments()
+    payments, next_cursor = get_payments_page(page_cursor("payments"))
 
     with st.expander("تسجيل دفعة جديدة", expanded=False):
+        # the latest appointments, or the search matches; never the whole table
+        appt_search = st.text_input("بحث عن موعد (المريض أو الطبيب)", key="payment-appointment-search")
+        if appt_search.strip():
+            appts = search_appointments(appt_search, limit=PAGE_SIZE)
+        else:
+            appts = get_appointments_page()[0]
         with st.form("add-payment"):
-            appt_choice = st.selectbox("اختر موعد (اختياري)", options=[("", None)] + [(f"{a.id} - {a.patient.name} - {a.date}", a.id) for a in appts], format_func=lambda x: x[0] if x else "")
+            appt_choice = st.selectbox("اختر موعد (اختياري)", options=[("", None)] + [(f"{a.id} - {a.patient_name or ''} - {a.date}", a.id) for a in appts], format_func=lambda x: x[0] if x else "")
             total_amount = st.number_input("المبلغ الإجمالي", min_value=0.0, value=0.0, step=1.0)
             discounts = st.number_input("الخصم", min_value=0.0, value=0.0)
             taxes = st.number_input("الضرائب", min_value=0.0, value=0.0)
@@ -760,6 +491,7 @@ def payments_page(num_cols):
         "موعد/ID": p.appointment_id
     } for p in payments])
     st.dataframe(df, use_container_width=True)
+    page_controls("payments", next_cursor)
 
     st.markdown("### طباعة فاتورة PDF")
     ids = [p.id for p in payments]
@@ -769,6 +501,19 @@ def payments_page(num_cols):
         buf = generate_invoice_pdf(payment_id=pid)
         st.download_button("تحميل الفاتورة PDF", data=buf, file_name=f"invoice_payment_{pid}.pdf", mime="application/pdf")
 
+    st.markdown("### فواتير مجمعة (ZIP)")
+    c1, c2, c3 = st.columns(3)
+    with c1:
+        inv_start = st.date_input("من تاريخ", value=datetime.date.today().replace(day=1), key="invoices-start")
+    with c2:
+        inv_end = st.date_input("إلى تاريخ", value=datetime.date.today(), key="invoices-end")
+    with c3:
+        d_choice = st.selectbox("الطبيب", options=[("كل الأطباء", None)] + [(f"{d.id} - {d.name}", d.id) for d in get_doctors()],
+                                format_func=lambda x: x[0], key="invoices-doctor")
+    if st.button("تجهيز الفواتير"):
+        submit_export("invoices_zip", start_date=inv_start, end_date=inv_end, doctor_id=d_choice[1])
+    export_jobs(("invoices_zip",))
+
 def expenses_page(num_cols):
     st.title("المصروفات")
     with st.expander("إضافة مصروف", expanded=False):
@@ -805,16 +550,25 @@ def inventory_page(num_cols):
             quantity = st.number_input("الكمية", min_value=0.0, value=0.0)
             unit = st.text_input("الوحدة (مثال: قطعة، علبة)")
             cost_per_unit = st.number_input("تكلفة الوحدة", min_value=0.0, value=0.0)
+            reorder_level = st.number_input("حد إعادة الطلب", min_value=0.0, value=0.0)
             if st.form_submit_button("إضافة"):
                 if not name.strip():
                     st.error("أدخل اسم الصنف")
                 else:
-                    iid = add_inventory_item(name=name.strip(), quantity=float(quantity), unit=unit, cost_per_unit=float(cost_per_unit))
+                    iid = add_inventory_item(name=name.strip(), quantity=float(quantity), unit=unit,
+                                             cost_per_unit=float(cost_per_unit), reorder_level=float(reorder_level))
                     st.success(f"تم إضافة الصنف (ID: {iid})")
 
+    low = get_low_stock_items()
+    if low:
+        st.markdown("### أصناف تحتاج إعادة طلب")
+        st.dataframe(pd.DataFrame([{"ID": r.id, "الاسم": r.name, "الكمية": r.quantity, "حد إعادة الطلب": r.reorder_level,
+                                    "العجز": -r.shortfall, "الوحدة": r.unit} for r in low]), use_container_width=True)
+
     st.markdown("---")
     items = get_inventory_items()
-    df = pd.DataFrame([{"ID": it.id, "الاسم": it.name, "الكمية": it.quantity, "الوحدة": it.unit, "تكلفة الوحدة": it.cost_per_unit} for it in items])
+    df = pd.DataFrame([{"ID": it.id, "الاسم": it.name, "الكمية": it.quantity, "الوحدة": it.unit, "تكلفة الوحدة": it.cost_per_unit,
+                        "حد إعادة الطلب": it.reorder_level} for it in items])
     st.dataframe(df, use_container_width=True)
 
     st.markdown("### تعديل / حذف بند مخزون")
@@ -824,15 +578,21 @@ def inventory_page(num_cols):
         iid = int(sel)
         it = next((x for x in items if x.id == iid), None)
         if it:
+            with st.expander("حركة المخزون", expanded=False):
+                moves = get_stock_movements(iid)
+                st.dataframe(pd.DataFrame([{"التاريخ": m.created_at, "التغير": m.change, "السبب": m.reason,
+                                            "موعد/ID": m.appointment_id} for m in moves]), use_container_width=True)
             with st.form("edit-inv"):
                 name = st.text_input("الاسم", value=it.name)
                 quantity = st.number_input("الكمية", min_value=0.0, value=it.quantity)
                 unit = st.text_input("الوحدة", value=it.unit or "")
                 cost_per_unit = st.number_input("تكلفة الوحدة", min_value=0.0, value=it.cost_per_unit)
+                reorder_level = st.number_input("حد إعادة الطلب", min_value=0.0, value=float(it.reorder_level or 0.0))
                 c1, c2 = st.columns(2)
                 with c1:
                     if st.form_submit_button("حفظ التعديلات"):
-                        ok = edit_inventory_item(iid, name=name, quantity=float(quantity), unit=unit, cost_per_unit=float(cost_per_unit))
+                        ok = edit_inventory_item(iid, name=name, quantity=float(quantity), unit=unit,
+                                                 cost_per_unit=float(cost_per_unit), reorder_level=float(reorder_level))
                         if ok:
                             st.success("تم حفظ التعديلات")
                         else:
@@ -847,67 +607,175 @@ def inventory_page(num_cols):
 
 def reports_page(num_cols):
     st.title("التقارير المالية")
-    payments = get_payments()
-    expenses = get_expenses()
+    c1, c2, c3 = st.columns(3)
+    with c1:
+        start_date = st.date_input("من تاريخ", value=datetime.date.today() - datetime.timedelta(days=365))
+    with c2:
+        end_date = st.date_input("إلى تاريخ", value=datetime.date.today())
+    with c3:
+        period = st.selectbox("التجميع", list(REPORT_PERIODS), format_func=lambda p: {"day": "يومي", "week": "أسبوعي", "month": "شهري"}[p])
 
-    # DataFrames
-    df_pay = pd.DataFrame([{
-        "تاريخ": p.date_paid.date() if p.date_paid else None,
-        "clinic_share": p.clinic_share or 0.0,
-        "doctor_share": p.doctor_share or 0.0,
-        "total": p.total_amount or 0.0
-    } for p in payments])
-
-    df_exp = pd.DataFrame([{
-        "تاريخ": e.date.date() if e.date else None,
-        "amount": e.amount or 0.0
-    } for e in expenses])
+    totals = get_financial_totals(start_date, end_date)
+    df_pay, df_exp = get_financial_series(period, start_date, end_date)
 
     st.markdown("### ملخص عام")
-    total_income = df_pay["total"].sum() if not df_pay.empty else 0.0
-    total_clinic = df_pay["clinic_share"].sum() if not df_pay.empty else 0.0
-    total_doctor = df_pay["doctor_share"].sum() if not df_pay.empty else 0.0
-    total_expenses = df_exp["amount"].sum() if not df_exp.empty else 0.0
-    net_profit = total_clinic - total_expenses
-
-    st.metric("إجمالي الإيرادات", f"{total_income:.2f}")
-    st.metric("حصة العيادة الإجمالية", f"{total_clinic:.2f}")
-    st.metric("حصة الأطباء الإجمالية", f"{total_doctor:.2f}")
-    st.metric("إجمالي المصروفات", f"{total_expenses:.2f}")
-    st.metric("ربح / خسارة صافي (حصة العيادة - المصروفات)", f"{net_profit:.2f}")
+    st.metric("إجمالي الإيرادات", f"{totals['income']:.2f}")
+    st.metric("حصة العيادة الإجمالية", f"{totals['clinic_share']:.2f}")
+    st.metric("حصة الأطباء الإجمالية", f"{totals['doctor_share']:.2f}")
+    st.metric("إجمالي المصروفات", f"{totals['expenses']:.2f}")
+    st.metric("ربح / خسارة صافي (حصة العيادة - المصروفات)", f"{totals['net']:.2f}")
 
     st.markdown("---")
     st.markdown("### رسوم/مصاريف حسب التاريخ")
+    if not (df_pay.empty and df_exp.empty):
+        import plotly.express as px  # heavy; only the reports page with data needs it
     if not df_pay.empty:
-        # aggregate by date
-        df_agg = df_pay.groupby("تاريخ").sum().reset_index().sort_values("تاريخ")
-        fig = px.line(df_agg, x="تاريخ", y=["clinic_share", "doctor_share"], title="حصة العيادة مقابل حصة الأطباء عبر الزمن")
+        fig = px.line(df_pay, x="تاريخ", y=["clinic_share", "doctor_share"], title="حصة العيادة مقابل حصة الأطباء عبر الزمن")
         st.plotly_chart(fig, use_container_width=True)
     else:
         st.info("لا توجد دفعات لعرض المخططات")
 
     if not df_exp.empty:
-        df_e_agg = df_exp.groupby("تاريخ").sum().reset_index().sort_values("تاريخ")
-        fig2 = px.bar(df_e_agg, x="تاريخ", y="amount", title="المصروفات عبر الزمن")
+        fig2 = px.bar(df_exp, x="تاريخ", y="amount", title="المصروفات عبر الزمن")
         st.plotly_chart(fig2, use_container_width=True)
     else:
         st.info("لا توجد مصروفات لعرض المخططات")
 
     st.markdown("---")
     st.markdown("### تقارير قابلة للتحميل")
-    if payments:
-        buf = io.BytesIO()
-        # Build CSV summary
-        df_all = pd.DataFrame([{
-            "date_paid": p.date_paid,
-            "total_amount": p.total_amount,
-            "paid_amount": p.paid_amount,
-            "clinic_share": p.clinic_share,
-            "doctor_share": p.doctor_share
-        } for p in payments])
-        buf.write(df_all.to_csv(index=False).encode("utf-8"))
-        buf.seek(0)
-        st.download_button("تحميل ملخص الدفعات (CSV)", data=buf, file_name="payments_summary.csv", mime="text/csv")
+    doctors = get_doctors()
+    d_choice = st.selectbox("الطبيب", options=[("كل الأطباء", None)] + [(f"{d.id} - {d.name}", d.id) for d in doctors],
+                            format_func=lambda x: x[0], key="export-doctor")
+    # exports run in the background; a repeated request reuses the file until the data changes
+    c1, c2, c3 = st.columns(3)
+    if c1.button("تجهيز ملخص الدفعات (CSV)"):
+        submit_export("payments_csv", start_date=start_date, end_date=end_date, doctor_id=d_choice[1])
+    if c2.button("تجهيز تقرير PDF"):
+        submit_export("report_pdf", start_date=start_date, end_date=end_date)
+    if c3.button("تجهيز تقرير Excel"):
+        submit_export("report_excel", start_date=start_date, end_date=end_date)
+    export_jobs(("payments_csv", "report_pdf", "report_excel"))
+
+def settlements_page(num_cols):
+    st.title("تسويات الأطباء")
+    last_month_end = datetime.date.today().replace(day=1) - datetime.timedelta(days=1)
+    c1, c2 = st.columns(2)
+    with c1:
+        start_date = st.date_input("من تاريخ", value=last_month_end.replace(day=1), key="settle-start")
+    with c2:
+        end_date = st.date_input("إلى تاريخ", value=last_month_end, key="settle-end")
+
+    lines, settlement_id = settlement_for(start_date, end_date)
+    if settlement_id:
+        st.success(f"فترة مقفلة (تسوية رقم {settlement_id}) — الأرقام من لقطة الإقفال")
+    else:
+        st.info("أرقام محسوبة من الدفعات الحالية — الفترة غير مقفلة")
+    st.dataframe(settlement_frame(lines), use_container_width=True)
+    if settlement_id is None and st.button("إقفال الفترة وحفظ التسوية"):
+        try:
+            sid = close_period(start_date, end_date)
+            st.success(f"تم إقفال الفترة (تسوية رقم {sid})")
+        except SettlementError as e:
+            st.error(str(e))
+
+    st.markdown("### كشف حساب طبيب")
+    doctors = get_doctors()
+    if doctors:
+        d_choice = st.selectbox("الطبيب", options=[(f"{d.id} - {d.name}", d.id) for d in doctors],
+                                format_func=lambda x: x[0], key="statement-doctor")
+        if st.button("تجهيز كشف الحساب (PDF)"):
+            submit_export("doctor_statement", doctor_id=d_choice[1], start_date=start_date, end_date=end_date)
+    export_jobs(("doctor_statement",))
+
+    st.markdown("### التسويات المقفلة")
+    df = pd.DataFrame([{
+        "رقم": s.id, "من": s.period_start, "إلى": s.period_end, "تاريخ الإقفال": s.closed_at,
+        "عدد الدفعات": s.payments_count, "مستحقات الأطباء": s.doctor_share
+    } for s in get_settlements()])
+    st.dataframe(df, use_container_width=True)
+
+BRANCH_COLUMNS = {
+    "branch": "الفرع", "income": "الإيرادات", "clinic_share": "حصة العيادة", "doctor_share": "حصة الأطباء",
+    "expenses": "المصروفات", "net": "الصافي", "doctor": "الطبيب", "payments_count": "عدد الدفعات",
+    "status": "الحالة", "count": "عدد المواعيد",
+}
+
+def branches_page(num_cols):
+    st.title("تقارير الفروع المجمعة")
+    c1, c2, c3 = st.columns(3)
+    with c1:
+        start_date = st.date_input("من تاريخ", value=datetime.date.today().replace(day=1), key="branches-start")
+    with c2:
+        end_date = st.date_input("إلى تاريخ", value=datetime.date.today(), key="branches-end")
+    with c3:
+        period = st.selectbox("التجميع", list(REPORT_PERIODS), index=2, key="branches-period",
+                              format_func=lambda p: {"day": "يومي", "week": "أسبوعي", "month": "شهري"}[p])
+
+    # every report runs on all branches at once; a branch that cannot be read is listed, not fatal
+    totals, errors = branches.consolidated_totals(start_date, end_date)
+    doctors, doctor_errors = branches.consolidated_doctor_totals(start_date, end_date)
+    counts, count_errors = branches.consolidated_appointment_counts(start_date, end_date)
+    df_pay, _, series_errors = branches.consolidated_series(period, start_date, end_date)
+    for name, error in {**series_errors, **count_errors, **doctor_errors, **errors}.items():
+        st.error(f"تعذر قراءة فرع {name}: {error}")
+
+    st.markdown("### الملخص حسب الفرع")
+    if not totals.empty:
+        totals = pd.concat([totals, totals.drop(columns="branch").sum().to_frame().T.assign(branch="الإجمالي")],
+                           ignore_index=True)
+    st.dataframe(totals.rename(columns=BRANCH_COLUMNS), use_container_width=True)
+    if not df_pay.empty:
+        import plotly.express as px
+        st.plotly_chart(px.line(df_pay, x="تاريخ", y="total", color="branch", title="الإيرادات حسب الفرع"),
+                        use_container_width=True)
+
+    st.markdown("### حصص الأطباء")
+    st.dataframe(doctors.rename(columns=BRANCH_COLUMNS), use_container_width=True)
+    st.markdown("### المواعيد حسب الحالة")
+    if not counts.empty:
+        counts = (counts.pivot_table(index="branch", columns="status", values="count", aggfunc="sum", fill_value=0,
+                                     sort=False)
+                  .reset_index().rename_axis(columns=None))
+    st.dataframe(counts.rename(columns=BRANCH_COLUMNS), use_container_width=True)
+
+def import_page(num_cols):
+    st.title("استيراد البيانات")
+    kind = st.selectbox("نوع البيانات", list(IMPORT_KINDS),
+                        format_func=lambda k: {"patients": "المرضى", "appointments": "المواعيد", "payments": "الدفعات"}[k])
+    st.caption("الأعمدة المقبولة: " + "، ".join(IMPORT_COLUMNS[kind]))
+    upload = st.file_uploader("ملف CSV أو Excel", type=["csv", "xlsx"])
+    if upload is not None and st.button("بدء الاستيراد"):
+        status = st.empty()
+        result = import_records(kind, upload, filename=upload.name,
+                                progress=lambda n, r: status.info(f"تم إدخال {n} صف، مرفوض {r}"))
+        st.success(f"تم استيراد {result['inserted']} صف")
+        if result["rejected"]:
+            st.warning(f"تم رفض {len(result['rejected'])} صف")
+            df = pd.DataFrame(result["rejected"], columns=["السطر", "السبب"])
+            st.dataframe(df, use_container_width=True)
+            st.download_button("تحميل الصفوف المرفوضة (CSV)", data=df.to_csv(index=False).encode("utf-8"),
+                               file_name=f"rejected_{kind}.csv", mime="text/csv")
+
+def sql_debug_panel(stats):
+    summary = stats.summary(top=10)
+    with st.sidebar:
+        st.markdown("### إحصاءات SQL لهذه الصفحة")
+        c1, c2 = st.columns(2)
+        c1.metric("عدد الاستعلامات", summary["statements"])
+        c2.metric("زمن SQL (ms)", summary["sql_ms"])
+        c1.metric("الصفوف", summary["rows"])
+        c2.metric("تحميل كسول", summary["lazy_loads"])
+        if summary["lazy_load_paths"]:
+            st.warning("تحميل علاقات داخل حلقة: " + ", ".join(f"{p} ×{n}" for p, n in summary["lazy_load_paths"].items()))
+        for sql, n in summary["repeated"].items():
+            st.warning(f"استعلام مكرر ×{n}: {sql}")
+        st.dataframe(pd.DataFrame(summary["slowest"]), use_container_width=True)
+
+def low_stock_alert():
+    """Shortage warning in the sidebar of every page; the count is an index range scan"""
+    count = count_low_stock()
+    if count:
+        st.sidebar.warning(f"⚠️ {count} صنف عند حد إعادة الطلب أو أقل — راجع إدارة المخزون")
 
 # --- Main ---
 def main():
@@ -916,7 +784,7 @@ def main():
     num_cols = determine_num_columns(width)
 
     st.sidebar.title("القائمة")
-    page = st.sidebar.selectbox("القسم", [
+    pages = [
         "إدارة المرضى",
         "إدارة الأطباء",
         "إدارة العلاجات",
@@ -924,27 +792,43 @@ def main():
         "إدارة المخزون",
         "الدفعات",
         "المصروفات",
-        "التقارير"
-    ])
-
-    if page == "إدارة المرضى":
-        patients_page(num_cols)
-    elif page == "إدارة الأطباء":
-        doctors_page(num_cols)
-    elif page == "إدارة العلاجات":
-        treatments_page(num_cols)
-    elif page == "إدارة المواعيد":
-        appointments_page(num_cols)
-    elif page == "إدارة المخزون":
-        inventory_page(num_cols)
-    elif page == "الدفعات":
-        payments_page(num_cols)
-    elif page == "المصروفات":
-        expenses_page(num_cols)
-    elif page == "التقارير":
-        reports_page(num_cols)
-    else:
-        st.write("اختر صفحة من القائمة الجانبية")
+        "التقارير",
+        "تسويات الأطباء",
+        "استيراد البيانات"
+    ]
+    if branches.get_branches():
+        pages.insert(pages.index("تسويات الأطباء") + 1, "تقارير الفروع")
+    page = st.sidebar.selectbox("القسم", pages)
+
+    with sql_profile.capture(page) as sql_stats:
+        low_stock_alert()
+        if page == "إدارة المرضى":
+            patients_page(num_cols)
+        elif page == "إدارة الأطباء":
+            doctors_page(num_cols)
+        elif page == "إدارة العلاجات":
+            treatments_page(num_cols)
+        elif page == "إدارة المواعيد":
+            appointments_page(num_cols)
+        elif page == "إدارة المخزون":
+            inventory_page(num_cols)
+        elif page == "الدفعات":
+            payments_page(num_cols)
+        elif page == "المصروفات":
+            expenses_page(num_cols)
+        elif page == "التقارير":
+            reports_page(num_cols)
+        elif page == "تسويات الأطباء":
+            settlements_page(num_cols)
+        elif page == "تقارير الفروع":
+            branches_page(num_cols)
+        elif page == "استيراد البيانات":
+            import_page(num_cols)
+        else:
+            st.write("اختر صفحة من القائمة الجانبية")
+
+    if sql_stats is not None and st.sidebar.checkbox("إحصاءات SQL", key="sql-debug"):
+        sql_debug_panel(sql_stats)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,200 @@
+# benchmarks/data_layer.py
+"""Time the data functions behind each page against a seeded database.
+
+    python benchmarks/data_layer.py [--db bench.db] [--scale 1.0] [--runs 5]
+                                    [--output results.json] [--compare baseline.json]
+
+The database is generated with benchmarks/synthetic.py when the file does not
+exist yet and reused otherwise. Cached reads are measured cold (their table
+version is bumped before each run). Write benchmarks add rows, so results on a
+reused file drift slightly between invocations. With --compare, any benchmark
+slower than the baseline by more than --threshold exits with status 1.
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def benchmarks():
+    """name -> (setup, fn); setup() runs untimed before each fn() call. fn may return a row count."""
+    from sqlalchemy import func
+
+    import branches
+    import database
+    import models
+    import reports
+    import settlements
+
+    rng = random.Random(7)
+    with database.get_session() as session:
+        max_appt = session.query(func.max(database.Appointment.id)).scalar() or 1
+        last_paid = session.query(func.max(database.Payment.date_paid)).scalar() or datetime.datetime.now()
+    month = (last_paid - datetime.timedelta(days=30), last_paid)
+    year = (last_paid - datetime.timedelta(days=365), last_paid)
+
+    def cold(*tables):
+        return lambda: database.bump_version(*tables)
+
+    def count(rows):
+        return len(rows)
+
+    def shares():
+        for _ in range(1000):
+            database.calculate_shares(rng.randint(1, max_appt), 500.0, 10.0, 0.0)
+        return 1000
+
+    def add_payments_one_by_one():
+        for _ in range(20):
+            database.add_payment(rng.randint(1, max_appt), 300.0, 300.0, "نقدًا")
+        return 20
+
+    def sync_stock_20k():
+        # already in sync, so this measures the scan that decides nothing changed
+        first = max(1, max_appt - 20_000)
+        with database.write_connection() as conn:
+            database.sync_stock(conn, first, max_appt)
+        return max_appt - first + 1
+
+    def csv_export():
+        out = io.StringIO()
+        return database.export_payments_csv(out, *year)
+
+    return {
+        "get_patients": (cold("patients"), lambda: count(database.get_patients())),
+        "get_patients_page": (None, lambda: count(database.get_patients_page()[0])),
+        "search_patients": (None, lambda: count(database.search_patients("محمد الخطيب"))),
+        "get_doctors": (cold("doctors"), lambda: count(database.get_doctors())),
+        "get_appointments": (None, lambda: count(database.get_appointments())),
+        "get_appointment_rows": (None, lambda: count(database.get_appointment_rows())),
+        "get_appointments_page": (None, lambda: count(database.get_appointments_page()[0])),
+        "search_appointments": (None, lambda: count(database.search_appointments("سارة"))),
+        "get_payments": (None, lambda: count(database.get_payments())),
+        "get_payments_page": (None, lambda: count(database.get_payments_page()[0])),
+        "calculate_shares_x1000": (cold("treatment_percentages"), shares),
+        "add_payment_x20": (None, add_payments_one_by_one),
+        "recalculate_shares_dry_run": (None, lambda: count(database.recalculate_shares(dry_run=True))),
+        "financial_totals_year": (None, lambda: database.get_financial_totals(*year) and 1),
+        "financial_series_year_monthly": (None, lambda: count(database.get_financial_series("month", *year)[0])),
+        "generate_report_month": (None, lambda: count(reports.generate_report(*month))),
+        "generate_summary_year": (None, lambda: count(reports.generate_summary(*year, period="month"))),
+        "export_to_pdf_month": (None, lambda: reports.export_to_pdf(reports.generate_report(*month)) and 1),
+        "export_to_excel_month": (None, lambda: reports.export_to_excel(reports.generate_report(*month)) and 1),
+        "export_payments_csv_year": (None, csv_export),
+        "compute_settlement_year": (None, lambda: count(settlements.compute_settlement(*(d.date() for d in year)))),
+        "low_stock_items": (None, lambda: count(database.get_low_stock_items())),
+        "sync_stock_20k": (None, sync_stock_20k),
+        # the same database as four branches: fan-out overhead over one doctor_totals_year
+        "doctor_totals_year": (None, lambda: count(database.get_doctor_totals(*year))),
+        "branches_doctor_totals_year_x4": (None, lambda: count(branches.consolidated_doctor_totals(
+            *year, branches={f"b{i}": models.DB_PATH for i in range(4)})[0])),
+        "find_free_slots_week": (database.reset_schedules,
+                                 lambda: count(database.find_free_slots(1, 45, datetime.timedelta(days=7)))),
+    }
+
+
+def run(names, runs):
+    results = {}
+    for name, (setup, fn) in benchmarks().items():
+        if names and name not in names:
+            continue
+        times, rows = [], None
+        for _ in range(runs):
+            if setup:
+                setup()
+            start = time.perf_counter()
+            rows = fn()
+            times.append(time.perf_counter() - start)
+        results[name] = {
+            "median_ms": round(statistics.median(times) * 1000, 2),
+            "min_ms": round(min(times) * 1000, 2),
+            "rows": rows,
+        }
+        print(f"{name:<32} {results[name]['median_ms']:>10.2f} ms  (min {results[name]['min_ms']:.2f}, rows {rows})",
+              file=sys.stderr)
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print the ratio to the baseline for each benchmark; returns the names over threshold"""
+    regressed = []
+    for name, r in results.items():
+        old = baseline.get("results", {}).get(name)
+        if not old or not old["median_ms"]:
+            continue
+        ratio = r["median_ms"] / old["median_ms"]
+        flag = "REGRESSION" if ratio > threshold else ""
+        print(f"{name:<32} {old['median_ms']:>10.2f} -> {r['median_ms']:>10.2f} ms  x{ratio:.2f} {flag}", file=sys.stderr)
+        if ratio > threshold:
+            regressed.append(name)
+    return regressed
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", help="SQLite file to reuse or create (default: dental_bench_<scale>.db in the temp dir)")
+    parser.add_argument("--scale", type=float, default=1.0, help="volume multiplier when generating the database")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--compare", help="baseline JSON from an earlier --output")
+    parser.add_argument("--threshold", type=float, default=1.25, help="slowdown ratio counted as a regression")
+    parser.add_argument("benchmarks", nargs="*", help="subset of benchmark names (default: all)")
+    args = parser.parse_args(argv)
+
+    args.db = args.db or os.path.join(tempfile.gettempdir(), f"dental_bench_{args.scale:g}.db")
+    os.environ["DENTAL_DB_URL"] = f"sqlite:///{os.path.abspath(args.db)}"
+    sys.path.insert(0, ROOT)
+    volumes = None
+    if not os.path.exists(args.db):
+        import synthetic
+        volumes = synthetic.generate(args.scale, args.seed, log=lambda m: print(m, file=sys.stderr))
+    import models
+    models.init_db()
+    if volumes is None:
+        with models.get_session() as session:
+            volumes = {name: session.query(model).count() for name, model in (
+                ("patients", models.Patient), ("doctors", models.Doctor), ("appointments", models.Appointment),
+                ("payments", models.Payment), ("expenses", models.Expense))}
+
+    results = run(set(args.benchmarks), args.runs)
+    report = {
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "sqlalchemy": __import__("sqlalchemy").__version__,
+        "runs": args.runs,
+        "volumes": volumes,
+        "results": results,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressed = compare(results, json.load(f), args.threshold)
+        if regressed:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
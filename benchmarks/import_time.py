@@ -0,0 +1,117 @@
+# benchmarks/import_time.py
+"""Cold-start import cost per page, measured with `python -X importtime`.
+
+    python benchmarks/import_time.py [--runs 5] [--output import_time.json]
+
+Every page is rendered in a fresh interpreter (Streamlit bare mode) against a
+throwaway database that holds one row per table, so code paths that import
+heavy libraries only when there is something to draw or export are exercised.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SEED = """
+import datetime
+import models, database
+models.init_db()
+p = database.add_patient("مريض")
+d = database.add_doctor("طبيب")
+t = database.add_treatment("علاج", 100.0)
+a = database.add_appointment(p, d, t, datetime.datetime.now())
+database.add_payment(a, 100.0, 100.0, "نقدًا")
+database.add_expense("مصروف", 10.0)
+database.add_inventory_item("صنف", 5.0, "علبة", 2.0)
+"""
+
+# name -> code run after the interpreter starts; "startup" is the app import alone and
+# every page target calls its page function directly, as main() does for the sidebar choice
+TARGETS = {
+    "startup": "import app",
+    "patients_page": "import app; app.patients_page(2)",
+    "doctors_page": "import app; app.doctors_page(2)",
+    "treatments_page": "import app; app.treatments_page(2)",
+    "appointments_page": "import app; app.appointments_page(2)",
+    "inventory_page": "import app; app.inventory_page(2)",
+    "payments_page": "import app; app.payments_page(2)",
+    "expenses_page": "import app; app.expenses_page(2)",
+    "reports_page": "import app; app.reports_page(2)",
+    "settlements_page": "import app; app.settlements_page(2)",
+    "branches_page": "import app; app.branches_page(2)",
+    "import_page": "import app; app.import_page(2)",
+    "invoice_pdf": "import app; app.generate_invoice_pdf(payment_id=1)",
+    "export_to_pdf": "import datetime, reports; reports.export_to_pdf(reports.generate_report(datetime.datetime(2000, 1, 1), datetime.datetime(2100, 1, 1)))",
+    "export_to_excel": "import datetime, reports; reports.export_to_excel(reports.generate_report(datetime.datetime(2000, 1, 1), datetime.datetime(2100, 1, 1)))",
+}
+
+
+def parse_importtime(stderr):
+    """Return [(module, cumulative_us)] for top-level imports in -X importtime output"""
+    top = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|", 2)
+        if not name[1:].startswith(" "):  # nested imports are indented
+            top.append((name.strip(), int(cumulative)))
+    return top
+
+
+def measure(code, env, cwd):
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          env=env, cwd=cwd, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(f"{code!r} failed:\n{proc.stderr[-2000:]}")
+    return wall, parse_importtime(proc.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("targets", nargs="*", choices=[[]] + list(TARGETS), default=[])
+    args = parser.parse_args(argv)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+        # the branches page reports over the seeded database as its only branch
+        env = dict(os.environ, PYTHONPATH=ROOT, DENTAL_DB_URL=url, DENTAL_BRANCHES=f"bench={url}")
+        subprocess.run([sys.executable, "-c", SEED], env=env, cwd=tmp, check=True, capture_output=True)
+        for name in args.targets or TARGETS:
+            walls, totals, modules = [], [], {}
+            for _ in range(args.runs):
+                wall, top = measure(TARGETS[name], env, tmp)
+                walls.append(wall)
+                totals.append(sum(us for _, us in top))
+                for module, us in top:
+                    modules.setdefault(module, []).append(us)
+            heaviest = sorted(modules.items(), key=lambda kv: -statistics.median(kv[1]))[:8]
+            results[name] = {
+                "import_ms": round(statistics.median(totals) / 1000, 1),
+                "wall_ms": round(statistics.median(walls) * 1000, 1),
+                "heaviest_imports_ms": {m: round(statistics.median(us) / 1000, 1) for m, us in heaviest},
+            }
+            print(f"{name:<18} import {results[name]['import_ms']:>8.1f} ms   wall {results[name]['wall_ms']:>8.1f} ms",
+                  file=sys.stderr)
+
+    output = json.dumps({"python": sys.version.split()[0], "runs": args.runs, "results": results},
+                        ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+# benchmarks/synthetic.py
+"""Seed a fresh SQLite database with realistic, reproducible clinic data.
+
+    python benchmarks/synthetic.py bench.db [--scale 1.0] [--seed 1]
+
+Volumes at scale 1: 50k patients, 500k appointments, 400k payments. Patients
+and doctors get Arabic names; treatment popularity, visit frequency and doctor
+load follow skewed distributions so the hot rows look like a real clinic's.
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+VOLUMES = {
+    "patients": 50_000,
+    "doctors": 40,
+    "appointments": 500_000,
+    "payments": 400_000,
+    "expenses": 20_000,
+    "inventory_items": 300,
+}
+CHUNK = 20_000
+
+MALE_NAMES = ["محمد", "أحمد", "علي", "عمر", "خالد", "يوسف", "إبراهيم", "حسن", "حسين", "سعيد",
+              "عبدالله", "عبدالرحمن", "مصطفى", "طارق", "ياسر", "فيصل", "سامي", "ماجد", "نبيل", "كريم"]
+FEMALE_NAMES = ["فاطمة", "عائشة", "مريم", "زينب", "سارة", "نور", "هدى", "ليلى", "رنا", "دعاء",
+                "أسماء", "خديجة", "سلمى", "ريم", "منى", "آمنة", "هالة", "إيمان", "ياسمين", "لمى"]
+FAMILY_NAMES = ["الخطيب", "العلي", "الحسن", "الأحمد", "المصري", "الشامي", "النجار", "الحداد", "السيد",
+                "القحطاني", "العتيبي", "الزهراني", "الشمري", "الدوسري", "البغدادي", "التميمي", "الكردي",
+                "الحلبي", "يوسف", "عثمان", "سليمان", "منصور", "حمدان", "عيسى", "جابر"]
+CITIES = ["الرياض", "جدة", "الدمام", "القاهرة", "الإسكندرية", "عمان", "دمشق", "بغداد", "الدوحة", "دبي"]
+STREETS = ["شارع الملك فهد", "شارع النيل", "شارع الجامعة", "حي النزهة", "حي الروضة", "شارع الاستقلال"]
+HISTORY = ["", "", "", "سكري", "ضغط مرتفع", "حساسية من البنسلين", "ربو", "أمراض القلب", "حامل"]
+SPECIALTIES = ["طب أسنان عام", "تقويم", "جراحة فم", "علاج عصب", "تركيبات", "أطفال", "لثة", "تجميل"]
+# name, base cost, minutes, relative popularity
+TREATMENTS = [
+    ("كشف", 100, 15, 30), ("تنظيف", 200, 30, 25), ("حشو عادي", 300, 30, 22), ("حشو تجميلي", 450, 45, 15),
+    ("خلع", 250, 30, 14), ("خلع جراحي", 800, 60, 5), ("علاج عصب", 1200, 60, 9), ("تاج خزف", 2000, 60, 5),
+    ("جسر", 4500, 90, 2), ("زراعة", 8000, 120, 2), ("تبييض", 1500, 60, 4), ("تقويم - جلسة", 500, 30, 10),
+    ("أشعة", 80, 15, 12), ("فلورايد", 150, 15, 6), ("طقم أسنان", 6000, 90, 1),
+]
+STATUSES_PAST = (["تم", "ملغي", "مؤجل", "مجدول"], [85, 9, 4, 2])
+PAYMENT_METHODS = (["نقدًا", "بطاقة", "تحويل بنكي", "أخرى"], [55, 35, 8, 2])
+EXPENSES = ["إيجار", "رواتب", "كهرباء", "مواد طبية", "صيانة", "تسويق", "إنترنت", "تعقيم"]
+SUPPLIES = ["قفازات", "كمامات", "مخدر موضعي", "مادة حشو", "إبر", "قطن", "خيوط جراحية", "أفلام أشعة"]
+
+
+def _person(rng):
+    female = rng.random() < 0.5
+    first = rng.choice(FEMALE_NAMES if female else MALE_NAMES)
+    return f"{first} {rng.choice(MALE_NAMES)} {rng.choice(FAMILY_NAMES)}", "أنثى" if female else "ذكر"
+
+
+def _skewed_weights(rng, n, alpha=1.2):
+    """Pareto weights: a few rows carry most of the traffic"""
+    return [rng.paretovariate(alpha) for _ in range(n)]
+
+
+def _chunks(rows):
+    for i in range(0, len(rows), CHUNK):
+        yield rows[i:i + CHUNK]
+
+
+def generate(scale=1.0, seed=1, years=3, log=print):
+    """Fill the database DENTAL_DB_URL points at (must be empty); returns the row counts"""
+    from sqlalchemy import DateTime, bindparam, text
+
+    import database
+    import models
+
+    rng = random.Random(seed)
+    counts = {k: max(1, int(v * scale)) for k, v in VOLUMES.items()}
+    models.init_db()
+    started = time.perf_counter()
+
+    def step(name):
+        log(f"{name:<18} {time.perf_counter() - started:7.1f}s")
+
+    patients = []
+    for _ in range(counts["patients"]):
+        name, gender = _person(rng)
+        patients.append({
+            "name": name, "age": rng.randint(3, 85), "gender": gender,
+            "phone": f"05{rng.randrange(10**8):08d}",
+            "address": f"{rng.choice(CITIES)} - {rng.choice(STREETS)}",
+            "medical_history": rng.choice(HISTORY) or None,
+        })
+    doctors = []
+    for _ in range(counts["doctors"]):
+        name, _ = _person(rng)
+        doctors.append({"name": f"د. {name}", "specialty": rng.choice(SPECIALTIES),
+                        "phone": f"05{rng.randrange(10**8):08d}", "email": None})
+    treatments = [{"name": n, "base_cost": float(c), "duration_minutes": m} for n, c, m, _ in TREATMENTS]
+    with models.write_connection() as conn:
+        for chunk in _chunks(patients):
+            models.bulk_insert(conn, models.Patient, chunk)
+        models.bulk_insert(conn, models.Doctor, doctors)
+        models.bulk_insert(conn, models.Treatment, treatments)
+        # ~70% of doctor/treatment pairs have a negotiated split, the rest use the default
+        percentages = []
+        for d in range(1, counts["doctors"] + 1):
+            for t in range(1, len(TREATMENTS) + 1):
+                if rng.random() < 0.7:
+                    doctor = float(rng.choice([30, 35, 40, 45, 50, 60]))
+                    percentages.append({"treatment_id": t, "doctor_id": d,
+                                        "clinic_percentage": 100.0 - doctor, "doctor_percentage": doctor})
+        models.bulk_insert(conn, models.TreatmentPercentage, percentages)
+    step("reference data")
+
+    now = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+    first_day = now - datetime.timedelta(days=365 * years)
+    span_slots = (now - first_day).days * 48  # 15-minute slots, 9:00-21:00 below
+    patient_w = _skewed_weights(rng, counts["patients"])
+    doctor_w = _skewed_weights(rng, counts["doctors"], alpha=3)
+    treatment_w = [w for *_, w in TREATMENTS]
+    appointments, done = [], []
+    patient_ids = rng.choices(range(1, counts["patients"] + 1), patient_w, k=counts["appointments"])
+    doctor_ids = rng.choices(range(1, counts["doctors"] + 1), doctor_w, k=counts["appointments"])
+    treatment_ids = rng.choices(range(1, len(TREATMENTS) + 1), treatment_w, k=counts["appointments"])
+    for i in range(counts["appointments"]):
+        slot = rng.randrange(span_slots + 30 * 48)  # last month is still upcoming
+        day, quarter = divmod(slot, 48)
+        date = datetime.datetime.combine(first_day.date() + datetime.timedelta(days=day),
+                                         datetime.time(9 + quarter // 4, 15 * (quarter % 4)))
+        status = rng.choices(*STATUSES_PAST)[0] if date < now else "مجدول"
+        t = TREATMENTS[treatment_ids[i] - 1]
+        appointments.append({"patient_id": patient_ids[i], "doctor_id": doctor_ids[i],
+                             "treatment_id": treatment_ids[i], "date": date, "duration_minutes": t[2],
+                             "status": status, "notes": None})
+        if status == "تم":
+            done.append((i + 1, date, t[1]))
+    with models.write_connection() as conn:
+        for chunk in _chunks(appointments):
+            models.bulk_insert(conn, models.Appointment, chunk)
+    step("appointments")
+
+    payments = []
+    for _ in range(counts["payments"]):
+        appt_id, date, cost = rng.choice(done) if done else (None, now, 100)
+        total = round(cost * rng.uniform(0.9, 1.2), 2)
+        discount = round(total * rng.choice([0, 0, 0, 0.05, 0.1]), 2)
+        payments.append({"appointment_id": appt_id, "total_amount": total, "discounts": discount, "taxes": 0.0,
+                         "paid_amount": total - discount if rng.random() < 0.9 else round((total - discount) / 2, 2),
+                         "payment_method": rng.choices(*PAYMENT_METHODS)[0],
+                         "date_paid": date + datetime.timedelta(minutes=rng.randint(10, 90))})
+    for chunk in _chunks(payments):
+        database.add_payments(chunk)
+    step("payments")
+
+    expenses = [{"description": rng.choice(EXPENSES), "amount": round(rng.uniform(50, 20000), 2),
+                 "date": first_day + datetime.timedelta(minutes=rng.randrange(365 * years * 24 * 60))}
+                for _ in range(counts["expenses"])]
+    items = [{"name": f"{rng.choice(SUPPLIES)} {i}", "quantity": 0.0,
+              "unit": rng.choice(["علبة", "قطعة", "عبوة"]), "cost_per_unit": round(rng.uniform(1, 300), 2),
+              "reorder_level": float(rng.choice([0, 5, 10, 20, 50]))}
+             for i in range(counts["inventory_items"])]
+    # every treatment uses one to three supplies
+    materials = [{"treatment_id": t, "item_id": item_id, "quantity": float(rng.choice([0.5, 1, 1, 2]))}
+                 for t in range(1, len(TREATMENTS) + 1)
+                 for item_id in rng.sample(range(1, counts["inventory_items"] + 1), min(counts["inventory_items"], rng.randint(1, 3)))]
+    with models.write_connection() as conn:
+        for chunk in _chunks(expenses):
+            conn.execute(models.Expense.__table__.insert(), chunk)
+        conn.execute(models.InventoryItem.__table__.insert(), items)
+        conn.execute(models.TreatmentMaterial.__table__.insert(), materials)
+    for first in range(1, counts["appointments"] + 1, CHUNK):
+        with models.write_connection() as conn:
+            database.sync_stock(conn, first, first + CHUNK - 1)
+    # stock on hand today: an opening balance on top of what the history consumed
+    with models.write_connection() as conn:
+        on_hand = [{"id": i, "target": float(rng.randint(0, 500)), "reason": models.OPENING_BALANCE, "day": first_day}
+                   for i in range(1, counts["inventory_items"] + 1)]
+        conn.execute(text("INSERT INTO stock_movements (item_id, change, reason, created_at) "
+                          "SELECT id, :target - quantity, :reason, :day FROM inventory_items WHERE id = :id")
+                     .bindparams(bindparam("day", type_=DateTime)), on_hand)
+        conn.execute(text("UPDATE inventory_items SET quantity = :target WHERE id = :id"), on_hand)
+    step("expenses/inventory")
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("db", help="SQLite file to create")
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+    if os.path.exists(args.db):
+        parser.error(f"{args.db} already exists")
+    os.environ["DENTAL_DB_URL"] = f"sqlite:///{os.path.abspath(args.db)}"
+    sys.path.insert(0, ROOT)
+    counts = generate(args.scale, args.seed, log=lambda m: print(m, file=sys.stderr))
+    print(counts)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# branches.py
+"""Head-office reports over several branch databases.
+
+Each branch runs its own dental_clinic.db. Given their URLs (DENTAL_BRANCHES,
+"name=url" pairs separated by ";"), every report query runs against all of them
+at once on a thread pool and the results are merged with a branch column.
+SQLite releases the GIL while it executes, so a consolidated report takes about
+as long as the slowest branch rather than the sum of all of them. A branch that
+cannot be read is reported in the errors instead of failing the whole report.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from database import get_appointment_counts, get_doctor_totals, get_financial_series, get_financial_totals
+from models import ENGINE_PROFILE, make_engine
+
+log = logging.getLogger("dental.branches")
+
+BRANCHES_ENV = "DENTAL_BRANCHES"
+BRANCH_WORKERS = 8
+# report reads only: one connection per branch query, a spare for the page. The
+# branch file is opened read-only and its journal mode is left as the branch set it.
+BRANCH_PROFILE = dict(ENGINE_PROFILE, pool_size=2, max_overflow=2, pragmas={
+    name: value for name, value in ENGINE_PROFILE["pragmas"].items() if name in ("busy_timeout", "cache_size", "temp_store")})
+
+_state = {"engines": {}, "pool": None, "lock": threading.Lock()}
+
+def parse_branches(spec):
+    """{name: url} from "name=url;name=url"; a bare URL is named after its file"""
+    branches = {}
+    for part in (spec or "").replace("\n", ";").split(";"):
+        part = part.strip()
+        if not part:
+            continue
+        name, sep, url = part.partition("=")
+        if not sep or "://" in name:
+            name, url = os.path.splitext(os.path.basename(part))[0], part
+        branches[name.strip()] = url.strip()
+    return branches
+
+def get_branches():
+    return parse_branches(os.environ.get(BRANCHES_ENV))
+
+def read_only_url(url):
+    """sqlite:///path as a read-only SQLite URI, so a report can never change a branch file"""
+    prefix = "sqlite:///"
+    if not url.startswith(prefix) or url.startswith(prefix + "file:"):
+        return url
+    path, _, query = url[len(prefix):].partition("?")
+    return f"{prefix}file:{path}?{query + '&' if query else ''}mode=ro&uri=true"
+
+def branch_engine(url):
+    with _state["lock"]:
+        if url not in _state["engines"]:
+            _state["engines"][url] = make_engine(read_only_url(url), BRANCH_PROFILE)
+        return _state["engines"][url]
+
+def _pool():
+    with _state["lock"]:
+        if _state["pool"] is None:
+            _state["pool"] = ThreadPoolExecutor(max_workers=BRANCH_WORKERS, thread_name_prefix="dental-branch")
+        return _state["pool"]
+
+def _run(url, query, args):
+    with branch_engine(url).connect() as conn:
+        return query(*args, conn=conn)
+
+def fan_out(query, *args, branches=None):
+    """Run query(*args, conn=<branch connection>) on every branch concurrently; returns
+    ({name: result}, {name: error message}) in branch order"""
+    branches = get_branches() if branches is None else branches
+    futures = {name: _pool().submit(_run, url, query, args) for name, url in branches.items()}
+    results, errors = {}, {}
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            log.exception("branch %s failed", name)
+            errors[name] = f"{type(e).__name__}: {e}"
+    return results, errors
+
+def _merge(results, columns):
+    """One frame from per-branch frames or row lists, with the branch as first column"""
+    frames = [(rows if isinstance(rows, pd.DataFrame) else pd.DataFrame(rows, columns=columns)).assign(branch=name)
+              for name, rows in results.items()]
+    if not frames:
+        return pd.DataFrame(columns=["branch"] + columns)
+    df = pd.concat(frames, ignore_index=True)
+    return df[["branch"] + columns]
+
+def consolidated_totals(start_date=None, end_date=None, branches=None):
+    """(income, shares, expenses and net per branch, errors)"""
+    results, errors = fan_out(get_financial_totals, start_date, end_date, branches=branches)
+    return _merge({name: [totals] for name, totals in results.items()},
+                  ["income", "clinic_share", "doctor_share", "expenses", "net"]), errors
+
+def consolidated_series(period="month", start_date=None, end_date=None, branches=None):
+    """(payments frame, expenses frame, errors) of get_financial_series per branch"""
+    results, errors = fan_out(get_financial_series, period, start_date, end_date, branches=branches)
+    return (_merge({name: pay for name, (pay, _) in results.items()}, ["تاريخ", "clinic_share", "doctor_share", "total"]),
+            _merge({name: exp for name, (_, exp) in results.items()}, ["تاريخ", "amount"]), errors)
+
+def consolidated_doctor_totals(start_date=None, end_date=None, branches=None):
+    """(payments, income and doctor share per branch and doctor, errors). Doctors are
+    not matched across branches: ids differ between databases."""
+    results, errors = fan_out(get_doctor_totals, start_date, end_date, branches=branches)
+    return _merge(results, ["doctor", "payments_count", "income", "doctor_share"]), errors
+
+def consolidated_appointment_counts(start_date=None, end_date=None, branches=None):
+    """(appointments per branch and status, errors)"""
+    results, errors = fan_out(get_appointment_counts, start_date, end_date, branches=branches)
+    return _merge(results, ["status", "count"]), errors
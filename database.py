@@ -1,27 +1,188 @@
 # database.py
-from models import Session, Patient, Doctor, Treatment, TreatmentPercentage, Appointment, Payment
+import csv
 import datetime
-import os
-
-# --- Patient CRUD ---
-
-def add_patient(name, age, gender, phone, address, medical_history, image=None):
-    session = Session()
-    patient = Patient(name=name, age=age, gender=gender, phone=phone, address=address, medical_history=medical_history)
-    if image:
-        os.makedirs("images", exist_ok=True)
-        image_path = f"images/{name}_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}.png"
-        with open(image_path, 'wb') as f:
-            f.write(image.getvalue())
-        patient.image_path = image_path
-    session.add(patient)
-    session.commit()
-    session.close()
+import functools
+import math
+import threading
+import time
+from contextlib import contextmanager
 
+import pandas as pd
+from sqlalchemy import DateTime, and_, bindparam, or_, func, select, text
+
+import images
+from models import (
+    DEFAULT_DURATION_MINUTES, engine, get_session, write_connection, bulk_insert, fts_query, normalize_arabic,
+    backfill_appointment_durations, suspended_triggers, payment_update_triggers, add_to_daily_summary,
+    bump_data_version, table_versions,
+    Patient, Doctor, Treatment, TreatmentPercentage, Appointment, Payment, Expense, InventoryItem, DailySummary,
+    TreatmentMaterial, StockMovement, OPENING_BALANCE, CONSUMED, RETURNED, ADJUSTED,
+)
+from schedule import DoctorSchedule
+
+# --- Read cache for reference data ---
+# Module state lives for the whole server process, so results are shared by
+# every session. Each result is tagged with the table's persisted data version,
+# which triggers bump on every write from any process (maintenance CLI, imports,
+# job workers), plus a local counter that write functions bump after commit.
+# A read reloads as soon as either has moved. The persisted version is read at
+# most once per VERSION_CHECK_INTERVAL seconds per thread, so a burst of cached
+# reads costs one query; local writes still show up at once through the counter.
+_read_cache = {"versions": {}, "values": {}, "lock": threading.Lock()}
+VERSION_CHECK_INTERVAL = 0.5
+_checked = threading.local()
+
+def data_version(table, conn=None):
+    """(persisted, local) version of table; pass conn to read it on the caller's connection"""
+    seen = _checked.__dict__.setdefault("versions", {})
+    now = time.monotonic()
+    checked_at, persisted = seen.get(table, (None, 0))
+    if checked_at is None or now - checked_at >= VERSION_CHECK_INTERVAL:
+        if conn is None:
+            with engine.connect() as conn:
+                persisted = table_versions(conn, (table,)).get(table, 0)
+        else:
+            persisted = table_versions(conn, (table,)).get(table, 0)
+        seen[table] = (now, persisted)
+    return persisted, _read_cache["versions"].get(table, 0)
+
+def bump_version(*tables):
+    with _read_cache["lock"]:
+        for table in tables:
+            _read_cache["versions"][table] = _read_cache["versions"].get(table, 0) + 1
+
+def cached_read(table, key, loader, conn=None):
+    """Return loader() for key, reusing the stored result while table's version is unchanged"""
+    version = data_version(table, conn)
+    hit = _read_cache["values"].get(key)
+    if hit and hit[0] == version:
+        return hit[1]
+    value = loader()
+    _read_cache["values"][key] = (version, value)
+    return value
+
+def invalidates(*tables):
+    """Decorator for write functions: bump the tables' versions once the write committed"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            result = fn(*args, **kwargs)
+            bump_version(*tables)
+            return result
+        return wrapper
+    return decorate
+
+# --- Images ---
+def save_uploaded_image(image_file):
+    """Store an uploaded streamlit file in the content-addressed image store and return its path"""
+    if image_file is None:
+        return None
+    return images.store_image(image_file.getvalue(), getattr(image_file, "name", None))
+
+def _orphaned_image(session, path):
+    """path if no patient row will point at it once the session's changes are flushed"""
+    session.flush()
+    if path and not session.query(Patient.id).filter(Patient.image_path == path).first():
+        return path
+    return None
+
+def _remove_image(path):
+    """Drop a replaced image; called after commit so a rolled-back edit keeps its file"""
+    if path:
+        images.remove_image(path)
+
+def garbage_collect_images(dry_run=False):
+    """Delete image files no patient references; returns the removed paths"""
+    with get_session() as session:
+        referenced = [p for (p,) in session.query(Patient.image_path).filter(Patient.image_path.isnot(None)).distinct()]
+    return images.collect_garbage(referenced, dry_run=dry_run)
+
+# --- Pagination helpers ---
+PAGE_SIZE = 50
+
+def _keyset_desc(sort_col, id_col, cursor):
+    """Filter for rows after cursor=(value, id) when ordering by sort_col desc, id desc.
+    SQLite sorts NULLs last in descending order, so NULL values come after every date."""
+    value, last_id = cursor
+    if value is None:
+        return and_(sort_col.is_(None), id_col < last_id)
+    return or_(sort_col < value, and_(sort_col == value, id_col < last_id), sort_col.is_(None))
+
+def _split_page(rows, page_size, cursor_of):
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    next_cursor = cursor_of(rows[-1]) if has_more and rows else None
+    return rows, next_cursor
+
+# --- CRUD Functions ---
+# List views read plain rows (named tuples) of the columns they show rather than
+# ORM entities; long text such as medical history and notes is only loaded by
+# the single-row getters the detail forms use.
+PATIENT_LIST_COLUMNS = (Patient.id, Patient.name, Patient.age, Patient.gender, Patient.phone, Patient.address)
+DOCTOR_LIST_COLUMNS = (Doctor.id, Doctor.name, Doctor.specialty, Doctor.phone, Doctor.email)
+APPOINTMENT_LIST_COLUMNS = (Appointment.id, Appointment.patient_id, Appointment.doctor_id, Appointment.treatment_id,
+                            Appointment.date, Appointment.duration_minutes, Appointment.status)
+PAYMENT_LIST_COLUMNS = (Payment.id, Payment.appointment_id, Payment.date_paid, Payment.total_amount,
+                        Payment.discounts, Payment.taxes, Payment.paid_amount, Payment.clinic_share,
+                        Payment.doctor_share, Payment.payment_method)
+
+# Patients
+@invalidates("patients")
+def add_patient(name, age=None, gender=None, phone=None, address=None, medical_history=None, image=None):
+    with get_session(write=True) as session:
+        patient = Patient(
+            name=name,
+            age=age,
+            gender=gender,
+            phone=phone,
+            address=address,
+            medical_history=medical_history
+        )
+        if image:
+            patient.image_path = save_uploaded_image(image)
+        session.add(patient)
+        session.flush()  # to get id
+        return patient.id
+
+def get_patients():
+    return list(cached_read("patients", "patients", _load_patients))
+
+def _load_patients():
+    with get_session() as session:
+        return session.query(*PATIENT_LIST_COLUMNS).order_by(Patient.id).all()
+
+def get_patients_page(after_id=None, page_size=None):
+    """Return (patients, next_cursor) for one page ordered by id (keyset, no OFFSET)"""
+    page_size = page_size or PAGE_SIZE
+    with get_session() as session:
+        q = session.query(*PATIENT_LIST_COLUMNS).order_by(Patient.id)
+        if after_id is not None:
+            q = q.filter(Patient.id > after_id)
+        rows = q.limit(page_size + 1).all()
+    return _split_page(rows, page_size, lambda p: p.id)
+
+def search_patients(query, limit=50):
+    """Patients matching query via the FTS index, best match first"""
+    match = fts_query(query)
+    if not match:
+        return []
+    with get_session() as session:
+        columns = ", ".join(f"patients.{c.key}" for c in PATIENT_LIST_COLUMNS)
+        stmt = text(f"SELECT {columns} FROM patients_fts JOIN patients ON patients.id = patients_fts.rowid "
+                    "WHERE patients_fts MATCH :match ORDER BY bm25(patients_fts) LIMIT :limit")
+        return session.execute(stmt, {"match": match, "limit": limit}).all()
+
+def get_patient(patient_id):
+    with get_session() as session:
+        return session.get(Patient, patient_id)
+
+@invalidates("patients")
 def edit_patient(patient_id, name, age, gender, phone, address, medical_history, image=None):
-    session = Session()
-    patient = session.query(Patient).get(patient_id)
-    if patient:
+    orphan = None
+    with get_session(write=True) as session:
+        patient = session.get(Patient, patient_id)
+        if not patient:
+            return False
         patient.name = name
         patient.age = age
         patient.gender = gender
@@ -29,181 +190,1112 @@ def edit_patient(patient_id, name, age, gender, phone, address, medical_history,
         patient.address = address
         patient.medical_history = medical_history
         if image:
-            os.makedirs("images", exist_ok=True)
-            image_path = f"images/{name}_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}.png"
-            with open(image_path, 'wb') as f:
-                f.write(image.getvalue())
-            patient.image_path = image_path
-        session.commit()
-    session.close()
+            old_path, patient.image_path = patient.image_path, save_uploaded_image(image)
+            if old_path != patient.image_path:
+                orphan = _orphaned_image(session, old_path)
+    _remove_image(orphan)
+    return True
 
+@invalidates("patients")
 def delete_patient(patient_id):
-    session = Session()
-    patient = session.query(Patient).get(patient_id)
-    if patient:
+    with get_session(write=True) as session:
+        patient = session.get(Patient, patient_id)
+        if not patient:
+            return False
         session.delete(patient)
-        session.commit()
-    session.close()
+        orphan = _orphaned_image(session, patient.image_path)
+    _remove_image(orphan)
+    return True
 
-def get_patients():
-    session = Session()
-    patients = session.query(Patient).all()
-    session.close()
-    return patients
+# Doctors
+@invalidates("doctors")
+def add_doctor(name, specialty=None, phone=None, email=None):
+    with get_session(write=True) as session:
+        doc = Doctor(name=name, specialty=specialty, phone=phone, email=email)
+        session.add(doc)
+        session.flush()
+        return doc.id
+
+def get_doctors():
+    return list(cached_read("doctors", "doctors", _load_doctors))
+
+def _load_doctors():
+    with get_session() as session:
+        return session.query(*DOCTOR_LIST_COLUMNS).order_by(Doctor.id).all()
 
-# --- Doctor CRUD ---
+def search_doctors(query, limit=50):
+    """Doctors matching query via the FTS index, best match first"""
+    match = fts_query(query)
+    if not match:
+        return []
+    with get_session() as session:
+        columns = ", ".join(f"doctors.{c.key}" for c in DOCTOR_LIST_COLUMNS)
+        stmt = text(f"SELECT {columns} FROM doctors_fts JOIN doctors ON doctors.id = doctors_fts.rowid "
+                    "WHERE doctors_fts MATCH :match ORDER BY bm25(doctors_fts) LIMIT :limit")
+        return session.execute(stmt, {"match": match, "limit": limit}).all()
 
-def add_doctor(name, specialty, phone, email):
-    session = Session()
-    doctor = Doctor(name=name, specialty=specialty, phone=phone, email=email)
-    session.add(doctor)
-    session.commit()
-    session.close()
+def get_doctor(doctor_id):
+    with get_session() as session:
+        return session.get(Doctor, doctor_id)
 
+@invalidates("doctors")
 def edit_doctor(doctor_id, name, specialty, phone, email):
-    session = Session()
-    doctor = session.query(Doctor).get(doctor_id)
-    if doctor:
-        doctor.name = name
-        doctor.specialty = specialty
-        doctor.phone = phone
-        doctor.email = email
-        session.commit()
-    session.close()
+    with get_session(write=True) as session:
+        doc = session.get(Doctor, doctor_id)
+        if not doc:
+            return False
+        doc.name = name
+        doc.specialty = specialty
+        doc.phone = phone
+        doc.email = email
+        return True
 
+@invalidates("doctors")
 def delete_doctor(doctor_id):
-    session = Session()
-    doctor = session.query(Doctor).get(doctor_id)
-    if doctor:
-        session.delete(doctor)
-        session.commit()
-    session.close()
+    with get_session(write=True) as session:
+        doc = session.get(Doctor, doctor_id)
+        if doc:
+            session.delete(doc)
+            return True
+    return False
 
-def get_doctors():
-    session = Session()
-    doctors = session.query(Doctor).all()
-    session.close()
-    return doctors
-
-# --- Treatment CRUD ---
-
-def add_treatment(name, base_cost):
-    session = Session()
-    treatment = Treatment(name=name, base_cost=base_cost)
-    session.add(treatment)
-    session.commit()
-    session.close()
-
-def edit_treatment(treatment_id, name, base_cost):
-    session = Session()
-    treatment = session.query(Treatment).get(treatment_id)
-    if treatment:
-        treatment.name = name
-        treatment.base_cost = base_cost
-        session.commit()
-    session.close()
+# Treatments
+@invalidates("treatments")
+def add_treatment(name, base_cost, duration_minutes=DEFAULT_DURATION_MINUTES):
+    with get_session(write=True) as session:
+        t = Treatment(name=name, base_cost=base_cost, duration_minutes=duration_minutes)
+        session.add(t)
+        session.flush()
+        return t.id
+
+def get_treatments():
+    return list(cached_read("treatments", "treatments", _load_treatments))
 
+def _load_treatments():
+    with get_session() as session:
+        return session.query(Treatment).order_by(Treatment.id).all()
+
+def get_treatment(treatment_id):
+    with get_session() as session:
+        return session.get(Treatment, treatment_id)
+
+@invalidates("treatments")
+def edit_treatment(treatment_id, name, base_cost, duration_minutes=None):
+    """Existing appointments keep their own duration; None leaves the treatment's unchanged"""
+    with get_session(write=True) as session:
+        t = session.get(Treatment, treatment_id)
+        if not t:
+            return False
+        t.name = name
+        t.base_cost = base_cost
+        if duration_minutes is not None:
+            t.duration_minutes = duration_minutes
+        return True
+
+@invalidates("treatments")
 def delete_treatment(treatment_id):
-    session = Session()
-    treatment = session.query(Treatment).get(treatment_id)
-    if treatment:
-        session.delete(treatment)
-        session.commit()
-    session.close()
+    with get_session(write=True) as session:
+        t = session.get(Treatment, treatment_id)
+        if t:
+            session.query(TreatmentMaterial).filter(TreatmentMaterial.treatment_id == treatment_id).delete()
+            session.delete(t)
+            return True
+    return False
 
-def get_treatments():
-    session = Session()
-    treatments = session.query(Treatment).all()
-    session.close()
-    return treatments
-
-# --- Treatment Percentage CRUD ---
-
-def add_treatment_percentage(treatment_id, doctor_id, clinic_percentage, doctor_percentage):
-    session = Session()
-    perc = TreatmentPercentage(treatment_id=treatment_id, doctor_id=doctor_id,
-                               clinic_percentage=clinic_percentage, doctor_percentage=doctor_percentage)
-    session.add(perc)
-    session.commit()
-    session.close()
-
-# --- Appointment CRUD ---
-
-def add_appointment(patient_id, doctor_id, treatment_id, date, status, notes):
-    session = Session()
-    appointment = Appointment(patient_id=patient_id, doctor_id=doctor_id, treatment_id=treatment_id,
-                              date=date, status=status, notes=notes)
-    session.add(appointment)
-    session.commit()
-    session.close()
-
-def edit_appointment(appointment_id, patient_id, doctor_id, treatment_id, date, status, notes):
-    session = Session()
-    appointment = session.query(Appointment).get(appointment_id)
-    if appointment:
-        appointment.patient_id = patient_id
-        appointment.doctor_id = doctor_id
-        appointment.treatment_id = treatment_id
-        appointment.date = date
-        appointment.status = status
-        appointment.notes = notes
-        session.commit()
-    session.close()
+# Treatment Percentage
+@invalidates("treatment_percentages")
+def set_treatment_percentage(treatment_id, doctor_id, clinic_percentage, doctor_percentage):
+    with get_session(write=True) as session:
+        tp = session.query(TreatmentPercentage).filter_by(treatment_id=treatment_id, doctor_id=doctor_id).first()
+        if not tp:
+            tp = TreatmentPercentage(treatment_id=treatment_id, doctor_id=doctor_id,
+                                     clinic_percentage=clinic_percentage, doctor_percentage=doctor_percentage)
+            session.add(tp)
+        else:
+            tp.clinic_percentage = clinic_percentage
+            tp.doctor_percentage = doctor_percentage
+        return True
 
-def delete_appointment(appointment_id):
-    session = Session()
-    appointment = session.query(Appointment).get(appointment_id)
-    if appointment:
-        session.delete(appointment)
-        session.commit()
-    session.close()
+def get_treatment_percentage_rows():
+    """Percentages joined to treatment and doctor names in a single SELECT"""
+    with get_session() as session:
+        return (session.query(TreatmentPercentage.id,
+                              TreatmentPercentage.treatment_id,
+                              TreatmentPercentage.doctor_id,
+                              TreatmentPercentage.clinic_percentage,
+                              TreatmentPercentage.doctor_percentage,
+                              Treatment.name.label("treatment_name"),
+                              Doctor.name.label("doctor_name"))
+                .outerjoin(Treatment, TreatmentPercentage.treatment_id == Treatment.id)
+                .outerjoin(Doctor, TreatmentPercentage.doctor_id == Doctor.id)
+                .order_by(TreatmentPercentage.id)
+                .all())
+
+# Appointments
+# --- Scheduling ---
+# Cancelled and postponed appointments do not hold their slot
+FREE_STATUSES = ("ملغي", "مؤجل")
+DONE_STATUS = "تم"  # completed: the treatment's materials leave the stock
+MAX_DURATION_MINUTES = 8 * 60
+
+class AppointmentConflict(ValueError):
+    """The doctor already has an appointment overlapping the requested time"""
+
+# Per-doctor interval indexes, loaded on first use and then updated in place by
+# the appointment write functions; dropped after SCHEDULE_TTL seconds to pick up
+# writes from other processes.
+SCHEDULE_TTL = 300
+_schedules = {"doctors": {}, "lock": threading.Lock()}
+
+def _occupies(status):
+    return status not in FREE_STATUSES
+
+def _duration(session, treatment_id, duration_minutes=None):
+    if duration_minutes is None and treatment_id is not None:
+        duration_minutes = session.query(Treatment.duration_minutes).filter(Treatment.id == treatment_id).scalar()
+    duration_minutes = int(duration_minutes or DEFAULT_DURATION_MINUTES)
+    if not 0 < duration_minutes <= MAX_DURATION_MINUTES:
+        raise ValueError(f"مدة الموعد يجب أن تكون بين 1 و {MAX_DURATION_MINUTES} دقيقة")
+    return duration_minutes
+
+def _check_conflict(session, doctor_id, start, duration_minutes, ignore_id=None):
+    """Raise AppointmentConflict if doctor_id is booked within [start, start + duration).
+    Runs inside the write transaction, so it sees every committed booking."""
+    if doctor_id is None or start is None:
+        return
+    end = start + datetime.timedelta(minutes=duration_minutes)
+    q = (session.query(Appointment.id, Appointment.date, Appointment.duration_minutes)
+         .filter(Appointment.doctor_id == doctor_id,
+                 Appointment.date < end,
+                 Appointment.date > start - datetime.timedelta(minutes=MAX_DURATION_MINUTES),
+                 or_(Appointment.status.is_(None), Appointment.status.notin_(FREE_STATUSES))))
+    if ignore_id is not None:
+        q = q.filter(Appointment.id != ignore_id)
+    for appt_id, other_start, other_minutes in q:
+        if other_start + datetime.timedelta(minutes=other_minutes or DEFAULT_DURATION_MINUTES) > start:
+            raise AppointmentConflict(
+                f"الطبيب لديه موعد آخر ({appt_id}) في {other_start:%Y-%m-%d %H:%M}")
+
+def _load_schedule(doctor_id):
+    with get_session() as session:
+        rows = (session.query(Appointment.id, Appointment.date, Appointment.duration_minutes)
+                .filter(Appointment.doctor_id == doctor_id, Appointment.date.isnot(None),
+                        or_(Appointment.status.is_(None), Appointment.status.notin_(FREE_STATUSES)))
+                .all())
+    return DoctorSchedule((appt_id, start, start + datetime.timedelta(minutes=minutes or DEFAULT_DURATION_MINUTES))
+                          for appt_id, start, minutes in rows)
+
+def doctor_schedule(doctor_id):
+    """The doctor's in-memory DoctorSchedule"""
+    with _schedules["lock"]:
+        hit = _schedules["doctors"].get(doctor_id)
+        if hit and time.monotonic() - hit[0] < SCHEDULE_TTL:
+            return hit[1]
+    schedule = _load_schedule(doctor_id)
+    with _schedules["lock"]:
+        _schedules["doctors"][doctor_id] = (time.monotonic(), schedule)
+    return schedule
+
+def _schedule_moved(appt_id, old_doctor_id, doctor_id=None, start=None, duration_minutes=None, status=None):
+    """Apply one committed appointment write to the loaded indexes (unloaded doctors load fresh later)"""
+    with _schedules["lock"]:
+        old = _schedules["doctors"].get(old_doctor_id)
+        if old:
+            old[1].remove(appt_id)
+        new = _schedules["doctors"].get(doctor_id)
+        if new and start is not None and _occupies(status):
+            new[1].add(appt_id, start, start + datetime.timedelta(minutes=duration_minutes))
+
+def reset_schedules():
+    with _schedules["lock"]:
+        _schedules["doctors"].clear()
+
+def find_free_slots(doctor_id, duration, window):
+    """Free (start, end) gaps of at least duration minutes for doctor_id within working hours.
+    window is a (start, end) pair of datetimes or a timedelta counted from now."""
+    if isinstance(window, datetime.timedelta):
+        now = datetime.datetime.now().replace(second=0, microsecond=0)
+        window = (now, now + window)
+    schedule = doctor_schedule(doctor_id)
+    with _schedules["lock"]:
+        # _schedule_moved edits the shared index in place from other sessions
+        return schedule.free_slots(window[0], window[1], datetime.timedelta(minutes=duration))
+
+@invalidates("appointments", "inventory_items")
+def add_appointment(patient_id, doctor_id, treatment_id, date, status="مجدول", notes=None, duration_minutes=None):
+    """Book an appointment; raises AppointmentConflict if the doctor is busy then"""
+    with get_session(write=True) as session:
+        duration_minutes = _duration(session, treatment_id, duration_minutes)
+        if _occupies(status):
+            _check_conflict(session, doctor_id, date, duration_minutes)
+        appt = Appointment(patient_id=patient_id, doctor_id=doctor_id, treatment_id=treatment_id,
+                           date=date, duration_minutes=duration_minutes, status=status, notes=notes)
+        session.add(appt)
+        session.flush()
+        appt_id = appt.id
+        if status == DONE_STATUS:
+            sync_stock(session, appt_id)
+    _schedule_moved(appt_id, None, doctor_id, date, duration_minutes, status)
+    return appt_id
 
 def get_appointments():
-    session = Session()
-    appointments = session.query(Appointment).all()
-    session.close()
-    return appointments
-
-# --- Payment and Shares ---
-
-def calculate_shares(appointment_id, total_amount, discounts=0, taxes=0):
-    session = Session()
-    appointment = session.query(Appointment).get(appointment_id)
-    perc = session.query(TreatmentPercentage).filter_by(
-        treatment_id=appointment.treatment_id,
-        doctor_id=appointment.doctor_id).first()
-    if perc:
-        clinic_perc = perc.clinic_percentage
-        doctor_perc = perc.doctor_percentage
-    else:
-        clinic_perc = 50.0
-        doctor_perc = 50.0
-    net_amount = total_amount - discounts + taxes
-    clinic_share = net_amount * (clinic_perc / 100)
-    doctor_share = net_amount * (doctor_perc / 100)
-    session.close()
+    with get_session() as session:
+        return session.query(*APPOINTMENT_LIST_COLUMNS).order_by(Appointment.date.desc()).all()
+
+def _appointment_rows_query(session):
+    """Appointment columns joined to patient, doctor and treatment names (one SELECT, no lazy loads)"""
+    return (session.query(*APPOINTMENT_LIST_COLUMNS,
+                          Patient.name.label("patient_name"),
+                          Doctor.name.label("doctor_name"),
+                          Treatment.name.label("treatment_name"))
+            .outerjoin(Patient, Appointment.patient_id == Patient.id)
+            .outerjoin(Doctor, Appointment.doctor_id == Doctor.id)
+            .outerjoin(Treatment, Appointment.treatment_id == Treatment.id))
+
+def get_appointment_rows():
+    """All appointments as joined rows, newest first"""
+    with get_session() as session:
+        return _appointment_rows_query(session).order_by(Appointment.date.desc(), Appointment.id.desc()).all()
+
+def search_appointments(query, limit=50):
+    """Joined appointment rows whose patient, doctor, status or notes match query, newest first"""
+    match = fts_query(query)
+    if not match:
+        return []
+    matched = or_(
+        Appointment.id.in_(text("SELECT rowid FROM appointments_fts WHERE appointments_fts MATCH :match")),
+        Appointment.patient_id.in_(text("SELECT rowid FROM patients_fts WHERE patients_fts MATCH :match")),
+        Appointment.doctor_id.in_(text("SELECT rowid FROM doctors_fts WHERE doctors_fts MATCH :match")),
+    )
+    with get_session() as session:
+        return (_appointment_rows_query(session)
+                .filter(matched)
+                .order_by(Appointment.date.desc(), Appointment.id.desc())
+                .limit(limit)
+                .params(match=match)
+                .all())
+
+def get_appointments_page(cursor=None, page_size=None):
+    """Return (rows, next_cursor) of joined appointment rows ordered by date desc;
+    cursor is (date, id) of the last row"""
+    page_size = page_size or PAGE_SIZE
+    with get_session() as session:
+        q = _appointment_rows_query(session).order_by(Appointment.date.desc(), Appointment.id.desc())
+        if cursor is not None:
+            q = q.filter(_keyset_desc(Appointment.date, Appointment.id, cursor))
+        rows = q.limit(page_size + 1).all()
+    return _split_page(rows, page_size, lambda a: (a.date, a.id))
+
+def get_appointment(appointment_id):
+    with get_session() as session:
+        return session.get(Appointment, appointment_id)
+
+@invalidates("appointments", "inventory_items")
+def edit_appointment(appointment_id, patient_id, doctor_id, treatment_id, date, status, notes, duration_minutes=None):
+    """Update an appointment; without duration_minutes it keeps its length unless the treatment changed.
+    Raises AppointmentConflict if the new time overlaps another booking of the doctor."""
+    with get_session(write=True) as session:
+        appt = session.get(Appointment, appointment_id)
+        if not appt:
+            return False
+        if duration_minutes is None and treatment_id == appt.treatment_id:
+            duration_minutes = appt.duration_minutes
+        duration_minutes = _duration(session, treatment_id, duration_minutes)
+        if _occupies(status):
+            _check_conflict(session, doctor_id, date, duration_minutes, ignore_id=appointment_id)
+        old_doctor_id = appt.doctor_id
+        stock_changes = DONE_STATUS in (appt.status, status) and (appt.status, appt.treatment_id) != (status, treatment_id)
+        appt.patient_id = patient_id
+        appt.doctor_id = doctor_id
+        appt.treatment_id = treatment_id
+        appt.date = date
+        appt.duration_minutes = duration_minutes
+        appt.status = status
+        appt.notes = notes
+        if stock_changes:
+            session.flush()
+            sync_stock(session, appointment_id)
+    _schedule_moved(appointment_id, old_doctor_id, doctor_id, date, duration_minutes, status)
+    return True
+
+@invalidates("appointments", "inventory_items")
+def delete_appointment(appointment_id):
+    with get_session(write=True) as session:
+        appt = session.get(Appointment, appointment_id)
+        if not appt:
+            return False
+        session.delete(appt)
+        doctor_id = appt.doctor_id
+        if appt.status == DONE_STATUS:
+            session.flush()
+            sync_stock(session, appointment_id)
+    _schedule_moved(appointment_id, doctor_id)
+    return True
+
+# Payment calculation and CRUD
+DEFAULT_SHARES = (50.0, 50.0)
+
+def _load_share_rates():
+    with get_session() as session:
+        rows = session.query(TreatmentPercentage.treatment_id, TreatmentPercentage.doctor_id,
+                             TreatmentPercentage.clinic_percentage, TreatmentPercentage.doctor_percentage).all()
+    return {(t, d): (clinic or 50.0, doctor or 50.0) for t, d, clinic, doctor in rows}
+
+def get_share_rates(conn=None):
+    """(treatment_id, doctor_id) -> (clinic %, doctor %), cached until set_treatment_percentage runs"""
+    return cached_read("treatment_percentages", "share_rates", _load_share_rates, conn)
+
+def _appointment_share_keys(session, appointment_ids, chunk_size=500):
+    """appointment id -> (treatment_id, doctor_id) for the given ids"""
+    ids = [i for i in set(appointment_ids) if i is not None]
+    keys = {}
+    for start in range(0, len(ids), chunk_size):
+        rows = (session.query(Appointment.id, Appointment.treatment_id, Appointment.doctor_id)
+                .filter(Appointment.id.in_(ids[start:start + chunk_size])).all())
+        keys.update({a_id: (t_id, d_id) for a_id, t_id, d_id in rows})
+    return keys
+
+def _split_shares(rates, share_key, total_amount, discounts=0.0, taxes=0.0):
+    """Shares of one payment; rates is get_share_rates(), fetched once by the caller"""
+    clinic_perc, doctor_perc = rates.get(share_key, DEFAULT_SHARES)
+    net_amount = float(total_amount) - float(discounts or 0.0) + float(taxes or 0.0)
+    clinic_share = round(net_amount * (clinic_perc / 100.0), 2)
+    doctor_share = round(net_amount * (doctor_perc / 100.0), 2)
     return clinic_share, doctor_share
 
+def calculate_shares(appointment_id, total_amount, discounts=0.0, taxes=0.0, session=None):
+    """Clinic and doctor shares of a payment; pass session to reuse the caller's transaction"""
+    if session is None:
+        with get_session() as session:
+            return calculate_shares(appointment_id, total_amount, discounts, taxes, session)
+    share_key = _appointment_share_keys(session, [appointment_id]).get(appointment_id)
+    return _split_shares(get_share_rates(session.connection()), share_key, total_amount, discounts, taxes)
+
+_SHARE_CHANGES_TABLE = (
+    "CREATE TEMP TABLE share_changes (id INTEGER PRIMARY KEY, day TEXT, doctor_id INTEGER, treatment_id INTEGER, "
+    "clinic_share FLOAT, doctor_share FLOAT, clinic_delta FLOAT, doctor_delta FLOAT)"
+)
+
+def _share_changes_sql(conditions):
+    """INSERT into share_changes every payment whose stored shares differ from the current
+    percentages, computed exactly like _split_shares (py_round is Python's round)"""
+    net = "(coalesce(p.total_amount, 0) - coalesce(p.discounts, 0) + coalesce(p.taxes, 0))"
+    rate = "coalesce(nullif(tp.{}_percentage, 0), {}) / 100.0"
+    return ("INSERT INTO share_changes SELECT id, day, doctor_id, treatment_id, clinic_share, doctor_share, "
+            "clinic_share - coalesce(old_clinic, 0), doctor_share - coalesce(old_doctor, 0) FROM ("
+            "SELECT p.id, date(p.date_paid) AS day, a.doctor_id, a.treatment_id, "
+            "p.clinic_share AS old_clinic, p.doctor_share AS old_doctor, "
+            f"py_round({net} * ({rate.format('clinic', DEFAULT_SHARES[0])}), 2) AS clinic_share, "
+            f"py_round({net} * ({rate.format('doctor', DEFAULT_SHARES[1])}), 2) AS doctor_share "
+            "FROM payments p JOIN appointments a ON a.id = p.appointment_id "
+            "LEFT JOIN treatment_percentages tp ON tp.treatment_id = a.treatment_id AND tp.doctor_id = a.doctor_id "
+            f"WHERE {' AND '.join(conditions) or '1'}) "
+            "WHERE old_clinic IS NOT clinic_share OR old_doctor IS NOT doctor_share")
+
+@invalidates("payments")
+def recalculate_shares(treatment_id=None, doctor_id=None, start_date=None, end_date=None, dry_run=False):
+    """Bring stored clinic/doctor shares of appointment payments in line with the current
+    percentages, optionally for one treatment and/or doctor and a date_paid range.
+
+    The stale payments and their new shares are collected by one INSERT ... SELECT into a
+    temp table; unless dry_run, one UPDATE then applies them and the daily rollup gets the
+    summed deltas, with the per-row payment triggers suspended. Returns [{"treatment_id",
+    "doctor_id", "payments", "clinic_delta", "doctor_delta"}] per affected pair.
+    """
+    conditions, params, types = [], {}, []
+    if treatment_id is not None:
+        conditions.append("a.treatment_id = :treatment_id")
+        params["treatment_id"] = treatment_id
+    if doctor_id is not None:
+        conditions.append("a.doctor_id = :doctor_id")
+        params["doctor_id"] = doctor_id
+    if start_date is not None:
+        conditions.append("p.date_paid >= :start")
+        params["start"] = datetime.datetime.combine(_as_date(start_date), datetime.time.min)
+        types.append(bindparam("start", type_=DateTime))
+    if end_date is not None:
+        conditions.append("p.date_paid < :end")
+        params["end"] = datetime.datetime.combine(_as_date(end_date), datetime.time.min) + datetime.timedelta(days=1)
+        types.append(bindparam("end", type_=DateTime))
+    insert = text(_share_changes_sql(conditions)).bindparams(*types)
+    with (engine.connect() if dry_run else write_connection()) as conn:
+        conn.execute(text("DROP TABLE IF EXISTS temp.share_changes"))
+        conn.execute(text(_SHARE_CHANGES_TABLE))
+        conn.execute(insert, params)
+        changes = [dict(row._mapping) for row in conn.execute(text(
+            "SELECT treatment_id, doctor_id, count(*) AS payments, round(sum(clinic_delta), 2) AS clinic_delta, "
+            "round(sum(doctor_delta), 2) AS doctor_delta FROM share_changes GROUP BY 1, 2 ORDER BY 1, 2"))]
+        if changes and not dry_run:
+            with suspended_triggers(conn, payment_update_triggers()):
+                conn.execute(text(
+                    "UPDATE payments SET "
+                    "clinic_share = (SELECT clinic_share FROM share_changes s WHERE s.id = payments.id), "
+                    "doctor_share = (SELECT doctor_share FROM share_changes s WHERE s.id = payments.id) "
+                    "WHERE id IN (SELECT id FROM share_changes)"))
+                add_to_daily_summary(conn, "SELECT day, coalesce(doctor_id, 0), 0, sum(clinic_delta), "
+                                           "sum(doctor_delta), 0, 0, 0, 0, 0 FROM share_changes GROUP BY 1, 2")
+                bump_data_version(conn, "payments")
+        conn.execute(text("DROP TABLE temp.share_changes"))
+    return changes
+
+@invalidates("payments")
 def add_payment(appointment_id, total_amount, paid_amount, payment_method, discounts=0.0, taxes=0.0):
-    session = Session()
-    clinic_share, doctor_share = calculate_shares(appointment_id, total_amount, discounts, taxes)
-    payment = Payment(
-        appointment_id=appointment_id,
-        total_amount=total_amount,
-        paid_amount=paid_amount,
-        clinic_share=clinic_share,
-        doctor_share=doctor_share,
-        payment_method=payment_method,
-        discounts=discounts,
-        taxes=taxes,
-        date_paid=datetime.datetime.now()
-    )
-    session.add(payment)
-    session.commit()
-    session.close()
+    with get_session(write=True) as session:
+        clinic_share, doctor_share = calculate_shares(appointment_id, total_amount, discounts, taxes, session)
+        p = Payment(
+            appointment_id=appointment_id,
+            total_amount=total_amount,
+            paid_amount=paid_amount,
+            clinic_share=clinic_share,
+            doctor_share=doctor_share,
+            payment_method=payment_method,
+            discounts=discounts,
+            taxes=taxes,
+            date_paid=datetime.datetime.now()
+        )
+        session.add(p)
+        session.flush()
+        return p.id
+
+@invalidates("payments")
+def add_payments(rows):
+    """Post many payments in one transaction with a single executemany INSERT.
+    rows are dicts with add_payment's arguments and an optional date_paid;
+    returns the number of payments inserted"""
+    rows = list(rows)
+    now = datetime.datetime.now()
+    with get_session(write=True) as session:
+        rates = get_share_rates(session.connection())
+        share_keys = _appointment_share_keys(session, (r.get("appointment_id") for r in rows))
+        values = []
+        for r in rows:
+            discounts = r.get("discounts") or 0.0
+            taxes = r.get("taxes") or 0.0
+            clinic_share, doctor_share = _split_shares(rates, share_keys.get(r.get("appointment_id")),
+                                                       r["total_amount"], discounts, taxes)
+            values.append({
+                "appointment_id": r.get("appointment_id"),
+                "total_amount": r["total_amount"],
+                "paid_amount": r.get("paid_amount", r["total_amount"]),
+                "clinic_share": clinic_share,
+                "doctor_share": doctor_share,
+                "payment_method": r.get("payment_method"),
+                "discounts": discounts,
+                "taxes": taxes,
+                "date_paid": r.get("date_paid") or now,
+            })
+        if values:
+            session.execute(Payment.__table__.insert(), values)
+    return len(values)
 
 def get_payments():
-    session = Session()
-    payments = session.query(Payment).all()
-    session.close()
-    return payments
+    with get_session() as session:
+        return session.query(*PAYMENT_LIST_COLUMNS).order_by(Payment.date_paid.desc()).all()
+
+def get_payments_page(cursor=None, page_size=None):
+    """Return (payments, next_cursor) ordered by date_paid desc; cursor is (date_paid, id) of the last row"""
+    page_size = page_size or PAGE_SIZE
+    with get_session() as session:
+        q = session.query(*PAYMENT_LIST_COLUMNS).order_by(Payment.date_paid.desc(), Payment.id.desc())
+        if cursor is not None:
+            q = q.filter(_keyset_desc(Payment.date_paid, Payment.id, cursor))
+        rows = q.limit(page_size + 1).all()
+    return _split_page(rows, page_size, lambda p: (p.date_paid, p.id))
+
+def get_invoice_rows(start_date=None, end_date=None, doctor_id=None, payment_ids=None):
+    """Everything a payment invoice prints, as plain dicts from one joined query, oldest first"""
+    with get_session() as session:
+        q = (session.query(Payment.id,
+                           Payment.date_paid,
+                           Payment.total_amount,
+                           Payment.discounts,
+                           Payment.taxes,
+                           Payment.clinic_share,
+                           Payment.doctor_share,
+                           Payment.paid_amount,
+                           Patient.name.label("patient_name"),
+                           Doctor.name.label("doctor_name"),
+                           Treatment.name.label("treatment_name"))
+             .outerjoin(Appointment, Payment.appointment_id == Appointment.id)
+             .outerjoin(Patient, Appointment.patient_id == Patient.id)
+             .outerjoin(Doctor, Appointment.doctor_id == Doctor.id)
+             .outerjoin(Treatment, Appointment.treatment_id == Treatment.id)
+             .filter(*date_range(Payment.date_paid, start_date, end_date)))
+        if doctor_id is not None:
+            q = q.filter(Appointment.doctor_id == doctor_id)
+        if payment_ids is not None:
+            q = q.filter(Payment.id.in_(payment_ids))
+        return [row._asdict() for row in q.order_by(Payment.date_paid, Payment.id)]
+
+def get_appointment_invoice(appointment_id):
+    """Joined appointment row plus notes as a dict, or None"""
+    with get_session() as session:
+        row = (_appointment_rows_query(session).add_columns(Appointment.notes)
+               .filter(Appointment.id == appointment_id).first())
+    return row._asdict() if row else None
+
+# Expenses
+@invalidates("expenses")
+def add_expense(description, amount, date=None):
+    with get_session(write=True) as session:
+        if date is None:
+            date = datetime.datetime.now()
+        e = Expense(description=description, amount=amount, date=date)
+        session.add(e)
+        session.flush()
+        return e.id
+
+def get_expenses():
+    with get_session() as session:
+        return session.query(Expense).order_by(Expense.date.desc()).all()
+
+@invalidates("expenses")
+def delete_expense(expense_id):
+    with get_session(write=True) as session:
+        e = session.get(Expense, expense_id)
+        if e:
+            session.delete(e)
+            return True
+    return False
+
+# Inventory
+@invalidates("inventory_items")
+def add_inventory_item(name, quantity, unit, cost_per_unit, reorder_level=0.0):
+    with get_session(write=True) as session:
+        it = InventoryItem(name=name, quantity=quantity, unit=unit, cost_per_unit=cost_per_unit,
+                           reorder_level=reorder_level)
+        session.add(it)
+        session.flush()
+        if quantity:
+            session.add(StockMovement(item_id=it.id, change=quantity, reason=OPENING_BALANCE,
+                                      created_at=datetime.datetime.now()))
+        return it.id
+
+def get_inventory_items():
+    with get_session() as session:
+        return session.query(InventoryItem).order_by(InventoryItem.id).all()
+
+@invalidates("inventory_items")
+def edit_inventory_item(item_id, name, quantity, unit, cost_per_unit, reorder_level=None):
+    """Update an item; a changed quantity is recorded in the ledger as a manual adjustment"""
+    with get_session(write=True) as session:
+        it = session.get(InventoryItem, item_id)
+        if not it:
+            return False
+        change = (quantity or 0.0) - (it.quantity or 0.0)
+        if abs(change) > 1e-9:
+            session.add(StockMovement(item_id=item_id, change=change, reason=ADJUSTED,
+                                      created_at=datetime.datetime.now()))
+        it.name = name
+        it.quantity = quantity
+        it.unit = unit
+        it.cost_per_unit = cost_per_unit
+        if reorder_level is not None:
+            it.reorder_level = reorder_level
+        return True
+
+@invalidates("inventory_items")
+def delete_inventory_item(item_id):
+    with get_session(write=True) as session:
+        it = session.get(InventoryItem, item_id)
+        if it:
+            session.query(TreatmentMaterial).filter(TreatmentMaterial.item_id == item_id).delete()
+            session.query(StockMovement).filter(StockMovement.item_id == item_id).delete()
+            session.delete(it)
+            return True
+    return False
+
+def _shortfall():
+    # must stay identical to the expression of ix_inventory_items_shortfall
+    return InventoryItem.quantity - InventoryItem.reorder_level
+
+def _low_stock_query(session):
+    return (session.query(InventoryItem.id, InventoryItem.name, InventoryItem.quantity, InventoryItem.reorder_level,
+                          InventoryItem.unit, _shortfall().label("shortfall"))
+            .filter(_shortfall() <= 0)
+            .order_by(_shortfall()))
+
+def get_low_stock_items(limit=None):
+    """Items at or below their reorder level, largest shortfall first; an index range scan"""
+    with get_session() as session:
+        q = _low_stock_query(session)
+        return (q.limit(limit) if limit else q).all()
+
+def count_low_stock():
+    with get_session() as session:
+        return session.query(func.count()).filter(_shortfall() <= 0).scalar()
+
+def get_stock_movements(item_id, limit=100):
+    """The item's latest ledger rows, newest first"""
+    with get_session() as session:
+        return (session.query(StockMovement.id, StockMovement.created_at, StockMovement.change, StockMovement.reason,
+                              StockMovement.appointment_id)
+                .filter(StockMovement.item_id == item_id)
+                .order_by(StockMovement.id.desc()).limit(limit).all())
+
+def check_stock(tolerance=1e-6):
+    """Items whose quantity differs from the sum of their ledger; returns [(id, name, quantity, ledger)]"""
+    with get_session() as session:
+        ledger = (session.query(StockMovement.item_id, func.sum(StockMovement.change).label("total"))
+                  .group_by(StockMovement.item_id).subquery())
+        rows = (session.query(InventoryItem.id, InventoryItem.name, InventoryItem.quantity,
+                              func.coalesce(ledger.c.total, 0.0))
+                .outerjoin(ledger, ledger.c.item_id == InventoryItem.id).all())
+    return [r for r in rows if abs((r[2] or 0.0) - r[3]) > tolerance]
+
+# Bill of materials
+def get_treatment_materials(treatment_id=None):
+    """(treatment_id, item_id, item name, unit, quantity per treatment) rows"""
+    with get_session() as session:
+        q = (session.query(TreatmentMaterial.treatment_id, TreatmentMaterial.item_id, InventoryItem.name,
+                           InventoryItem.unit, TreatmentMaterial.quantity)
+             .join(InventoryItem, TreatmentMaterial.item_id == InventoryItem.id))
+        if treatment_id is not None:
+            q = q.filter(TreatmentMaterial.treatment_id == treatment_id)
+        return q.order_by(TreatmentMaterial.treatment_id, InventoryItem.name).all()
+
+@invalidates("treatment_materials")
+def set_treatment_material(treatment_id, item_id, quantity):
+    """Set how much of an item one treatment uses; a quantity of 0 removes the item.
+    Only appointments completed from now on consume the new amount."""
+    with get_session(write=True) as session:
+        tm = session.query(TreatmentMaterial).filter_by(treatment_id=treatment_id, item_id=item_id).first()
+        if not quantity:
+            if tm:
+                session.delete(tm)
+        elif tm:
+            tm.quantity = quantity
+        else:
+            session.add(TreatmentMaterial(treatment_id=treatment_id, item_id=item_id, quantity=quantity))
+        return True
+
+# Consumption. The ledger records what each appointment used, so syncing a range
+# of appointment ids moves every one of them to its treatment's materials when it
+# is done and to nothing otherwise (cancelled, reopened or deleted), in one
+# INSERT ... SELECT into the ledger and one UPDATE of the items it touched.
+_STOCK_SYNC_SQL = """
+INSERT INTO stock_movements (item_id, change, reason, appointment_id, created_at)
+SELECT item_id, sum(delta), CASE WHEN sum(delta) < 0 THEN :consumed ELSE :returned END, appointment_id, :now
+FROM (
+    SELECT a.id AS appointment_id, m.item_id AS item_id, -m.quantity AS delta
+    FROM appointments a JOIN treatment_materials m ON m.treatment_id = a.treatment_id
+    WHERE a.id BETWEEN :first AND :last AND a.status = :done
+    UNION ALL
+    SELECT appointment_id, item_id, -change FROM stock_movements WHERE appointment_id BETWEEN :first AND :last
+)
+GROUP BY appointment_id, item_id
+HAVING abs(sum(delta)) > 1e-9
+"""
+
+_APPLY_MOVEMENTS_SQL = """
+UPDATE inventory_items SET quantity = coalesce(quantity, 0.0) +
+    (SELECT sum(change) FROM stock_movements s WHERE s.item_id = inventory_items.id AND s.id > :after)
+WHERE id IN (SELECT item_id FROM stock_movements WHERE id > :after)
+"""
+
+def sync_stock(conn, first_id, last_id=None):
+    """Consume or return materials for appointments first_id..last_id (a Session or
+    Connection inside a write transaction); returns the number of ledger rows written"""
+    last_id = first_id if last_id is None else last_id
+    after = conn.execute(text("SELECT coalesce(max(id), 0) FROM stock_movements")).scalar()
+    written = conn.execute(text(_STOCK_SYNC_SQL).bindparams(bindparam("now", type_=DateTime)), {
+        "first": first_id, "last": last_id, "done": DONE_STATUS, "consumed": CONSUMED, "returned": RETURNED,
+        "now": datetime.datetime.now()}).rowcount
+    if written:
+        conn.execute(text(_APPLY_MOVEMENTS_SQL), {"after": after})
+    return written
+
+# --- Report aggregation ---
+REPORT_PERIODS = {"day": "%Y-%m-%d", "week": "%Y-W%W", "month": "%Y-%m"}
+
+def _as_date(d):
+    return d.date() if isinstance(d, datetime.datetime) else d
+
+def date_range(col, start_date=None, end_date=None):
+    """Conditions for start_date <= col < end_date + 1 day on a DateTime column (inclusive days)"""
+    conds = []
+    if start_date is not None:
+        conds.append(col >= datetime.datetime.combine(_as_date(start_date), datetime.time.min))
+    if end_date is not None:
+        conds.append(col < datetime.datetime.combine(_as_date(end_date), datetime.time.min) + datetime.timedelta(days=1))
+    return conds
+
+def _day_range(col, start_date=None, end_date=None):
+    """Conditions for start_date <= col <= end_date on a Date column (both bounds optional)"""
+    conds = []
+    if start_date is not None:
+        conds.append(col >= _as_date(start_date))
+    if end_date is not None:
+        conds.append(col <= _as_date(end_date))
+    return conds
+
+@contextmanager
+def _reading(conn=None):
+    """conn itself (another clinic's database, say), or a connection to this one"""
+    if conn is not None:
+        yield conn
+    else:
+        with engine.connect() as own:
+            yield own
+
+def get_financial_totals(start_date=None, end_date=None, conn=None):
+    """Headline totals for the period, summed over the daily rollup"""
+    with _reading(conn) as conn:
+        income, clinic, doctor, expenses = conn.execute(select(
+            func.coalesce(func.sum(DailySummary.income), 0.0),
+            func.coalesce(func.sum(DailySummary.clinic_share), 0.0),
+            func.coalesce(func.sum(DailySummary.doctor_share), 0.0),
+            func.coalesce(func.sum(DailySummary.expenses), 0.0),
+        ).where(*_day_range(DailySummary.day, start_date, end_date))).one()
+    return {
+        "income": income,
+        "clinic_share": clinic,
+        "doctor_share": doctor,
+        "expenses": expenses,
+        "net": clinic - expenses,
+    }
+
+def get_financial_series(period="day", start_date=None, end_date=None, conn=None):
+    """Return (payments_df, expenses_df) summed per day/week/month bucket from the daily rollup"""
+    bucket = func.strftime(REPORT_PERIODS[period], DailySummary.day)
+    with _reading(conn) as conn:
+        rows = conn.execute(select(bucket,
+                                   func.sum(DailySummary.clinic_share),
+                                   func.sum(DailySummary.doctor_share),
+                                   func.sum(DailySummary.income),
+                                   func.sum(DailySummary.payments_count),
+                                   func.sum(DailySummary.expenses))
+                            .where(*_day_range(DailySummary.day, start_date, end_date))
+                            .group_by(bucket)
+                            .order_by(bucket)).all()
+    df = pd.DataFrame(rows, columns=["تاريخ", "clinic_share", "doctor_share", "total", "count", "amount"])
+    df_pay = df[df["count"] > 0][["تاريخ", "clinic_share", "doctor_share", "total"]]
+    df_exp = df[df["amount"] != 0][["تاريخ", "amount"]]
+    return df_pay.reset_index(drop=True), df_exp.reset_index(drop=True)
+
+def get_doctor_totals(start_date=None, end_date=None, conn=None):
+    """(doctor name, payments, income, doctor share) per doctor paid in the period, from the daily rollup"""
+    with _reading(conn) as conn:
+        # doctor_id 0 holds expenses and payments without an appointment
+        return conn.execute(
+            select(Doctor.name, func.sum(DailySummary.payments_count), func.sum(DailySummary.income),
+                   func.sum(DailySummary.doctor_share))
+            .join(Doctor, Doctor.id == DailySummary.doctor_id)
+            .where(DailySummary.doctor_id != 0, *_day_range(DailySummary.day, start_date, end_date))
+            .group_by(DailySummary.doctor_id)
+            .having(func.sum(DailySummary.payments_count) > 0)
+            .order_by(Doctor.name)).all()
+
+def get_appointment_counts(start_date=None, end_date=None, conn=None):
+    """(status, count) of the appointments dated in the period"""
+    with _reading(conn) as conn:
+        return conn.execute(
+            select(Appointment.status, func.count())
+            .where(*date_range(Appointment.date, start_date, end_date))
+            .group_by(Appointment.status)
+            .order_by(Appointment.status)).all()
+
+# --- Exports ---
+EXPORT_CHUNK_SIZE = 5000
+PAYMENT_EXPORT_COLUMNS = ["id", "date_paid", "doctor", "total_amount", "discounts", "taxes",
+                          "paid_amount", "clinic_share", "doctor_share", "payment_method"]
+
+def export_payments_csv(out, start_date=None, end_date=None, doctor_id=None, chunk_size=EXPORT_CHUNK_SIZE,
+                        progress=None):
+    """Write payments as CSV to the text file object out, streaming chunk_size rows at a
+    time from the cursor so memory stays flat however long the ledger is; returns the row count.
+    progress(rows written, None) is called after each chunk."""
+    stmt = (select(Payment.id, Payment.date_paid, Doctor.name, Payment.total_amount, Payment.discounts,
+                   Payment.taxes, Payment.paid_amount, Payment.clinic_share, Payment.doctor_share,
+                   Payment.payment_method)
+            .outerjoin(Appointment, Payment.appointment_id == Appointment.id)
+            .outerjoin(Doctor, Appointment.doctor_id == Doctor.id)
+            .where(*date_range(Payment.date_paid, start_date, end_date))
+            .order_by(Payment.date_paid, Payment.id))
+    if doctor_id is not None:
+        stmt = stmt.where(Appointment.doctor_id == doctor_id)
+    writer = csv.writer(out)
+    writer.writerow(PAYMENT_EXPORT_COLUMNS)
+    count = 0
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(stmt)
+        for rows in result.partitions(chunk_size):
+            writer.writerows(rows)
+            count += len(rows)
+            if progress:
+                progress(count, None)
+    return count
+
+# --- Query plan checks ---
+def _plan_check_statements():
+    """(name, statement, index the plan must use) for the queries behind the pages"""
+    day = datetime.datetime(2024, 1, 1)
+    with get_session() as session:
+        return [
+            ("appointments_page",
+             _appointment_rows_query(session).order_by(Appointment.date.desc(), Appointment.id.desc()).limit(PAGE_SIZE).statement,
+             "ix_appointments_date"),
+            ("payments_page",
+             session.query(Payment).order_by(Payment.date_paid.desc(), Payment.id.desc()).limit(PAGE_SIZE).statement,
+             "ix_payments_date_paid"),
+            ("payments_in_range",
+             session.query(Payment.id, Payment.total_amount).filter(
+                 Payment.date_paid.between(day, day + datetime.timedelta(days=30))).statement,
+             "ix_payments_date_paid"),
+            ("share_rate_lookup",
+             session.query(TreatmentPercentage).filter_by(treatment_id=1, doctor_id=1).statement,
+             "ux_treatment_percentages_pair"),
+            ("appointment_payments",
+             session.query(Payment.id).filter(Payment.appointment_id == 1).statement,
+             "ix_payments_appointment_id"),
+            ("patient_appointments",
+             session.query(Appointment.id).filter(Appointment.patient_id == 1).statement,
+             "ix_appointments_patient_id"),
+            ("doctor_schedule",
+             session.query(Appointment.id, Appointment.date).filter(
+                 Appointment.doctor_id == 1, Appointment.date >= day).order_by(Appointment.date).statement,
+             "ix_appointments_doctor_date"),
+            ("appointment_conflict",
+             session.query(Appointment.id, Appointment.date, Appointment.duration_minutes).filter(
+                 Appointment.doctor_id == 1, Appointment.date < day,
+                 Appointment.date > day - datetime.timedelta(minutes=MAX_DURATION_MINUTES)).statement,
+             "ix_appointments_doctor_date"),
+            ("low_stock", _low_stock_query(session).statement, "ix_inventory_items_shortfall"),
+            ("stock_ledger",
+             session.query(StockMovement.id).filter(StockMovement.item_id == 1)
+             .order_by(StockMovement.id.desc()).limit(100).statement,
+             "ix_stock_movements_item_id"),
+        ]
+
+def explain_query_plans():
+    """Run EXPLAIN QUERY PLAN for each page query; returns [(name, expected index, plan lines, ok)]"""
+    results = []
+    with engine.connect() as conn:
+        for name, stmt, index in _plan_check_statements():
+            compiled = stmt.compile(dialect=engine.dialect)
+            params = compiled.construct_params()
+            values = tuple(params[k].isoformat(" ") if isinstance(params[k], datetime.datetime) else params[k]
+                           for k in compiled.positiontup)
+            plan = [row[-1] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}", values)]
+            results.append((name, index, plan, any(index in line for line in plan)))
+    return results
+
+# --- Bulk import ---
+IMPORT_CHUNK_SIZE = 5000
+
+# accepted header -> field, per import kind (English names or the UI's Arabic labels)
+IMPORT_COLUMNS = {
+    "patients": {
+        "name": "name", "الاسم": "name",
+        "age": "age", "العمر": "age",
+        "gender": "gender", "الجنس": "gender",
+        "phone": "phone", "الهاتف": "phone",
+        "address": "address", "العنوان": "address",
+        "medical_history": "medical_history", "التاريخ الطبي": "medical_history",
+    },
+    "appointments": {
+        "patient_id": "patient_id", "patient": "patient", "المريض": "patient",
+        "doctor_id": "doctor_id", "doctor": "doctor", "الطبيب": "doctor",
+        "treatment_id": "treatment_id", "treatment": "treatment", "العلاج": "treatment",
+        "date": "date", "تاريخ": "date",
+        "duration_minutes": "duration_minutes", "المدة": "duration_minutes",
+        "status": "status", "الحالة": "status",
+        "notes": "notes", "ملاحظات": "notes",
+    },
+    "payments": {
+        "appointment_id": "appointment_id", "موعد/ID": "appointment_id",
+        "total_amount": "total_amount", "المبلغ الإجمالي": "total_amount",
+        "paid_amount": "paid_amount", "المدفوع": "paid_amount",
+        "payment_method": "payment_method", "طريقة الدفع": "payment_method",
+        "discounts": "discounts", "الخصم": "discounts",
+        "taxes": "taxes", "الضرائب": "taxes",
+        "date_paid": "date_paid", "تاريخ الدفع": "date_paid",
+    },
+}
+
+def read_import_chunks(file, filename=None, chunk_size=IMPORT_CHUNK_SIZE):
+    """Yield DataFrames of at most chunk_size rows (all values as strings) from a CSV or XLSX file"""
+    filename = filename or getattr(file, "name", "") or str(file)
+    if filename.lower().endswith((".xlsx", ".xlsm")):
+        from openpyxl import load_workbook
+        wb = load_workbook(file, read_only=True, data_only=True)
+        rows = wb.active.iter_rows(values_only=True)
+        header = [str(h).strip() if h is not None else "" for h in next(rows, [])]
+        batch = []
+        for row in rows:
+            batch.append(["" if v is None else str(v) for v in row])
+            if len(batch) >= chunk_size:
+                yield pd.DataFrame(batch, columns=header)
+                batch = []
+        if batch:
+            yield pd.DataFrame(batch, columns=header)
+        wb.close()
+    else:
+        for chunk in pd.read_csv(file, chunksize=chunk_size, dtype=str, keep_default_na=False, encoding="utf-8-sig"):
+            chunk.columns = [str(c).strip() for c in chunk.columns]
+            yield chunk
+
+def _clean(value):
+    value = (value or "").strip()
+    return value or None
+
+def _parse_number(value, field, cast=float, required=False):
+    value = _clean(value)
+    if value is None:
+        if required:
+            raise ValueError(f"{field}: قيمة مطلوبة")
+        return None
+    try:
+        number = float(value)
+        if not math.isfinite(number):  # inf/nan would reach the rollup sums
+            raise ValueError(value)
+        if cast is int and not number.is_integer():  # 2.5 must not become 2
+            raise ValueError(value)
+        number = cast(number) if cast is int else cast(value)
+    except (ValueError, OverflowError):
+        raise ValueError(f"{field}: رقم غير صالح ({value})") from None
+    if number < 0:
+        raise ValueError(f"{field}: لا يمكن أن يكون سالبًا")
+    return number
+
+def _parse_datetime(value, field, required=False):
+    value = _clean(value)
+    if value is None:
+        if required:
+            raise ValueError(f"{field}: قيمة مطلوبة")
+        return None
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        parsed = pd.to_datetime(value, errors="coerce", dayfirst=True)
+        if pd.isna(parsed):
+            raise ValueError(f"{field}: تاريخ غير صالح ({value})")
+        return parsed.to_pydatetime()
+
+def _build_lookup(model):
+    """normalized name -> id, with None for names shared by several rows"""
+    lookup = {}
+    with get_session() as session:
+        for row_id, name in session.query(model.id, model.name):
+            key = normalize_arabic(name).strip()
+            lookup[key] = None if key in lookup else row_id
+    return lookup
+
+def _resolve(rec, lookups, field):
+    """Id for a referenced row given either <field>_id or <field> (name)"""
+    ids, names = lookups[field]
+    raw_id = _clean(rec.get(f"{field}_id"))
+    if raw_id is not None:
+        row_id = _parse_number(raw_id, f"{field}_id", int)
+        if row_id not in ids:
+            raise ValueError(f"{field}_id: غير موجود ({row_id})")
+        return row_id
+    name = _clean(rec.get(field))
+    if name is None:
+        raise ValueError(f"{field}: قيمة مطلوبة")
+    key = normalize_arabic(name)
+    if key not in names:
+        raise ValueError(f"{field}: غير موجود ({name})")
+    if names[key] is None:
+        raise ValueError(f"{field}: الاسم مكرر، استخدم {field}_id ({name})")
+    return names[key]
+
+def _validate_patient(rec, lookups):
+    name = _clean(rec.get("name"))
+    if name is None:
+        raise ValueError("name: قيمة مطلوبة")
+    return {
+        "name": name,
+        "age": _parse_number(rec.get("age"), "age", int),
+        "gender": _clean(rec.get("gender")),
+        "phone": _clean(rec.get("phone")),
+        "address": _clean(rec.get("address")),
+        "medical_history": _clean(rec.get("medical_history")),
+    }
+
+def _validate_appointment(rec, lookups):
+    return {
+        "patient_id": _resolve(rec, lookups, "patient"),
+        "doctor_id": _resolve(rec, lookups, "doctor"),
+        "treatment_id": _resolve(rec, lookups, "treatment"),
+        "date": _parse_datetime(rec.get("date"), "date", required=True),
+        "duration_minutes": _parse_number(rec.get("duration_minutes"), "duration_minutes", int),
+        "status": _clean(rec.get("status")) or "مجدول",
+        "notes": _clean(rec.get("notes")),
+    }
+
+def _validate_payment(rec, lookups):
+    appointment_id = _parse_number(rec.get("appointment_id"), "appointment_id", int)
+    if appointment_id is not None and appointment_id not in lookups["appointment"]:
+        raise ValueError(f"appointment_id: غير موجود ({appointment_id})")
+    total_amount = _parse_number(rec.get("total_amount"), "total_amount", required=True)
+    paid_amount = _parse_number(rec.get("paid_amount"), "paid_amount")
+    return {
+        "appointment_id": appointment_id,
+        "total_amount": total_amount,
+        "paid_amount": total_amount if paid_amount is None else paid_amount,
+        "payment_method": _clean(rec.get("payment_method")),
+        "discounts": _parse_number(rec.get("discounts"), "discounts") or 0.0,
+        "taxes": _parse_number(rec.get("taxes"), "taxes") or 0.0,
+        "date_paid": _parse_datetime(rec.get("date_paid"), "date_paid"),
+    }
+
+def _import_lookups(kind):
+    """Prebuilt id sets and name -> id dicts so rows never hit the database one by one"""
+    if kind == "appointments":
+        lookups = {}
+        for field, model in (("patient", Patient), ("doctor", Doctor), ("treatment", Treatment)):
+            with get_session() as session:
+                ids = {i for (i,) in session.query(model.id)}
+            lookups[field] = (ids, _build_lookup(model))
+        return lookups
+    if kind == "payments":
+        with get_session() as session:
+            return {"appointment": {i for (i,) in session.query(Appointment.id)}}
+    return {}
+
+IMPORT_KINDS = {
+    "patients": (Patient, _validate_patient),
+    "appointments": (Appointment, _validate_appointment),
+    "payments": (Payment, _validate_payment),
+}
+
+def import_records(kind, file, filename=None, chunk_size=IMPORT_CHUNK_SIZE, progress=None):
+    """Validate and bulk insert rows of a CSV/XLSX file, one transaction per chunk.
+    Returns {"inserted": n, "rejected": [(line, reason), ...]} where line is the
+    spreadsheet line number (header is line 1)"""
+    model, validate = IMPORT_KINDS[kind]
+    columns = IMPORT_COLUMNS[kind]
+    lookups = _import_lookups(kind)
+    inserted, rejected, line = 0, [], 1
+    for chunk in read_import_chunks(file, filename, chunk_size):
+        fields = [columns.get(c, columns.get(c.lower())) for c in chunk.columns]
+        values = []
+        for raw in chunk.itertuples(index=False, name=None):
+            line += 1
+            rec = {f: v for f, v in zip(fields, raw) if f}
+            try:
+                values.append(validate(rec, lookups))
+            except ValueError as e:
+                rejected.append((line, str(e)))
+        if values:
+            if kind == "payments":
+                add_payments(values)
+            else:
+                with write_connection() as conn:
+                    first_id = conn.execute(text(f"SELECT coalesce(max(id), 0) + 1 FROM {model.__tablename__}")).scalar()
+                    bulk_insert(conn, model, values)
+                    if kind == "appointments":
+                        backfill_appointment_durations(conn)
+                        # completed history consumes its materials, one batch per chunk
+                        sync_stock(conn, first_id, first_id + len(values) - 1)
+            inserted += len(values)
+        if progress:
+            progress(inserted, len(rejected))
+    bump_version(model.__tablename__)
+    if kind == "appointments":
+        bump_version("inventory_items")
+        # imported history is not conflict-checked; reload the interval indexes from the table
+        reset_schedules()
+    return {"inserted": inserted, "rejected": rejected}
+
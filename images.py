@@ -0,0 +1,93 @@
+# images.py
+import hashlib
+import io
+import os
+import tempfile
+import time
+
+IMAGE_DIR = os.environ.get("DENTAL_IMAGE_DIR", "images")
+THUMBNAIL_SIZE = (256, 256)
+GC_MIN_AGE = 3600  # seconds; newer files may belong to an upload whose row is not committed yet
+
+def _sharded(kind, digest, ext):
+    return os.path.join(IMAGE_DIR, kind, digest[:2], f"{digest}{ext}")
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def _extension(data, filename=None):
+    from PIL import Image
+
+    try:
+        with Image.open(io.BytesIO(data)) as im:
+            return "." + (im.format or "png").lower().replace("jpeg", "jpg")
+    except (OSError, ValueError):
+        ext = os.path.splitext(filename or "")[1].lower()
+        return ext or ".bin"
+
+def thumbnail_path(path):
+    """Thumbnail location for a stored original (or any legacy image path)"""
+    path = os.path.normpath(path)
+    digest = os.path.splitext(os.path.basename(path))[0]
+    if os.path.dirname(os.path.dirname(path)) != os.path.normpath(os.path.join(IMAGE_DIR, "originals")):
+        digest = hashlib.sha256(path.encode("utf-8")).hexdigest()
+    return _sharded("thumbs", digest, ".jpg")
+
+def make_thumbnail(path, data=None):
+    """Write the downscaled JPEG for path unless it exists; returns its path or None if unreadable"""
+    from PIL import Image
+
+    thumb = thumbnail_path(path)
+    if os.path.exists(thumb):
+        return thumb
+    try:
+        with Image.open(io.BytesIO(data) if data is not None else path) as im:
+            im.thumbnail(THUMBNAIL_SIZE)
+            out = io.BytesIO()
+            im.convert("RGB").save(out, "JPEG", quality=80, optimize=True)
+    except (OSError, ValueError):
+        return None
+    _write_atomic(thumb, out.getvalue())
+    return thumb
+
+def store_image(data, filename=None):
+    """Store bytes under originals/<sha256[:2]>/<sha256><ext>, once per distinct content,
+    with its thumbnail made at the same time; returns the original's path"""
+    digest = hashlib.sha256(data).hexdigest()
+    path = _sharded("originals", digest, _extension(data, filename))
+    if not os.path.exists(path):
+        _write_atomic(path, data)
+    make_thumbnail(path, data)
+    return path
+
+def remove_image(path):
+    """Delete an original and its thumbnail (missing files are ignored)"""
+    for p in (path, thumbnail_path(path)):
+        try:
+            os.remove(p)
+        except FileNotFoundError:
+            pass
+
+def collect_garbage(referenced, dry_run=False, min_age=GC_MIN_AGE):
+    """Delete files under IMAGE_DIR that no referenced image (or its thumbnail) accounts for.
+    Returns the removed (or, with dry_run, removable) paths."""
+    keep = set()
+    for path in referenced:
+        if path:
+            keep.add(os.path.normpath(path))
+            keep.add(os.path.normpath(thumbnail_path(path)))
+    cutoff = time.time() - min_age
+    removed = []
+    for root, _dirs, files in os.walk(IMAGE_DIR):
+        for name in files:
+            path = os.path.normpath(os.path.join(root, name))
+            if path in keep or os.path.getmtime(path) > cutoff:
+                continue
+            if not dry_run:
+                os.remove(path)
+            removed.append(path)
+    return removed
@@ -0,0 +1,116 @@
+# invoices.py
+import io
+import multiprocessing
+import os
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from database import get_invoice_rows, get_appointment_invoice
+from reports import pdf_font, shape_text
+
+INVOICE_CHUNK_SIZE = 50
+INVOICE_TITLE = "فاتورة عيادة الأسنان"
+
+def _fmt_datetime(value):
+    return value.strftime("%Y-%m-%d %H:%M") if value else ""
+
+def _render(title, lines):
+    """One-page invoice with the title and (label, value) lines right-aligned; returns PDF bytes"""
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfgen import canvas
+
+    buffer = io.BytesIO()
+    font = pdf_font()
+    c = canvas.Canvas(buffer, pagesize=letter, pageCompression=1)
+    width, height = letter
+    right = width - 50
+    y = height - 50
+    c.setFont(font, 14)
+    c.drawRightString(right, y, shape_text(title))
+    y -= 30
+    c.setFont(font, 11)
+    for label, value, gap in lines:
+        c.drawRightString(right, y, shape_text(f"{label}: {value}"))
+        y -= gap
+    c.showPage()
+    c.save()
+    return buffer.getvalue()
+
+def render_payment_invoice(row):
+    """PDF bytes for a get_invoice_rows() dict; touches no database, so it runs in worker processes"""
+    return _render(INVOICE_TITLE, [
+        ("تاريخ الدفع", _fmt_datetime(row["date_paid"]), 20),
+        ("المريض", row["patient_name"] or "", 15),
+        ("الطبيب", row["doctor_name"] or "", 15),
+        ("العلاج", row["treatment_name"] or "", 20),
+        ("المبلغ الإجمالي", row["total_amount"], 15),
+        ("الخصم", row["discounts"] or 0.0, 15),
+        ("الضريبة", row["taxes"] or 0.0, 15),
+        ("حصة العيادة", row["clinic_share"], 15),
+        ("حصة الطبيب", row["doctor_share"], 15),
+        ("المدفوع", row["paid_amount"], 30),
+    ])
+
+def render_appointment_invoice(row):
+    return _render(INVOICE_TITLE, [
+        ("تاريخ الموعد", _fmt_datetime(row["date"]), 20),
+        ("المريض", row["patient_name"] or "", 15),
+        ("الطبيب", row["doctor_name"] or "", 15),
+        ("العلاج", row["treatment_name"] or "", 25),
+        ("ملاحظات", row["notes"] or "", 25),
+    ])
+
+def generate_invoice_pdf(payment_id=None, appointment_id=None):
+    """Single invoice as a BytesIO, for a payment or else an appointment"""
+    if payment_id:
+        rows = get_invoice_rows(payment_ids=[payment_id])
+        if rows:
+            return io.BytesIO(render_payment_invoice(rows[0]))
+    elif appointment_id:
+        row = get_appointment_invoice(appointment_id)
+        if row:
+            return io.BytesIO(render_appointment_invoice(row))
+    return io.BytesIO(_render(INVOICE_TITLE, []))
+
+def invoice_filename(row):
+    return f"invoice_payment_{row['id']}.pdf"
+
+def _render_chunk(rows):
+    return [(invoice_filename(row), render_payment_invoice(row)) for row in rows]
+
+def generate_invoices_zip(out, start_date=None, end_date=None, doctor_id=None, workers=None,
+                          chunk_size=INVOICE_CHUNK_SIZE, progress=None):
+    """Write one PDF per matching payment into a ZIP on the binary file object out.
+
+    Rows come from a single joined query; rendering is spread over a process pool in
+    chunks and each finished chunk is written to the archive as soon as it arrives.
+    Returns {"count", "seconds", "per_second"}.
+    """
+    started = time.perf_counter()
+    rows = get_invoice_rows(start_date, end_date, doctor_id)
+    chunks = [rows[i:i + chunk_size] for i in range(0, len(rows), chunk_size)]
+    workers = workers or os.cpu_count() or 1
+    done = 0
+    # PDF pages are already compressed, so entries are stored as-is
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_STORED) as archive:
+        if workers == 1 or len(chunks) <= 1:
+            results = map(_render_chunk, chunks)
+            pool = None
+        else:
+            # spawn, not fork: the Streamlit server is multi-threaded and holds pooled connections
+            pool = ProcessPoolExecutor(max_workers=min(workers, len(chunks)),
+                                       mp_context=multiprocessing.get_context("spawn"))
+            results = pool.map(_render_chunk, chunks)
+        try:
+            for rendered in results:
+                for name, data in rendered:
+                    archive.writestr(name, data)
+                done += len(rendered)
+                if progress:
+                    progress(done, len(rows))
+        finally:
+            if pool:
+                pool.shutdown()
+    seconds = time.perf_counter() - started
+    return {"count": done, "seconds": seconds, "per_second": done / seconds if seconds else 0.0}
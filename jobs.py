@@ -0,0 +1,201 @@
+# jobs.py
+"""Background exports: the page submits a job and returns at once, a worker
+thread writes the file and records progress in the jobs table, and the page
+polls that row until the download is ready.
+
+Finished files live in JOB_DIR, named by the job key (kind, parameters and the
+data versions of the tables the export reads), so repeating a request reuses
+the file until one of those tables changes.
+"""
+import datetime
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import update
+
+import database
+import invoices
+import reports
+import settlements
+from models import Job, get_session, table_versions, write_connection
+
+log = logging.getLogger("dental.jobs")
+
+JOB_DIR = os.environ.get("DENTAL_JOB_DIR", "exports")
+JOB_WORKERS = 2  # the invoice job already renders on a process pool
+JOB_RETENTION = datetime.timedelta(days=7)
+JOB_STALE_AFTER = datetime.timedelta(minutes=15)  # no progress for this long: the worker process died
+PROGRESS_INTERVAL = 0.5  # seconds between progress writes
+ACTIVE = ("queued", "running")
+
+_executor = {"pool": None, "lock": threading.Lock()}
+
+def _dates(params):
+    return [datetime.date.fromisoformat(params[k]) if params.get(k) else None for k in ("start_date", "end_date")]
+
+def _payments_csv(path, params, progress):
+    start, end = _dates(params)
+    with open(path, "w", newline="", encoding="utf-8-sig") as f:
+        return database.export_payments_csv(f, start, end, params.get("doctor_id"), progress=progress)
+
+def _report_pdf(path, params, progress):
+    df = reports.generate_report(*_dates(params))
+    progress(0, len(df))
+    with open(path, "wb") as f:
+        reports.export_to_pdf(df, out=f)
+    return len(df)
+
+def _report_excel(path, params, progress):
+    df = reports.generate_report(*_dates(params))
+    progress(0, len(df))
+    with open(path, "wb") as f:
+        f.write(reports.export_to_excel(df).getvalue())
+    return len(df)
+
+def _invoices_zip(path, params, progress):
+    start, end = _dates(params)
+    with open(path, "wb") as f:
+        return invoices.generate_invoices_zip(f, start, end, params.get("doctor_id"), progress=progress)["count"]
+
+def _doctor_statement(path, params, progress):
+    start, end = _dates(params)
+    df = settlements.doctor_statement(params["doctor_id"], start, end)
+    progress(0, len(df) - 1)  # last row holds the totals
+    with open(path, "wb") as f:
+        reports.export_to_pdf(df, out=f, title=settlements.statement_title(params["doctor_id"], start, end))
+    return len(df) - 1
+
+# kind -> (writer, file extension, tables the output depends on)
+JOB_KINDS = {
+    "payments_csv": (_payments_csv, ".csv", ("payments", "appointments", "doctors")),
+    "report_pdf": (_report_pdf, ".pdf", ("payments",)),
+    "report_excel": (_report_excel, ".xlsx", ("payments",)),
+    "invoices_zip": (_invoices_zip, ".zip", ("payments", "appointments", "patients", "doctors", "treatments")),
+    "doctor_statement": (_doctor_statement, ".pdf", ("payments", "appointments", "patients", "doctors", "treatments")),
+}
+
+def _digest(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def _now():
+    return datetime.datetime.now()
+
+def _pool():
+    with _executor["lock"]:
+        if _executor["pool"] is None:
+            _executor["pool"] = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="dental-job")
+        return _executor["pool"]
+
+def _reusable(job, now):
+    if job.status == "done":
+        return bool(job.result_path) and os.path.exists(job.result_path)
+    return now - (job.updated_at or job.created_at) < JOB_STALE_AFTER
+
+def submit(kind, **params):
+    """Queue an export and return its job id. A job with the same key that is still
+    queued or running, or finished with its file on disk, is returned instead."""
+    params = json.loads(json.dumps(params, default=str))
+    params_key = _digest(kind, params)
+    now = _now()
+    with get_session(write=True) as session:
+        # versions are read before the export runs, so a file is never older than its key
+        versions = table_versions(session.connection(), JOB_KINDS[kind][2])
+        key = _digest(params_key, versions)
+        for job in session.query(Job).filter(Job.key == key, Job.status.in_(ACTIVE + ("done",))):
+            if _reusable(job, now):
+                return job.id
+            if job.status in ACTIVE:
+                job.status, job.error, job.finished_at = "failed", "interrupted", now
+        job = Job(kind=kind, params=json.dumps(params), params_key=params_key, key=key, status="queued",
+                  created_at=now, updated_at=now)
+        session.add(job)
+        session.flush()
+        job_id = job.id
+    _pool().submit(_run, job_id)
+    return job_id
+
+def _update(job_id, **values):
+    values["updated_at"] = _now()
+    with write_connection() as conn:
+        conn.execute(update(Job).where(Job.id == job_id).values(**values))
+
+def _progress_writer(job_id):
+    last = [0.0]
+
+    def progress(done, total=None):
+        if time.monotonic() - last[0] >= PROGRESS_INTERVAL:
+            last[0] = time.monotonic()
+            _update(job_id, done=done, total=total)
+    return progress
+
+def _run(job_id):
+    with get_session(write=True) as session:
+        job = session.get(Job, job_id)
+        if job is None or job.status != "queued":
+            return
+        job.status, job.started_at, job.updated_at = "running", _now(), _now()
+        kind, params, key, params_key = job.kind, json.loads(job.params), job.key, job.params_key
+    writer, ext, _ = JOB_KINDS[kind]
+    os.makedirs(JOB_DIR, exist_ok=True)
+    path = os.path.join(JOB_DIR, key + ext)
+    partial = path + ".part"
+    try:
+        count = writer(partial, params, _progress_writer(job_id))
+        os.replace(partial, path)
+    except Exception as e:
+        log.exception("job %s (%s) failed", job_id, kind)
+        if os.path.exists(partial):
+            os.remove(partial)
+        _update(job_id, status="failed", error=f"{type(e).__name__}: {e}", finished_at=_now())
+        return
+    _update(job_id, status="done", done=count, total=count, result_path=path, finished_at=_now())
+    _expire_superseded(job_id, params_key, key)
+
+def _expire_superseded(job_id, params_key, key):
+    """Drop the files of earlier runs of the same request built from older data"""
+    with get_session(write=True) as session:
+        old = session.query(Job).filter(Job.params_key == params_key, Job.key != key, Job.status == "done").all()
+        paths = [job.result_path for job in old]
+        for job in old:
+            job.status, job.result_path, job.updated_at = "expired", None, _now()
+    for path in paths:
+        if path and os.path.exists(path):
+            os.remove(path)
+
+def get_jobs(job_ids):
+    """Job rows for the given ids, newest first"""
+    if not job_ids:
+        return []
+    with get_session() as session:
+        return (session.query(Job.id, Job.kind, Job.params, Job.status, Job.done, Job.total, Job.result_path,
+                              Job.error, Job.started_at, Job.finished_at)
+                .filter(Job.id.in_(job_ids)).order_by(Job.id.desc()).all())
+
+def cleanup(retention=JOB_RETENTION):
+    """Fail jobs whose worker died, delete jobs finished more than retention ago and
+    files in JOB_DIR no job points at; returns (jobs removed, files removed)"""
+    now = _now()
+    with get_session(write=True) as session:
+        for job in session.query(Job).filter(Job.status.in_(ACTIVE)):
+            if not _reusable(job, now):
+                job.status, job.error, job.finished_at = "failed", "interrupted", now
+        old = session.query(Job).filter(Job.status.notin_(ACTIVE), Job.finished_at < now - retention).all()
+        for job in old:
+            session.delete(job)
+        keep = {os.path.normpath(p) for (p,) in session.query(Job.result_path).filter(Job.result_path.isnot(None))}
+        # running jobs write <key><ext>.part; leave those alone
+        keep |= {os.path.normpath(os.path.join(JOB_DIR, k + JOB_KINDS[kind][1] + ".part"))
+                 for k, kind in session.query(Job.key, Job.kind).filter(Job.status.in_(ACTIVE))}
+    removed = 0
+    if os.path.isdir(JOB_DIR):
+        for name in os.listdir(JOB_DIR):
+            path = os.path.normpath(os.path.join(JOB_DIR, name))
+            if path not in keep and os.path.isfile(path):
+                os.remove(path)
+                removed += 1
+    return len(old), removed
@@ -0,0 +1,168 @@
+# maintenance.py
+import argparse
+import datetime
+import sys
+
+import branches
+import database
+import invoices
+import jobs
+import models
+import settlements
+
+def rebuild_summary(args):
+    models.rebuild_daily_summary()
+    print("daily_summary rebuilt")
+
+def check_summary(args):
+    mismatches = models.check_daily_summary()
+    for day, doctor_id, column, expected, actual in mismatches:
+        print(f"{day} doctor={doctor_id} {column}: expected {expected}, found {actual}")
+    print(f"{len(mismatches)} mismatches")
+    return 1 if mismatches else 0
+
+def check_stock(args):
+    mismatches = database.check_stock()
+    for item_id, name, quantity, ledger in mismatches:
+        print(f"item {item_id} {name}: quantity {quantity}, ledger {ledger}")
+    print(f"{len(mismatches)} mismatches")
+    return 1 if mismatches else 0
+
+def rebuild_search(args):
+    models.rebuild_search_index()
+    print("search index rebuilt")
+
+def migrate(args):
+    # init_db creates missing tables and then applies the pending steps; compare versions around it
+    with models.engine.connect() as conn:
+        before = models.schema_version(conn)
+    models.init_db()
+    with models.engine.connect() as conn:
+        after = models.schema_version(conn)
+    applied = [version for version, _ in models.SCHEMA_MIGRATIONS if before < version <= after]
+    print(f"applied migrations: {applied or 'none'}; schema version {after}")
+
+def explain(args):
+    failed = 0
+    for name, index, plan, ok in database.explain_query_plans():
+        print(f"{'ok  ' if ok else 'FAIL'} {name} (expects {index})")
+        for line in plan:
+            print(f"     {line}")
+        failed += not ok
+    return 1 if failed else 0
+
+def import_file(args):
+    def progress(inserted, rejected):
+        print(f"\r{inserted} inserted, {rejected} rejected", end="", file=sys.stderr)
+
+    with open(args.file, "rb") as f:
+        result = database.import_records(args.kind, f, filename=args.file, chunk_size=args.chunk_size, progress=progress)
+    print(file=sys.stderr)
+    for line, reason in result["rejected"]:
+        print(f"line {line}: {reason}")
+    print(f"{result['inserted']} inserted, {len(result['rejected'])} rejected")
+    return 1 if result["rejected"] else 0
+
+def gc_images(args):
+    removed = database.garbage_collect_images(dry_run=args.dry_run)
+    for path in removed:
+        print(path)
+    print(f"{len(removed)} orphaned files {'found' if args.dry_run else 'removed'}")
+
+def batch_invoices(args):
+    def progress(done, total):
+        print(f"\r{done}/{total} invoices", end="", file=sys.stderr)
+
+    with open(args.output, "wb") as f:
+        stats = invoices.generate_invoices_zip(f, args.start, args.end, args.doctor, args.workers, progress=progress)
+    print(file=sys.stderr)
+    print(f"{stats['count']} invoices in {stats['seconds']:.2f}s ({stats['per_second']:.1f}/s) -> {args.output}")
+
+def clean_jobs(args):
+    removed_jobs, removed_files = jobs.cleanup(datetime.timedelta(days=args.days))
+    print(f"{removed_jobs} old jobs and {removed_files} export files removed")
+
+def settle(args):
+    try:
+        lines = (settlements.compute_settlement(args.start, args.end) if not args.close
+                 else settlements.get_settlement_lines(settlements.close_period(args.start, args.end)))
+    except settlements.SettlementError as e:
+        print(e, file=sys.stderr)
+        return 1
+    for line in lines:
+        print(f"{line['doctor_id']:>5} {line['doctor_name']:<30} payments={line['payments_count']:<6} "
+              f"net={line['net']:>12.2f} paid={line['paid']:>12.2f} unpaid={line['unpaid']:>10.2f} "
+              f"doctor_share={line['doctor_share']:>12.2f}")
+    print(f"{len(lines)} doctors, {'closed' if args.close else 'not closed'}")
+
+def recalc_shares(args):
+    changes = database.recalculate_shares(args.treatment, args.doctor, args.start, args.end, dry_run=args.dry_run)
+    for c in changes:
+        print(f"treatment={c['treatment_id']} doctor={c['doctor_id']} payments={c['payments']} "
+              f"clinic_delta={c['clinic_delta']:.2f} doctor_delta={c['doctor_delta']:.2f}")
+    total = sum(c["payments"] for c in changes)
+    print(f"{total} payments {'would change' if args.dry_run else 'updated'}")
+
+def branch_totals(args):
+    spec = ";".join(args.branch) if args.branch else None
+    totals, errors = branches.consolidated_totals(args.start, args.end,
+                                                  branches=branches.parse_branches(spec) if spec else None)
+    for row in totals.itertuples(index=False):
+        print(f"{row.branch:<20} income={row.income:>14.2f} clinic={row.clinic_share:>14.2f} "
+              f"doctors={row.doctor_share:>14.2f} expenses={row.expenses:>14.2f} net={row.net:>14.2f}")
+    for name, error in errors.items():
+        print(f"{name}: {error}", file=sys.stderr)
+    print(f"{len(totals)} branches, {len(errors)} failed")
+    return 1 if errors else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Dental clinic database maintenance")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("rebuild-summary").set_defaults(func=rebuild_summary)
+    commands.add_parser("check-summary").set_defaults(func=check_summary)
+    commands.add_parser("check-stock", help="compare item quantities with their movement ledger").set_defaults(func=check_stock)
+    commands.add_parser("rebuild-search").set_defaults(func=rebuild_search)
+    commands.add_parser("migrate").set_defaults(func=migrate)
+    commands.add_parser("explain", help="check that page queries use their indexes").set_defaults(func=explain)
+    imp = commands.add_parser("import", help="bulk import a CSV/XLSX file")
+    imp.add_argument("kind", choices=database.IMPORT_KINDS)
+    imp.add_argument("file")
+    imp.add_argument("--chunk-size", type=int, default=database.IMPORT_CHUNK_SIZE)
+    imp.set_defaults(func=import_file)
+    gc = commands.add_parser("gc-images", help="delete image files no patient references")
+    gc.add_argument("--dry-run", action="store_true")
+    gc.set_defaults(func=gc_images)
+    inv = commands.add_parser("invoices", help="write every invoice in a date range into a ZIP")
+    inv.add_argument("output")
+    inv.add_argument("--start", type=datetime.date.fromisoformat)
+    inv.add_argument("--end", type=datetime.date.fromisoformat)
+    inv.add_argument("--doctor", type=int)
+    inv.add_argument("--workers", type=int)
+    inv.set_defaults(func=batch_invoices)
+    cj = commands.add_parser("clean-jobs", help="delete old background exports and their files")
+    cj.add_argument("--days", type=float, default=jobs.JOB_RETENTION.days)
+    cj.set_defaults(func=clean_jobs)
+    stl = commands.add_parser("settle", help="per-doctor payout totals for a period; --close snapshots them")
+    stl.add_argument("--start", type=datetime.date.fromisoformat, required=True)
+    stl.add_argument("--end", type=datetime.date.fromisoformat, required=True)
+    stl.add_argument("--close", action="store_true")
+    stl.set_defaults(func=settle)
+    rs = commands.add_parser("recalc-shares", help="update stored payment shares to the current percentages")
+    rs.add_argument("--treatment", type=int)
+    rs.add_argument("--doctor", type=int)
+    rs.add_argument("--start", type=datetime.date.fromisoformat)
+    rs.add_argument("--end", type=datetime.date.fromisoformat)
+    rs.add_argument("--dry-run", action="store_true")
+    rs.set_defaults(func=recalc_shares)
+    br = commands.add_parser("branches", help="income and expenses of every branch database, queried in parallel")
+    br.add_argument("--start", type=datetime.date.fromisoformat)
+    br.add_argument("--end", type=datetime.date.fromisoformat)
+    br.add_argument("--branch", action="append", help=f"name=url (repeatable); default: ${branches.BRANCHES_ENV}")
+    br.set_defaults(func=branch_totals)
+    args = parser.parse_args(argv)
+    if args.func is not migrate:
+        models.init_db()
+    return args.func(args) or 0
+
+if __name__ == "__main__":
+    sys.exit(main())
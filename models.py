@@ -1,14 +1,98 @@
 # models.py
-from sqlalchemy import create_engine, Column, Integer, String, Float, DateTime, ForeignKey, Text
+import datetime
+import logging
+import os
+import time
+import random
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, event, Column, Index, Integer, String, Float, Date, DateTime, ForeignKey, Text, bindparam, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import sessionmaker, relationship
+
+log = logging.getLogger("dental.models")
+
+# --- Database Setup ---
+DB_PATH = os.environ.get("DENTAL_DB_URL", "sqlite:///dental_clinic.db")
+
+# SQLite concurrency profile: WAL lets readers proceed while one writer commits,
+# busy_timeout makes a writer wait for the lock instead of failing at once, and
+# pooled connections keep their page cache between reruns.
+ENGINE_PROFILE = {
+    "pool_size": 5,
+    "max_overflow": 10,
+    "pool_timeout": 30,
+    "pragmas": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -64000,  # negative means KiB: 64 MB per connection
+        "busy_timeout": 5000,  # ms
+        "temp_store": "MEMORY",
+    },
+}
+LOCK_RETRIES = 5
+LOCK_BACKOFF = 0.05  # seconds, doubled on every retry
+
+def make_engine(url, profile=ENGINE_PROFILE):
+    eng = create_engine(url, echo=False, poolclass=QueuePool,
+                        pool_size=profile["pool_size"], max_overflow=profile["max_overflow"],
+                        pool_timeout=profile["pool_timeout"], connect_args={"check_same_thread": False})
+
+    @event.listens_for(eng, "connect")
+    def set_pragmas(dbapi_conn, connection_record):
+        # SQLAlchemy emits BEGIN itself (see below) so write transactions can take the lock up front
+        dbapi_conn.isolation_level = None
+        cursor = dbapi_conn.cursor()
+        for name, value in profile["pragmas"].items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+        # Python's round() for set-based share updates: SQLite's round() differs on binary
+        # halves such as 177.325, and stored shares must match calculate_shares exactly.
+        # Statements only; triggers must work on connections that lack it.
+        dbapi_conn.create_function("py_round", 2, round, deterministic=True)
+
+    @event.listens_for(eng, "begin")
+    def begin(conn):
+        conn.exec_driver_sql(f"BEGIN {conn.get_execution_options().get('sqlite_begin', 'DEFERRED')}")
+
+    return eng
+
+def is_lock_error(exc):
+    return isinstance(exc, OperationalError) and ("locked" in str(exc) or "busy" in str(exc))
+
+def lock_backoff(attempt):
+    return LOCK_BACKOFF * (2 ** attempt) * (0.5 + random.random())
 
-DATABASE_URL = 'sqlite:///dental_clinic.db'
+engine = make_engine(DB_PATH)
+Session = sessionmaker(bind=engine, expire_on_commit=False)
+
+@contextmanager
+def write_connection(eng=None):
+    """Core connection inside a BEGIN IMMEDIATE transaction, retried with backoff while
+    another writer holds the lock; commits on success"""
+    with (eng or engine).connect() as conn:
+        conn = conn.execution_options(sqlite_begin="IMMEDIATE")
+        for attempt in range(LOCK_RETRIES):
+            try:
+                trans = conn.begin()
+                break
+            except OperationalError as e:
+                if not is_lock_error(e) or attempt == LOCK_RETRIES - 1:
+                    raise
+                time.sleep(lock_backoff(attempt))
+        try:
+            yield conn
+            trans.commit()
+        except Exception:
+            trans.rollback()
+            raise
 
-engine = create_engine(DATABASE_URL, echo=True)
-Session = sessionmaker(bind=engine)
 Base = declarative_base()
 
+# --- Models ---
 class Patient(Base):
     __tablename__ = 'patients'
     id = Column(Integer, primary_key=True)
@@ -28,11 +112,14 @@ class Doctor(Base):
     phone = Column(String)
     email = Column(String)
 
+DEFAULT_DURATION_MINUTES = 30
+
 class Treatment(Base):
     __tablename__ = 'treatments'
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
     base_cost = Column(Float)
+    duration_minutes = Column(Integer, default=DEFAULT_DURATION_MINUTES)
 
 class TreatmentPercentage(Base):
     __tablename__ = 'treatment_percentages'
@@ -43,24 +130,27 @@ class TreatmentPercentage(Base):
     doctor_percentage = Column(Float)
     treatment = relationship("Treatment")
     doctor = relationship("Doctor")
+    __table_args__ = (Index("ux_treatment_percentages_pair", "treatment_id", "doctor_id", unique=True),)
 
 class Appointment(Base):
     __tablename__ = 'appointments'
     id = Column(Integer, primary_key=True)
-    patient_id = Column(Integer, ForeignKey('patients.id'))
+    patient_id = Column(Integer, ForeignKey('patients.id'), index=True)
     doctor_id = Column(Integer, ForeignKey('doctors.id'))
-    treatment_id = Column(Integer, ForeignKey('treatments.id'))
-    date = Column(DateTime)
+    treatment_id = Column(Integer, ForeignKey('treatments.id'), index=True)
+    date = Column(DateTime, index=True)
+    duration_minutes = Column(Integer)
     status = Column(String)
     notes = Column(Text)
     patient = relationship("Patient")
     doctor = relationship("Doctor")
     treatment = relationship("Treatment")
+    __table_args__ = (Index("ix_appointments_doctor_date", "doctor_id", "date"),)
 
 class Payment(Base):
     __tablename__ = 'payments'
     id = Column(Integer, primary_key=True)
-    appointment_id = Column(Integer, ForeignKey('appointments.id'))
+    appointment_id = Column(Integer, ForeignKey('appointments.id'), nullable=True, index=True)
     total_amount = Column(Float)
     paid_amount = Column(Float)
     clinic_share = Column(Float)
@@ -68,8 +158,507 @@ class Payment(Base):
     payment_method = Column(String)
     discounts = Column(Float)
     taxes = Column(Float)
-    date_paid = Column(DateTime)
+    date_paid = Column(DateTime, index=True)
     appointment = relationship("Appointment")
 
+class Expense(Base):
+    __tablename__ = 'expenses'
+    id = Column(Integer, primary_key=True)
+    description = Column(String)
+    amount = Column(Float)
+    date = Column(DateTime, index=True)
+
+class InventoryItem(Base):
+    __tablename__ = 'inventory_items'
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    quantity = Column(Float)
+    unit = Column(String)
+    cost_per_unit = Column(Float)
+    reorder_level = Column(Float, default=0.0)
+
+# quantity - reorder_level <= 0 is the low-stock condition; the query repeats this
+# exact expression so SQLite can answer it from the index
+Index("ix_inventory_items_shortfall", InventoryItem.quantity - InventoryItem.reorder_level)
+
+class TreatmentMaterial(Base):
+    """Bill of materials: quantity of an inventory item one treatment consumes"""
+    __tablename__ = 'treatment_materials'
+    id = Column(Integer, primary_key=True)
+    treatment_id = Column(Integer, ForeignKey('treatments.id'), nullable=False)
+    item_id = Column(Integer, ForeignKey('inventory_items.id'), nullable=False, index=True)
+    quantity = Column(Float, nullable=False)
+    __table_args__ = (Index("ux_treatment_materials_pair", "treatment_id", "item_id", unique=True),)
+
+class StockMovement(Base):
+    """Stock ledger: every change to an item's quantity, positive for stock in.
+    Consumption rows carry the appointment that used the material."""
+    __tablename__ = 'stock_movements'
+    id = Column(Integer, primary_key=True)
+    item_id = Column(Integer, ForeignKey('inventory_items.id'), nullable=False, index=True)
+    change = Column(Float, nullable=False)
+    reason = Column(String)
+    appointment_id = Column(Integer, ForeignKey('appointments.id'), index=True)
+    created_at = Column(DateTime)
+
+# StockMovement.reason values
+OPENING_BALANCE = "رصيد افتتاحي"
+CONSUMED = "استهلاك علاج"
+RETURNED = "إلغاء استهلاك"
+ADJUSTED = "تعديل يدوي"
+
+class DailySummary(Base):
+    """Per-day (and per-doctor) financial rollup, maintained by triggers on
+    payments, expenses and appointments; doctor_id 0 holds expenses and
+    payments without an appointment"""
+    __tablename__ = 'daily_summary'
+    day = Column(Date, primary_key=True)
+    doctor_id = Column(Integer, primary_key=True, default=0)
+    income = Column(Float, default=0.0)
+    clinic_share = Column(Float, default=0.0)
+    doctor_share = Column(Float, default=0.0)
+    expenses = Column(Float, default=0.0)
+    payments_count = Column(Integer, default=0)
+    discounts = Column(Float, default=0.0)
+    taxes = Column(Float, default=0.0)
+    paid = Column(Float, default=0.0)
+
+class Settlement(Base):
+    """A closed payout period; its lines are a snapshot and are never recomputed"""
+    __tablename__ = 'settlements'
+    id = Column(Integer, primary_key=True)
+    period_start = Column(Date, nullable=False)
+    period_end = Column(Date, nullable=False)
+    closed_at = Column(DateTime)
+    payments_count = Column(Integer, default=0)
+    doctor_share = Column(Float, default=0.0)
+    __table_args__ = (Index("ix_settlements_period", "period_start", "period_end"),)
+
+class SettlementLine(Base):
+    """One doctor's totals in a closed settlement"""
+    __tablename__ = 'settlement_lines'
+    id = Column(Integer, primary_key=True)
+    settlement_id = Column(Integer, ForeignKey('settlements.id'), nullable=False, index=True)
+    doctor_id = Column(Integer, ForeignKey('doctors.id'))
+    payments_count = Column(Integer, default=0)
+    gross = Column(Float, default=0.0)
+    discounts = Column(Float, default=0.0)
+    taxes = Column(Float, default=0.0)
+    net = Column(Float, default=0.0)
+    paid = Column(Float, default=0.0)
+    unpaid = Column(Float, default=0.0)
+    clinic_share = Column(Float, default=0.0)
+    doctor_share = Column(Float, default=0.0)
+
+class DataVersion(Base):
+    """Write counter per table, bumped by triggers so that changes made by any
+    process (server, maintenance CLI, imports) are visible to every other"""
+    __tablename__ = 'data_versions'
+    table_name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+class Job(Base):
+    """Background export. key covers the kind, the parameters and the data versions
+    of the tables it reads, so a finished file is reused until that data changes."""
+    __tablename__ = 'jobs'
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)
+    params = Column(Text)
+    params_key = Column(String, index=True)
+    key = Column(String, index=True)
+    status = Column(String, nullable=False, default="queued")
+    done = Column(Integer, default=0)
+    total = Column(Integer)
+    result_path = Column(String)
+    error = Column(Text)
+    created_at = Column(DateTime)
+    started_at = Column(DateTime)
+    updated_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+# --- Schema migrations ---
+# create_all only creates missing tables; changes to existing clinic databases
+# go here as numbered steps. The applied version is kept in PRAGMA user_version
+# and each step runs in its own write transaction, so append new steps and
+# never edit one that has shipped.
+def _migration_1(conn):
+    """Indexes on hot filter/sort columns and a unique (treatment, doctor) percentage pair"""
+    # duplicate pairs keep their lowest id, the row the lookups always returned
+    duplicates = ("FROM treatment_percentages WHERE id NOT IN "
+                  "(SELECT min(id) FROM treatment_percentages GROUP BY treatment_id, doctor_id)")
+    for row in conn.execute(text("SELECT id, treatment_id, doctor_id, clinic_percentage, doctor_percentage "
+                                 + duplicates)):
+        log.warning("dropping duplicate treatment percentage id=%s treatment=%s doctor=%s clinic=%s%% doctor=%s%%", *row)
+    conn.execute(text("DELETE " + duplicates))
+    for statement in (
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_treatment_percentages_pair ON treatment_percentages (treatment_id, doctor_id)",
+        "CREATE INDEX IF NOT EXISTS ix_appointments_date ON appointments (date)",
+        "CREATE INDEX IF NOT EXISTS ix_appointments_patient_id ON appointments (patient_id)",
+        "CREATE INDEX IF NOT EXISTS ix_appointments_treatment_id ON appointments (treatment_id)",
+        "CREATE INDEX IF NOT EXISTS ix_appointments_doctor_date ON appointments (doctor_id, date)",
+        "CREATE INDEX IF NOT EXISTS ix_payments_appointment_id ON payments (appointment_id)",
+        "CREATE INDEX IF NOT EXISTS ix_payments_date_paid ON payments (date_paid)",
+        "CREATE INDEX IF NOT EXISTS ix_expenses_date ON expenses (date)",
+    ):
+        conn.execute(text(statement))
+
+def _add_column(conn, table, column, ddl):
+    if column not in {row[1] for row in conn.execute(text(f"PRAGMA table_info({table})"))}:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+def backfill_appointment_durations(conn):
+    """Give appointments without a duration their treatment's (or the default) length"""
+    conn.execute(text(
+        "UPDATE appointments SET duration_minutes = coalesce("
+        "(SELECT duration_minutes FROM treatments WHERE treatments.id = appointments.treatment_id), "
+        f"{DEFAULT_DURATION_MINUTES}) WHERE duration_minutes IS NULL"))
+
+def _migration_2(conn):
+    """Appointment durations, defaulted per treatment"""
+    _add_column(conn, "treatments", "duration_minutes", f"INTEGER DEFAULT {DEFAULT_DURATION_MINUTES}")
+    _add_column(conn, "appointments", "duration_minutes", "INTEGER")
+    conn.execute(text(f"UPDATE treatments SET duration_minutes = {DEFAULT_DURATION_MINUTES} WHERE duration_minutes IS NULL"))
+    backfill_appointment_durations(conn)
+
+def _migration_3(conn):
+    """Discounts, taxes and paid amounts in the daily rollup, for doctor settlements.
+    The payment triggers are dropped here; ensure_daily_summary recreates them with
+    the new columns and rebuilds the table."""
+    for column in ("discounts", "taxes", "paid"):
+        _add_column(conn, "daily_summary", column, "FLOAT DEFAULT 0.0")
+    for name in SUMMARY_TRIGGERS:
+        conn.execute(text(f"DROP TRIGGER IF EXISTS {name}"))
+
+def _migration_4(conn):
+    """Reorder levels with the low-stock index, and an opening ledger entry for the
+    stock on hand so every quantity equals the sum of its movements"""
+    _add_column(conn, "inventory_items", "reorder_level", "FLOAT DEFAULT 0.0")
+    conn.execute(text("UPDATE inventory_items SET reorder_level = 0.0 WHERE reorder_level IS NULL"))
+    conn.execute(text("UPDATE inventory_items SET quantity = 0.0 WHERE quantity IS NULL"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_inventory_items_shortfall "
+                      "ON inventory_items (quantity - reorder_level)"))
+    conn.execute(text("INSERT INTO stock_movements (item_id, change, reason, created_at) "
+                      "SELECT id, quantity, :reason, :now FROM inventory_items WHERE quantity != 0")
+                 .bindparams(bindparam("now", type_=DateTime)),
+                 {"reason": OPENING_BALANCE, "now": datetime.datetime.now()})
+
+SCHEMA_MIGRATIONS = [
+    (1, _migration_1),
+    (2, _migration_2),
+    (3, _migration_3),
+    (4, _migration_4),
+]
+
+def schema_version(conn):
+    return conn.execute(text("PRAGMA user_version")).scalar()
+
+def migrate_schema():
+    """Apply pending migrations; returns the list of versions applied"""
+    applied = []
+    for version, step in SCHEMA_MIGRATIONS:
+        with write_connection() as conn:
+            # re-read under the write lock so concurrent servers apply each step once
+            if schema_version(conn) >= version:
+                continue
+            step(conn)
+            conn.execute(text(f"PRAGMA user_version = {int(version)}"))
+        applied.append(version)
+    return applied
+
+# --- Full-text search index (SQLite FTS5) ---
+# Indexed text is stored normalized so that alef/hamza variants, taa marbuta,
+# alef maqsura and diacritics all match the plain form typed in the search box.
+ARABIC_NORMALIZATION = {
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ة": "ه", "ى": "ي", "ؤ": "و", "ئ": "ي",
+    # tanween, harakat, shadda, sukun, superscript alef, tatweel
+    "ً": "", "ٌ": "", "ٍ": "", "َ": "", "ُ": "", "ِ": "",
+    "ّ": "", "ْ": "", "ٰ": "", "ـ": "",
+}
+_ARABIC_TRANSLATION = str.maketrans(ARABIC_NORMALIZATION)
+
+# fts table -> (source table, indexed columns)
+SEARCH_INDEXES = {
+    "patients_fts": ("patients", ["name", "phone", "address"]),
+    "doctors_fts": ("doctors", ["name", "specialty", "phone", "email"]),
+    "appointments_fts": ("appointments", ["status", "notes"]),
+}
+
+def normalize_arabic(text):
+    if not text:
+        return ""
+    return str(text).translate(_ARABIC_TRANSLATION).lower()
+
+def _sql_normalize(expr):
+    """Same normalization as normalize_arabic as a plain SQL expression, so the
+    triggers work for any connection without registering a Python function"""
+    sql = f"coalesce({expr}, '')"
+    for src, dst in ARABIC_NORMALIZATION.items():
+        sql = f"replace({sql}, '{src}', '{dst}')"
+    return f"lower({sql})"
+
+def _fts_insert_sql(fts, columns, row="new"):
+    values = ", ".join(_sql_normalize(f"{row}.{c}") for c in columns)
+    return f"INSERT INTO {fts}(rowid, {', '.join(columns)}) VALUES ({row}.id, {values});"
+
+def _fts_backfill_sql(fts, where="1"):
+    table, columns = SEARCH_INDEXES[fts]
+    values = ", ".join(_sql_normalize(c) for c in columns)
+    return f"INSERT INTO {fts}(rowid, {', '.join(columns)}) SELECT id, {values} FROM {table} WHERE {where}"
+
+def _fts_triggers(fts):
+    table, columns = SEARCH_INDEXES[fts]
+    return {
+        f"{fts}_ai": f"AFTER INSERT ON {table} BEGIN {_fts_insert_sql(fts, columns)} END",
+        f"{fts}_au": (f"AFTER UPDATE ON {table} BEGIN DELETE FROM {fts} WHERE rowid = old.id; "
+                      f"{_fts_insert_sql(fts, columns)} END"),
+        f"{fts}_ad": f"AFTER DELETE ON {table} BEGIN DELETE FROM {fts} WHERE rowid = old.id; END",
+    }
+
+def ensure_search_index():
+    """Create the FTS tables and sync triggers if missing, backfilling new tables"""
+    with write_connection() as conn:
+        existing = {r[0] for r in conn.execute(text("SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger')"))}
+        for fts, (table, columns) in SEARCH_INDEXES.items():
+            if fts not in existing:
+                conn.execute(text(f"CREATE VIRTUAL TABLE {fts} USING fts5({', '.join(columns)}, tokenize='unicode61')"))
+                conn.execute(text(_fts_backfill_sql(fts)))
+            for name, body in _fts_triggers(fts).items():
+                if name not in existing:
+                    conn.execute(text(f"CREATE TRIGGER {name} {body}"))
+
+def rebuild_search_index():
+    """Repopulate every FTS table from its source table"""
+    with write_connection() as conn:
+        for fts in SEARCH_INDEXES:
+            conn.execute(text(f"DELETE FROM {fts}"))
+            conn.execute(text(_fts_backfill_sql(fts)))
+
+@contextmanager
+def suspended_triggers(conn, triggers):
+    """Drop the {name: body} triggers on conn for a bulk statement and recreate them
+    when the block ends, inside the caller's transaction, so other writers never see
+    them missing (a rollback restores them as well)"""
+    for name in triggers:
+        conn.execute(text(f"DROP TRIGGER IF EXISTS {name}"))
+    yield
+    for name, body in triggers.items():
+        conn.execute(text(f"CREATE TRIGGER {name} {body}"))
+
+def bulk_insert(conn, model, values):
+    """executemany INSERT for imports. The per-row insert triggers of the FTS index
+    and the data version counter are suspended for the statement and replaced by one
+    INSERT ... SELECT and one version bump."""
+    table = model.__tablename__
+    fts = next((f for f, (t, _) in SEARCH_INDEXES.items() if t == table), None)
+    suspended = {}
+    if fts is not None:
+        suspended[f"{fts}_ai"] = _fts_triggers(fts)[f"{fts}_ai"]
+    if table in VERSIONED_TABLES:
+        name = f"data_versions_{table}_ai"
+        suspended[name] = _version_triggers(table)[name]
+    if not suspended:
+        conn.execute(model.__table__.insert(), values)
+        return
+    last_id = conn.execute(text(f"SELECT coalesce(max(id), 0) FROM {table}")).scalar()
+    with suspended_triggers(conn, suspended):
+        conn.execute(model.__table__.insert(), values)
+        if fts is not None:
+            conn.execute(text(_fts_backfill_sql(fts, where=f"id > {int(last_id)}")))
+        if table in VERSIONED_TABLES:
+            bump_data_version(conn, table)
+
+def fts_query(query):
+    """Turn free text into an FTS5 MATCH expression: every term must match as a prefix"""
+    terms = normalize_arabic(query).replace('"', " ").split()
+    return " ".join(f'"{t}"*' for t in terms)
+
+# --- Daily financial rollup ---
+SUMMARY_COLUMNS = ["income", "clinic_share", "doctor_share", "expenses", "payments_count", "discounts", "taxes", "paid"]
+
+_SUMMARY_UPSERT = (
+    "INSERT INTO daily_summary(day, doctor_id, " + ", ".join(SUMMARY_COLUMNS) + ") {select} "
+    "ON CONFLICT(day, doctor_id) DO UPDATE SET "
+    + ", ".join(f"{c} = {c} + excluded.{c}" for c in SUMMARY_COLUMNS) + ";"
+)
+
+def _payment_delta(row, sign, doctor=None):
+    """Upsert adding (sign=1) or removing (sign=-1) one payment row's amounts"""
+    if doctor is None:
+        doctor = f"coalesce((SELECT doctor_id FROM appointments WHERE id = {row}.appointment_id), 0)"
+    select = (f"SELECT date({row}.date_paid), {doctor}, "
+              f"{sign} * coalesce({row}.total_amount, 0), {sign} * coalesce({row}.clinic_share, 0), "
+              f"{sign} * coalesce({row}.doctor_share, 0), 0, {sign}, {sign} * coalesce({row}.discounts, 0), "
+              f"{sign} * coalesce({row}.taxes, 0), {sign} * coalesce({row}.paid_amount, 0) "
+              f"WHERE {row}.date_paid IS NOT NULL")
+    return _SUMMARY_UPSERT.format(select=select)
+
+def _expense_delta(row, sign):
+    select = (f"SELECT date({row}.date), 0, 0, 0, 0, {sign} * coalesce({row}.amount, 0), 0, 0, 0, 0 "
+              f"WHERE {row}.date IS NOT NULL")
+    return _SUMMARY_UPSERT.format(select=select)
+
+def _appointment_payments_delta(appointment_id, doctor, sign):
+    """Upsert moving every payment of an appointment into (sign=1) or out of (sign=-1) a doctor's rows"""
+    select = (f"SELECT date(date_paid), {doctor}, "
+              f"{sign} * sum(coalesce(total_amount, 0)), {sign} * sum(coalesce(clinic_share, 0)), "
+              f"{sign} * sum(coalesce(doctor_share, 0)), 0, {sign} * count(*), "
+              f"{sign} * sum(coalesce(discounts, 0)), {sign} * sum(coalesce(taxes, 0)), "
+              f"{sign} * sum(coalesce(paid_amount, 0)) "
+              f"FROM payments WHERE appointment_id = {appointment_id} AND date_paid IS NOT NULL "
+              f"GROUP BY date(date_paid)")
+    return _SUMMARY_UPSERT.format(select=select)
+
+SUMMARY_TRIGGERS = {
+    "daily_summary_payments_ai": f"AFTER INSERT ON payments BEGIN {_payment_delta('new', 1)} END",
+    "daily_summary_payments_ad": f"AFTER DELETE ON payments BEGIN {_payment_delta('old', -1)} END",
+    "daily_summary_payments_au": (f"AFTER UPDATE ON payments BEGIN {_payment_delta('old', -1)} "
+                                  f"{_payment_delta('new', 1)} END"),
+    "daily_summary_expenses_ai": f"AFTER INSERT ON expenses BEGIN {_expense_delta('new', 1)} END",
+    "daily_summary_expenses_ad": f"AFTER DELETE ON expenses BEGIN {_expense_delta('old', -1)} END",
+    "daily_summary_expenses_au": (f"AFTER UPDATE ON expenses BEGIN {_expense_delta('old', -1)} "
+                                  f"{_expense_delta('new', 1)} END"),
+    "daily_summary_appointments_au": (
+        "AFTER UPDATE OF doctor_id ON appointments WHEN coalesce(old.doctor_id, 0) != coalesce(new.doctor_id, 0) BEGIN "
+        f"{_appointment_payments_delta('old.id', 'coalesce(old.doctor_id, 0)', -1)} "
+        f"{_appointment_payments_delta('new.id', 'coalesce(new.doctor_id, 0)', 1)} END"),
+    "daily_summary_appointments_ad": (
+        "AFTER DELETE ON appointments BEGIN "
+        f"{_appointment_payments_delta('old.id', 'coalesce(old.doctor_id, 0)', -1)} "
+        f"{_appointment_payments_delta('old.id', '0', 1)} END"),
+}
+
+_SUMMARY_FROM_PAYMENTS = (
+    "SELECT date(p.date_paid), coalesce(a.doctor_id, 0), sum(coalesce(p.total_amount, 0)), "
+    "sum(coalesce(p.clinic_share, 0)), sum(coalesce(p.doctor_share, 0)), 0, count(*), "
+    "sum(coalesce(p.discounts, 0)), sum(coalesce(p.taxes, 0)), sum(coalesce(p.paid_amount, 0)) "
+    "FROM payments p LEFT JOIN appointments a ON a.id = p.appointment_id "
+    "WHERE p.date_paid IS NOT NULL GROUP BY 1, 2"
+)
+_SUMMARY_FROM_EXPENSES = (
+    "SELECT date(date), 0, 0, 0, 0, sum(coalesce(amount, 0)), 0, 0, 0, 0 "
+    "FROM expenses WHERE date IS NOT NULL GROUP BY 1"
+)
+
+def rebuild_daily_summary(conn=None):
+    """Recompute daily_summary from the raw payments and expenses tables"""
+    if conn is None:
+        with write_connection() as conn:
+            return rebuild_daily_summary(conn)
+    conn.execute(text("DELETE FROM daily_summary"))
+    conn.execute(text(_SUMMARY_UPSERT.format(select=_SUMMARY_FROM_PAYMENTS)))
+    conn.execute(text(_SUMMARY_UPSERT.format(select=_SUMMARY_FROM_EXPENSES)))
+
+def payment_update_triggers():
+    """{name: body} of the per-row triggers an UPDATE of payments fires"""
+    return {"daily_summary_payments_au": SUMMARY_TRIGGERS["daily_summary_payments_au"],
+            "data_versions_payments_au": _version_triggers("payments")["data_versions_payments_au"]}
+
+def add_to_daily_summary(conn, select_sql):
+    """Add rows of (day, doctor_id, *SUMMARY_COLUMNS) deltas into the rollup, for bulk
+    writes made with the payment triggers suspended"""
+    conn.execute(text(_SUMMARY_UPSERT.format(select=select_sql)))
+
+def check_daily_summary(tolerance=0.005):
+    """Compare the rollup with a fresh aggregation; returns a list of
+    (day, doctor_id, column, expected, actual) for every mismatch"""
+    expected = {}
+    with engine.connect() as conn:
+        for sql in (_SUMMARY_FROM_PAYMENTS, _SUMMARY_FROM_EXPENSES):
+            for day, doctor_id, *values in conn.execute(text(sql)):
+                acc = expected.setdefault((day, doctor_id), [0.0] * len(SUMMARY_COLUMNS))
+                for i, v in enumerate(values):
+                    acc[i] += v or 0
+        actual = {(r[0], r[1]): list(r[2:]) for r in conn.execute(
+            text(f"SELECT day, doctor_id, {', '.join(SUMMARY_COLUMNS)} FROM daily_summary"))}
+    mismatches = []
+    for key in sorted(set(expected) | set(actual)):
+        exp = expected.get(key, [0.0] * len(SUMMARY_COLUMNS))
+        act = actual.get(key, [0.0] * len(SUMMARY_COLUMNS))
+        for col, e, a in zip(SUMMARY_COLUMNS, exp, act):
+            if abs((e or 0) - (a or 0)) > tolerance:
+                mismatches.append((key[0], key[1], col, e, a))
+    return mismatches
+
+def ensure_daily_summary():
+    """Install the rollup triggers; the first install also backfills the table"""
+    with write_connection() as conn:
+        existing = {r[0] for r in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'trigger'"))}
+        missing = [name for name in SUMMARY_TRIGGERS if name not in existing]
+        for name in missing:
+            conn.execute(text(f"CREATE TRIGGER {name} {SUMMARY_TRIGGERS[name]}"))
+        if missing:
+            rebuild_daily_summary(conn)
+
+# --- Persistent data versions ---
+VERSIONED_TABLES = ["patients", "doctors", "treatments", "treatment_percentages", "appointments", "payments", "expenses"]
+
+def _version_triggers(table):
+    bump = f"UPDATE data_versions SET version = version + 1 WHERE table_name = '{table}';"
+    return {f"data_versions_{table}_a{op[0].lower()}": f"AFTER {op} ON {table} BEGIN {bump} END"
+            for op in ("INSERT", "UPDATE", "DELETE")}
+
+def ensure_data_versions():
+    """Seed a counter row per versioned table and install the triggers that bump it"""
+    with write_connection() as conn:
+        existing = {r[0] for r in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'trigger'"))}
+        for table in VERSIONED_TABLES:
+            conn.execute(text("INSERT OR IGNORE INTO data_versions(table_name, version) VALUES (:t, 0)"), {"t": table})
+            for name, body in _version_triggers(table).items():
+                if name not in existing:
+                    conn.execute(text(f"CREATE TRIGGER {name} {body}"))
+
+def bump_data_version(conn, table):
+    conn.execute(text("UPDATE data_versions SET version = version + 1 WHERE table_name = :t"), {"t": table})
+
+def table_versions(conn, tables):
+    """{table: version} for the given tables"""
+    rows = conn.execute(text("SELECT table_name, version FROM data_versions"))
+    return {name: version for name, version in rows if name in tables}
+
+# --- DB session context manager ---
+@contextmanager
+def get_session(write=False):
+    """Session committed on exit. Write sessions start with BEGIN IMMEDIATE, retried
+    with backoff on lock errors, so they never fail halfway when upgrading a read
+    transaction; read sessions use a deferred BEGIN and never wait on writers (WAL)."""
+    session = Session()
+    try:
+        if write:
+            _begin_write(session)
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+def _begin_write(session):
+    for attempt in range(LOCK_RETRIES):
+        try:
+            session.connection(execution_options={"sqlite_begin": "IMMEDIATE"})
+            return
+        except OperationalError as e:
+            session.rollback()
+            if not is_lock_error(e) or attempt == LOCK_RETRIES - 1:
+                raise
+            time.sleep(lock_backoff(attempt))
+
+# --- Schema setup ---
+_init_lock = threading.Lock()
+_initialized = False
+
 def init_db():
-    Base.metadata.create_all(engine)
+    """Create tables, apply migrations and install the search/rollup triggers.
+    Runs once per process; later calls (every Streamlit rerun) return immediately."""
+    global _initialized
+    with _init_lock:
+        if _initialized:
+            return
+        Base.metadata.create_all(engine)
+        migrate_schema()
+        ensure_search_index()
+        ensure_daily_summary()
+        ensure_data_versions()
+        _initialized = True
@@ -1,47 +1,162 @@
 # reports.py
+import functools
+import os
 import pandas as pd
-from database import Session
-from models import Payment
+from sqlalchemy import func
+from models import Session, Payment, DailySummary
+from database import REPORT_PERIODS, date_range
 import io
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
 
 def generate_report(start_date, end_date):
+    """Payments dated start_date..end_date, both days inclusive like the CSV export"""
     session = Session()
-    payments = session.query(Payment).filter(
-        Payment.date_paid.between(start_date, end_date)).all()
-    data = []
-    for p in payments:
-        data.append({
-            'موعد': p.appointment_id,
-            'إجمالي': p.total_amount,
-            'نصيب العيادة': p.clinic_share,
-            'نصيب الطبيب': p.doctor_share,
-            'تاريخ': p.date_paid
-        })
-    df = pd.DataFrame(data)
+    rows = session.query(
+        Payment.appointment_id,
+        Payment.total_amount,
+        Payment.clinic_share,
+        Payment.doctor_share,
+        Payment.date_paid).filter(
+        *date_range(Payment.date_paid, start_date, end_date)).all()
+    df = pd.DataFrame(rows, columns=['موعد', 'إجمالي', 'نصيب العيادة', 'نصيب الطبيب', 'تاريخ'])
     session.close()
     return df
 
-def export_to_pdf(df):
-    buffer = io.BytesIO()
-    c = canvas.Canvas(buffer, pagesize=letter)
-    c.drawString(100, 750, "تقرير المحاسبة")
-    y = 700
-    x_positions = [100, 200, 300, 400, 500]
-    for i, col in enumerate(df.columns):
-        c.drawString(x_positions[i], y, col)
-    y -= 20
-    for _, row in df.iterrows():
-        for i, val in enumerate(row):
-            c.drawString(x_positions[i], y, str(val))
-        y -= 20
-        if y < 50:
-            c.showPage()
-            y = 750
+def generate_summary(start_date, end_date, period='day'):
+    """Per-period totals read from the daily_summary rollup (one row per day, not per payment)"""
+    session = Session()
+    bucket = func.strftime(REPORT_PERIODS[period], DailySummary.day)
+    rows = session.query(
+        bucket,
+        func.sum(DailySummary.income),
+        func.sum(DailySummary.clinic_share),
+        func.sum(DailySummary.doctor_share),
+        func.sum(DailySummary.expenses)).filter(
+        DailySummary.day.between(start_date, end_date)).group_by(bucket).order_by(bucket).all()
+    session.close()
+    df = pd.DataFrame(rows, columns=['الفترة', 'إجمالي', 'نصيب العيادة', 'نصيب الطبيب', 'المصروفات'])
+    df['الصافي'] = df['نصيب العيادة'] - df['المصروفات']
+    return df
+
+# Arabic-capable TrueType fonts tried in order; DENTAL_PDF_FONT overrides
+PDF_FONT_CANDIDATES = [
+    os.environ.get('DENTAL_PDF_FONT', ''),
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+    '/usr/share/fonts/truetype/noto/NotoNaskhArabic-Regular.ttf',
+    '/usr/share/fonts/opentype/fonts-hosny-amiri/Amiri-Regular.ttf',
+    'C:/Windows/Fonts/arial.ttf',
+    'C:/Windows/Fonts/tahoma.ttf',
+    '/Library/Fonts/Arial Unicode.ttf',
+]
+PDF_FONT_SIZE = 9
+PDF_ROW_HEIGHT = PDF_FONT_SIZE * 1.6
+PDF_MARGIN = 36
+PDF_CELL_PADDING = 4
+
+@functools.lru_cache(maxsize=None)
+def pdf_font():
+    """Register the first available Arabic-capable font; falls back to Helvetica"""
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+
+    for path in PDF_FONT_CANDIDATES:
+        if path and os.path.exists(path):
+            pdfmetrics.registerFont(TTFont('ReportFont', path))
+            return 'ReportFont'
+    return 'Helvetica'
+
+@functools.lru_cache(maxsize=65536)
+def shape_text(text):
+    """Join Arabic letters into their contextual forms and reorder for left-to-right drawing"""
+    if not any('\u0600' <= ch <= '\u06ff' for ch in text):
+        return text
+    import arabic_reshaper
+    from bidi.algorithm import get_display
+    return get_display(arabic_reshaper.reshape(text))
+
+def _format_column(col):
+    """Whole-column string formatting: amounts to 2 decimals, dates to ISO, text shaped once per distinct value"""
+    if pd.api.types.is_bool_dtype(col) or pd.api.types.is_integer_dtype(col):
+        return col.astype(str)
+    if pd.api.types.is_numeric_dtype(col):
+        return col.map('{:,.2f}'.format).where(col.notna(), '')
+    if pd.api.types.is_datetime64_any_dtype(col):
+        return col.dt.strftime('%Y-%m-%d %H:%M').fillna('')
+    col = col.fillna('').astype(str)
+    shaped = {v: shape_text(v) for v in col.unique()}
+    return col.map(shaped)
+
+def export_to_pdf(df, out=None, title='تقرير المحاسبة'):
+    """Render df as a right-to-left table into out (a binary file object, BytesIO by default).
+
+    Cells are formatted per column up front, column widths come from the widest value,
+    and each page holds as many rows as fit at PDF_ROW_HEIGHT, with the header repeated.
+
+    Memory is not flat: df and its formatted cells are held whole, and reportlab's canvas
+    keeps every finished page (compressed) until save(), so it grows with the row count
+    (about 4 s for 50k rows). Very long ranges belong in the streaming CSV export.
+    """
+    from reportlab.lib.pagesizes import A4, landscape
+    from reportlab.pdfbase.pdfmetrics import stringWidth
+    from reportlab.pdfgen import canvas
+
+    buffer = out is None
+    out = io.BytesIO() if buffer else out
+    font = pdf_font()
+    page_w, page_h = landscape(A4) if len(df.columns) > 6 else A4
+
+    headers = [shape_text(str(c)) for c in df.columns]
+    cells = [_format_column(df[c]).tolist() for c in df.columns]
+    # widths summed from a per-character table; reportlab's stringWidth per cell dominates otherwise
+    char_widths = {}
+    def width(text):
+        try:
+            return sum(map(char_widths.__getitem__, text))
+        except KeyError:
+            for ch in text:
+                if ch not in char_widths:
+                    char_widths[ch] = stringWidth(ch, font, PDF_FONT_SIZE)
+            return width(text)
+    col_w = [max([width(h)] + [width(v) for v in set(col)]) + 2 * PDF_CELL_PADDING
+             for h, col in zip(headers, cells)]
+    scale = min(1.0, (page_w - 2 * PDF_MARGIN) / max(sum(col_w), 1))
+    # first column on the right; each cell is right-aligned within its column
+    right_edges = []
+    x = page_w - PDF_MARGIN
+    for w in col_w:
+        right_edges.append(x - PDF_CELL_PADDING)
+        x -= w * scale
+
+    top = page_h - PDF_MARGIN - 2 * PDF_ROW_HEIGHT
+    rows_per_page = max(1, int((top - PDF_MARGIN) // PDF_ROW_HEIGHT))
+    n_rows = len(df)
+    pages = max(1, -(-n_rows // rows_per_page))
+
+    c = canvas.Canvas(out, pagesize=(page_w, page_h), pageCompression=1)
+    for page in range(pages):
+        c.setFont(font, PDF_FONT_SIZE + 4)
+        c.drawRightString(page_w - PDF_MARGIN, page_h - PDF_MARGIN, shape_text(title))
+        c.setFont(font, PDF_FONT_SIZE)
+        c.drawString(PDF_MARGIN, PDF_MARGIN / 2, f'{page + 1} / {pages}')
+        c.line(x, top - PDF_ROW_HEIGHT * 0.3, page_w - PDF_MARGIN, top - PDF_ROW_HEIGHT * 0.3)
+        first = page * rows_per_page
+        last = min(first + rows_per_page, n_rows)
+        text = c.beginText()
+        text.setFont(font, PDF_FONT_SIZE, PDF_ROW_HEIGHT)
+        for right, header, col in zip(right_edges, headers, cells):
+            # one line per cell; Td shifts each line start so the cell ends at the column's right edge
+            text.setTextOrigin(right, top)
+            prev = 0
+            for value in [header] + col[first:last]:
+                w = width(value)
+                text.moveCursor(prev - w, 0)
+                text.textLine(value)
+                prev = w
+        c.drawText(text)
+        c.showPage()
     c.save()
-    buffer.seek(0)
-    return buffer
+    if buffer:
+        out.seek(0)
+    return out
 
 def export_to_excel(df):
     buffer = io.BytesIO()
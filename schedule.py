@@ -0,0 +1,64 @@
+# schedule.py
+import bisect
+import datetime
+
+WORKING_HOURS = (datetime.time(9, 0), datetime.time(21, 0))
+
+class DoctorSchedule:
+    """One doctor's bookings as (start, end, appointment_id) tuples sorted by start.
+
+    Lookups bisect on the start times; `longest` bounds how far back an interval
+    starting earlier can still reach, so a slot search starts only a few intervals back.
+    Not thread-safe: callers hold a lock while reading or changing a shared instance.
+    """
+    __slots__ = ("starts", "intervals", "by_id", "longest")
+
+    def __init__(self, bookings=()):
+        self.intervals = sorted((start, end, appt_id) for appt_id, start, end in bookings)
+        self.starts = [start for start, _, _ in self.intervals]
+        self.by_id = {appt_id: start for start, _, appt_id in self.intervals}
+        self.longest = max((end - start for start, end, _ in self.intervals), default=datetime.timedelta(0))
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def add(self, appt_id, start, end):
+        self.remove(appt_id)
+        i = bisect.bisect_right(self.starts, start)
+        self.starts.insert(i, start)
+        self.intervals.insert(i, (start, end, appt_id))
+        self.by_id[appt_id] = start
+        self.longest = max(self.longest, end - start)
+
+    def remove(self, appt_id):
+        start = self.by_id.pop(appt_id, None)
+        if start is None:
+            return
+        i = bisect.bisect_left(self.starts, start)
+        while self.intervals[i][2] != appt_id:
+            i += 1
+        del self.starts[i]
+        del self.intervals[i]
+
+    def free_slots(self, start, end, duration, hours=WORKING_HOURS):
+        """Gaps of at least duration inside [start, end) and within working hours, as (start, end)"""
+        slots = []
+        day = start.date()
+        while day <= end.date():
+            lo = max(start, datetime.datetime.combine(day, hours[0]))
+            hi = min(end, datetime.datetime.combine(day, hours[1]))
+            cursor = lo
+            # the booking that began before lo but may still be running
+            i = bisect.bisect_left(self.starts, lo - self.longest)
+            while i < len(self.intervals) and cursor < hi:
+                s, e, _ = self.intervals[i]
+                if s >= hi:
+                    break
+                if s - cursor >= duration:
+                    slots.append((cursor, s))
+                cursor = max(cursor, e)
+                i += 1
+            if hi - cursor >= duration:
+                slots.append((cursor, hi))
+            day += datetime.timedelta(days=1)
+        return slots
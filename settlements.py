@@ -0,0 +1,151 @@
+# settlements.py
+"""Doctor payouts per period.
+
+Live totals are one grouped query over the daily_summary rollup, whose
+triggers already attribute every payment to its appointment's doctor, so a
+year costs a few thousand rollup rows rather than every payment. Closing a
+period stores those totals as a settlement snapshot; a closed period is read
+back from the snapshot, so later edits to old payments never change what was
+already paid out.
+"""
+import datetime
+
+import pandas as pd
+from sqlalchemy import func, select
+
+from database import get_doctors
+from models import (
+    Appointment, DailySummary, Doctor, Patient, Payment, Settlement, SettlementLine, Treatment, engine, get_session,
+    write_connection,
+)
+
+TOTAL_COLUMNS = ["payments_count", "gross", "discounts", "taxes", "net", "paid", "unpaid", "clinic_share",
+                 "doctor_share"]
+SETTLEMENT_HEADERS = {
+    "doctor_name": "الطبيب", "payments_count": "عدد الدفعات", "gross": "الإجمالي", "discounts": "الخصومات",
+    "taxes": "الضرائب", "net": "الصافي", "paid": "المدفوع", "unpaid": "غير المدفوع",
+    "clinic_share": "نصيب العيادة", "doctor_share": "مستحق الطبيب",
+}
+
+class SettlementError(ValueError):
+    pass
+
+def _bounds(start_date, end_date):
+    """[start of start_date, start of the day after end_date) for the DateTime column date_paid"""
+    return (datetime.datetime.combine(start_date, datetime.time.min),
+            datetime.datetime.combine(end_date, datetime.time.min) + datetime.timedelta(days=1))
+
+def _totals_statement(start_date, end_date):
+    gross = func.sum(DailySummary.income)
+    discounts = func.sum(DailySummary.discounts)
+    taxes = func.sum(DailySummary.taxes)
+    paid = func.sum(DailySummary.paid)
+    # doctor_id 0 holds expenses and payments without an appointment
+    return (select(DailySummary.doctor_id, func.sum(DailySummary.payments_count), gross, discounts, taxes,
+                   gross - discounts + taxes, paid, gross - discounts + taxes - paid,
+                   func.sum(DailySummary.clinic_share), func.sum(DailySummary.doctor_share))
+            .where(DailySummary.day >= start_date, DailySummary.day <= end_date, DailySummary.doctor_id != 0)
+            .group_by(DailySummary.doctor_id)
+            .having(func.sum(DailySummary.payments_count) > 0))
+
+def _line(doctor_id, values, names):
+    line = {"doctor_id": doctor_id, "doctor_name": names.get(doctor_id, "")}
+    for column, value in zip(TOTAL_COLUMNS, values):
+        line[column] = value if column == "payments_count" else round(value or 0.0, 2)
+    return line
+
+def _compute(conn, start_date, end_date):
+    names = {d.id: d.name for d in get_doctors()}
+    lines = [_line(doctor_id, values, names) for doctor_id, *values in conn.execute(_totals_statement(start_date, end_date))]
+    return sorted(lines, key=lambda line: line["doctor_name"])
+
+def compute_settlement(start_date, end_date):
+    """Live per-doctor totals for payments dated start_date..end_date (inclusive days)"""
+    with engine.connect() as conn:
+        return _compute(conn, start_date, end_date)
+
+def _overlapping(conn, start_date, end_date):
+    return conn.execute(select(Settlement.id, Settlement.period_start, Settlement.period_end)
+                        .where(Settlement.period_start <= end_date, Settlement.period_end >= start_date)).first()
+
+def close_period(start_date, end_date):
+    """Snapshot the period's totals as a settlement and return its id. Periods must have
+    ended and may not overlap a closed one, so no payment is ever paid out twice."""
+    if end_date < start_date:
+        raise SettlementError("تاريخ النهاية قبل تاريخ البداية")
+    if end_date >= datetime.date.today():
+        raise SettlementError("لا يمكن إقفال فترة لم تنته بعد")
+    # one write transaction: no payment can land in the period between the check and the snapshot
+    with write_connection() as conn:
+        clash = _overlapping(conn, start_date, end_date)
+        if clash:
+            raise SettlementError(f"الفترة تتداخل مع تسوية مقفلة رقم {clash.id} ({clash.period_start} - {clash.period_end})")
+        lines = _compute(conn, start_date, end_date)
+        settlement_id = conn.execute(Settlement.__table__.insert().values(
+            period_start=start_date, period_end=end_date, closed_at=datetime.datetime.now(),
+            payments_count=sum(line["payments_count"] for line in lines),
+            doctor_share=round(sum(line["doctor_share"] for line in lines), 2))).inserted_primary_key[0]
+        if lines:
+            conn.execute(SettlementLine.__table__.insert(), [
+                {"settlement_id": settlement_id, "doctor_id": line["doctor_id"],
+                 **{column: line[column] for column in TOTAL_COLUMNS}} for line in lines])
+    return settlement_id
+
+def get_settlements():
+    """Closed settlements, latest period first"""
+    with get_session() as session:
+        return (session.query(Settlement.id, Settlement.period_start, Settlement.period_end, Settlement.closed_at,
+                              Settlement.payments_count, Settlement.doctor_share)
+                .order_by(Settlement.period_start.desc()).all())
+
+def get_settlement_lines(settlement_id):
+    names = {d.id: d.name for d in get_doctors()}
+    with get_session() as session:
+        rows = (session.query(SettlementLine.doctor_id, *(getattr(SettlementLine, c) for c in TOTAL_COLUMNS))
+                .filter(SettlementLine.settlement_id == settlement_id).all())
+    return sorted((_line(doctor_id, values, names) for doctor_id, *values in rows), key=lambda line: line["doctor_name"])
+
+def settlement_for(start_date, end_date):
+    """(lines, settlement id) for the period: the snapshot when exactly this period is
+    closed, otherwise live totals and None"""
+    with get_session() as session:
+        settlement_id = (session.query(Settlement.id)
+                         .filter(Settlement.period_start == start_date, Settlement.period_end == end_date).scalar())
+    if settlement_id is not None:
+        return get_settlement_lines(settlement_id), settlement_id
+    return compute_settlement(start_date, end_date), None
+
+def settlement_frame(lines):
+    """Lines as a table with Arabic headers and a totals row"""
+    df = pd.DataFrame(lines, columns=["doctor_id"] + list(SETTLEMENT_HEADERS)).drop(columns="doctor_id")
+    if not df.empty:
+        totals = df[TOTAL_COLUMNS].sum()
+        totals["doctor_name"] = "الإجمالي"
+        df = pd.concat([df, totals.to_frame().T], ignore_index=True)
+        df["payments_count"] = df["payments_count"].astype(int)
+        df[TOTAL_COLUMNS[1:]] = df[TOTAL_COLUMNS[1:]].astype(float)
+    return df.rename(columns=SETTLEMENT_HEADERS)
+
+def doctor_statement(doctor_id, start_date, end_date):
+    """One doctor's payments in the period, one row each, followed by a totals row"""
+    start, end = _bounds(start_date, end_date)
+    with get_session() as session:
+        rows = (session.query(Payment.date_paid, Payment.id, Patient.name, Treatment.name, Payment.total_amount,
+                              Payment.discounts, Payment.taxes, Payment.paid_amount, Payment.doctor_share)
+                .join(Appointment, Payment.appointment_id == Appointment.id)
+                .outerjoin(Patient, Appointment.patient_id == Patient.id)
+                .outerjoin(Treatment, Appointment.treatment_id == Treatment.id)
+                .filter(Appointment.doctor_id == doctor_id, Payment.date_paid >= start, Payment.date_paid < end)
+                .order_by(Payment.date_paid, Payment.id).all())
+    amounts = ["الإجمالي", "الخصم", "الضريبة", "المدفوع", "مستحق الطبيب"]
+    df = pd.DataFrame(rows, columns=["التاريخ", "رقم الدفعة", "المريض", "العلاج"] + amounts)
+    df[amounts] = df[amounts].fillna(0.0).astype(float)
+    totals = pd.DataFrame([{"المريض": "الإجمالي", **df[amounts].sum().to_dict()}])
+    df = pd.concat([df, totals], ignore_index=True)
+    df["رقم الدفعة"] = df["رقم الدفعة"].map(lambda v: "" if pd.isna(v) else str(int(v)))
+    return df
+
+def statement_title(doctor_id, start_date, end_date):
+    with get_session() as session:
+        name = session.query(Doctor.name).filter(Doctor.id == doctor_id).scalar() or ""
+    return f"كشف حساب {name} {start_date} - {end_date}"
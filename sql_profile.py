@@ -0,0 +1,125 @@
+# sql_profile.py
+"""Per-rerun SQL statistics from SQLAlchemy event hooks.
+
+install() once per process, then wrap a unit of work (one Streamlit rerun) in
+capture(); every statement executed in that thread meanwhile is recorded with
+its duration, ORM row count and whether it was a lazy relationship load.
+
+Opt-in with DENTAL_SQL_DEBUG: counting rows buffers every ORM result, so without
+it install() attaches nothing and capture() records nothing.
+"""
+import contextvars
+import json
+import logging
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from models import Session, engine
+
+log = logging.getLogger("dental.sql")
+
+ENABLED = bool(os.environ.get("DENTAL_SQL_DEBUG"))
+SLOW_STATEMENT_MS = 100
+_current = contextvars.ContextVar("sql_profile", default=None)
+_installed = []
+
+class QueryStats:
+    __slots__ = ("label", "started", "statements", "lazy_loads")
+
+    def __init__(self, label=None):
+        self.label = label
+        self.started = time.perf_counter()
+        # [sql, ms, rows or None]; rows is known for ORM queries, which are fully fetched anyway
+        self.statements = []
+        self.lazy_loads = {}
+
+    @property
+    def total_ms(self):
+        return sum(s[1] for s in self.statements)
+
+    def repeated(self, threshold=3):
+        """SQL texts executed threshold times or more: the signature of an N+1 loop"""
+        counts = {}
+        for sql, _, _ in self.statements:
+            if not sql.startswith("BEGIN"):
+                counts[sql] = counts.get(sql, 0) + 1
+        return {sql: n for sql, n in counts.items() if n >= threshold}
+
+    def summary(self, top=5):
+        slowest = sorted(self.statements, key=lambda s: -s[1])[:top]
+        return {
+            "label": self.label,
+            "statements": len(self.statements),
+            "sql_ms": round(self.total_ms, 2),
+            "wall_ms": round((time.perf_counter() - self.started) * 1000, 2),
+            "rows": sum(s[2] or 0 for s in self.statements),
+            "lazy_loads": sum(self.lazy_loads.values()),
+            "lazy_load_paths": self.lazy_loads,
+            "repeated": {sql[:200]: n for sql, n in self.repeated().items()},
+            "slowest": [{"sql": sql[:200], "ms": round(ms, 2), "rows": rows} for sql, ms, rows in slowest],
+        }
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("sql_profile_start", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _current.get()
+    starts = conn.info.get("sql_profile_start")
+    if stats is None or not starts:
+        return
+    ms = (time.perf_counter() - starts.pop()) * 1000
+    stats.statements.append([" ".join(statement.split()), ms, None])
+    if ms >= SLOW_STATEMENT_MS:
+        log.warning("slow statement %.1f ms: %s", ms, statement[:500])
+
+def _do_orm_execute(orm_execute_state):
+    stats = _current.get()
+    if stats is None:
+        return None
+    if orm_execute_state.is_relationship_load and orm_execute_state.lazy_loaded_from is not None:
+        path = orm_execute_state.loader_strategy_path
+        path = str(path[-1]) if path else "?"
+        stats.lazy_loads[path] = stats.lazy_loads.get(path, 0) + 1
+    if not orm_execute_state.is_select:
+        return None
+    before = len(stats.statements)
+    frozen = orm_execute_state.invoke_statement().freeze()
+    if len(stats.statements) > before:
+        stats.statements[-1][2] = len(frozen.data)
+    return frozen()
+
+def install(eng=engine, session_factory=Session):
+    """Attach the hooks when profiling is enabled; idempotent, since app.py runs again
+    on every Streamlit rerun"""
+    if not ENABLED or (eng, session_factory) in _installed:
+        return
+    event.listen(eng, "before_cursor_execute", _before_cursor_execute)
+    event.listen(eng, "after_cursor_execute", _after_cursor_execute)
+    event.listen(session_factory, "do_orm_execute", _do_orm_execute)
+    _installed.append((eng, session_factory))
+    if not log.handlers:
+        # one JSON object per line on stderr unless the host app configured this logger
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(message)s"))
+        log.addHandler(handler)
+        log.setLevel(os.environ.get("DENTAL_SQL_LOG_LEVEL", "INFO"))
+
+@contextmanager
+def capture(label=None):
+    """Collect statistics for the statements run in this context; logs one JSON line at the end.
+    Yields None when profiling is not enabled."""
+    if not _installed:
+        yield None
+        return
+    stats = QueryStats(label)
+    token = _current.set(stats)
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+        log.info(json.dumps(stats.summary(), ensure_ascii=False))